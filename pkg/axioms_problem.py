@@ -121,7 +121,7 @@ class AxiomsProblem(Problem):
         if not make_free:
             self._density_coeff_blocks.append(new_density_indices)
 
-        self._compute_densities()
+        self._compute_densities(new_only=True)
 
     def _augment_certificate(self, data):
         
@@ -271,28 +271,21 @@ class AxiomsProblem(Problem):
         else:
             density_indices = range(num_densities)
         
-        DR = matrix(self._field, 0, num_sharps, sparse=True)
-        EDR = matrix(self._field, 0, num_sharps, sparse=True)
+        echelon = IncrementalEchelon(self._field, num_sharps)
                 
         sys.stdout.write("Constructing DR matrix")
         
         for j in density_indices:
-            new_row = matrix(QQ, [[self._densities[j][gi] for gi in self._sharp_graphs]], sparse=True)
-            if new_row.is_zero():
-                continue
-            try:
-                X = EDR.solve_left(new_row)
+            new_row = [self._densities[j][gi] for gi in self._sharp_graphs]
+            if all(x == 0 for x in new_row):
                 continue
-            except ValueError:
-                DR = DR.stack(new_row)
-                EDR = EDR.stack(new_row)
-                EDR.echelonize()
+            if echelon.add(new_row):
                 densities_to_use.append(j)
                 sys.stdout.write(".")
                 sys.stdout.flush()
             
         sys.stdout.write("\n")
-        sys.stdout.write("Rank is %d.\n" % DR.nrows())
+        sys.stdout.write("Rank is %d.\n" % echelon.rank)
 
         sys.stdout.write("Densities: %s\n" % (densities_to_use,))
 
@@ -37,6 +37,8 @@ from oriented_graph_flag import *
 from multigraph_flag import *
 
 from problem import *
+from sdp import *
+from batch import *
 
 from construction import *
 from blowup_construction import *
@@ -0,0 +1,325 @@
+"""
+
+flagmatic 2
+
+Copyright (c) 2012, E. R. Vaughan. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1) Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+
+2) Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation and/or
+other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+Further development of Flagmatic is supported by ERC.
+http://cordis.europa.eu/project/rcn/104324_en.html
+"""
+
+import json
+import multiprocessing
+import os
+import resource
+import signal
+import sys
+import time
+import traceback
+
+import sdp
+
+
+class BatchJob(object):
+    r"""
+    A job for ``BatchRunner``: either a problem script, such as "examples/33.sage", which
+    is run line by line as by ``Example`` in examples.sage, or a function of no arguments
+    that sets up and solves a problem and returns it.
+    """
+
+    def __init__(self, job, name=None):
+
+        if isinstance(job, basestring):
+            self.script = job
+            self.function = None
+            default_name = os.path.splitext(os.path.basename(job))[0]
+        else:
+            self.script = None
+            self.function = job
+            default_name = getattr(job, "__name__", "job")
+
+        self.name = default_name if name is None else name
+        self.status = "pending"
+        self.attempts = 0
+        self.seconds = 0.0
+        self.bound = None
+        self.error = None
+
+    def __repr__(self):
+        return "BatchJob(%s, %s)" % (self.name, self.status)
+
+    def run(self, save=True):
+        r"""
+        Runs the job in this process, and returns the problem.
+        """
+        if not self.function is None:
+            return self.function()
+
+        from sage.repl.preparse import preparse
+
+        base_filename = os.path.splitext(self.script)[0]
+        with open(self.script, "r") as f:
+            lines = f.read().splitlines()
+        if save:
+            lines.append('problem.write_certificate("' + base_filename + '.js")')
+            lines.append('problem.save("' + base_filename + '")')
+
+        namespace = {}
+        exec("from sage.all import *\nfrom flagmatic.all import *\nproblem = None", namespace)
+        for line in lines:
+            sys.stdout.write("sage: %s\n" % line)
+            exec(preparse(line), namespace)
+        return namespace["problem"]
+
+
+class _StageSlot(object):
+    # Passed to the SDP solver code in a job process (as sdp.solver_slot). While external
+    # solvers run, the job gives up its generation slot and holds a solver slot for each
+    # of them; the slots are handed out by the BatchRunner process.
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def acquire(self, count=1):
+        self.connection.send(("stage", ("solve", count)))
+        return self.connection.recv()
+
+    def release(self):
+        self.connection.send(("stage", ("generate", 1)))
+        self.connection.recv()
+
+
+def _run_job(job, connection, log_filename, save, cpu_time, memory):
+    # The body of a job process.
+
+    os.setpgrp()  # so that the job and its solver processes can be killed together
+
+    if not cpu_time is None:
+        resource.setrlimit(resource.RLIMIT_CPU, (int(cpu_time), int(cpu_time) + 5))
+
+    # The memory limit is for the solvers only: they are what can use a huge amount of
+    # memory, and SolverLimits diagnoses their failures. An address space limit on the
+    # Sage process itself would also make its own allocations fail.
+    if not memory is None:
+        sdp.default_solver_limits = sdp.SolverLimits(memory=memory)
+    sdp.solver_slot = _StageSlot(connection)
+
+    log = open(log_filename, "w")
+    sys.stdout = sys.stderr = log
+
+    try:
+        problem = job.run(save=save)
+        bound = None
+        if not problem is None:
+            for attr in ["_bound", "_sdp_objective_value"]:
+                if hasattr(problem, attr):
+                    bound = str(getattr(problem, attr))
+                    break
+        message = ("done", bound)
+    except MemoryError:
+        message = ("failed", "out of memory")
+    except Exception:
+        traceback.print_exc(None, log)
+        message = ("failed", traceback.format_exc().strip().splitlines()[-1])
+
+    log.flush()
+    connection.send(message)
+
+
+class BatchRunner(object):
+    r"""
+    Runs many problems, each in its own process, keeping a pool of generation workers (for
+    the Sage stages: generating flags, computing products, rounding) and a separate pool of
+    external SDP solver workers busy, so that the two kinds of work overlap. This is for
+    total throughput; an individual problem is not solved any faster.
+
+    INPUT:
+
+     - ``jobs`` - a list of jobs. Each is a BatchJob, a filename of a problem script
+       (such as "examples/33.sage"), or a function of no arguments that returns a solved
+       problem.
+
+     - ``generation_workers`` - Integer (default: 2). The number of jobs that can be doing
+       Sage computations at once.
+
+     - ``solver_workers`` - Integer (default: 1). The number of external SDP solvers that
+       can be running at once.
+
+     - ``wall_time`` - Number or None (default: None). The wall-clock limit for each
+       attempt at a job, in seconds.
+
+     - ``cpu_time`` - Number or None (default: None). The CPU time limit for each attempt,
+       in seconds. It applies separately to the job process and to each solver it runs.
+
+     - ``memory`` - Integer or None (default: None). The address space limit for each
+       external solver that an attempt runs, in bytes (see ``SolverLimits``). It does not
+       apply to the job process itself.
+
+     - ``retries`` - Integer (default: 1). How many more times a job that fails is tried.
+
+     - ``log_directory`` - String or None (default: None). Where the output of each job is
+       written, as "<name>.txt". By default it goes next to the script, or in the current
+       directory for functions.
+
+     - ``save`` - Boolean (default: True). Whether to write the certificate and save the
+       problem at the end of each script, as ``Example`` does.
+
+    EXAMPLES:
+
+    sage: runner = BatchRunner(glob.glob("examples/*.sage"), generation_workers=6,
+              solver_workers=2, wall_time=12 * 3600, memory=16 * 2^30)
+    sage: summary = runner.run()
+    """
+
+    def __init__(self, jobs, generation_workers=2, solver_workers=1, wall_time=None,
+                 cpu_time=None, memory=None, retries=1, log_directory=None, save=True):
+
+        self.jobs = [j if isinstance(j, BatchJob) else BatchJob(j) for j in jobs]
+        self.generation_workers = max(1, generation_workers)
+        self.solver_workers = max(1, solver_workers)
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.memory = memory
+        self.retries = retries
+        self.log_directory = log_directory
+        self.save = save
+
+    def _log_filename(self, job):
+        if not self.log_directory is None:
+            directory = self.log_directory
+        elif not job.script is None:
+            directory = os.path.dirname(job.script)
+        else:
+            directory = os.getcwd()
+        return os.path.join(directory, job.name + ".txt")
+
+    def _start(self, job):
+        parent_connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_run_job, args=(job, child_connection,
+            self._log_filename(job), self.save, self.cpu_time, self.memory))
+        process.start()
+        child_connection.close()
+        job.attempts += 1
+        job.status = "running"
+        sys.stdout.write("Starting %s (attempt %d).\n" % (job.name, job.attempts))
+        # running jobs are [job, process, connection, start time, stage, wanted stage,
+        # number of slots held or wanted]
+        return [job, process, parent_connection, time.time(), "generate", None, 1]
+
+    def _finish(self, entry, status, info, pending):
+        job, process, connection, start_time = entry[:4]
+        if process.is_alive():
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        process.join()
+        connection.close()
+        job.seconds += time.time() - start_time
+
+        if status == "done":
+            job.status, job.bound, job.error = "done", info, None
+            sys.stdout.write("Finished %s: %s.\n" % (job.name, info))
+            return
+
+        job.status, job.error = "failed", info
+        if job.attempts <= self.retries:
+            sys.stdout.write("%s failed (%s); retrying.\n" % (job.name, info))
+            pending.append(job)
+        else:
+            sys.stdout.write("%s failed: %s.\n" % (job.name, info))
+
+    def run(self, poll_interval=0.1, summary_filename=None):
+        r"""
+        Runs the jobs, and returns a summary: a list of rows (name, status, attempts,
+        seconds, bound, error), in the order of the jobs. ``bound`` is the exact bound if
+        one was found, or else the SDP objective value. If ``summary_filename`` is given,
+        the summary is also written there as JSON.
+        """
+        pending = list(self.jobs)
+        running = []
+
+        while len(pending) > 0 or len(running) > 0:
+
+            for entry in list(running):
+                job, process, connection, start_time, stage, wanted, slots = entry
+                if connection.poll():
+                    try:
+                        kind, info = connection.recv()
+                    except EOFError:  # the job process died
+                        process.join()
+                        kind, info = "failed", self._exit_diagnostic(process.exitcode)
+                    if kind == "stage":
+                        entry[4], entry[5], entry[6] = None, info[0], info[1]
+                        continue
+                    running.remove(entry)
+                    self._finish(entry, kind, info, pending)
+                elif not process.is_alive():
+                    running.remove(entry)
+                    self._finish(entry, "failed", self._exit_diagnostic(process.exitcode), pending)
+                elif not self.wall_time is None and time.time() - start_time > self.wall_time:
+                    running.remove(entry)
+                    self._finish(entry, "failed", "wall-clock limit of %s seconds exceeded" % self.wall_time,
+                                 pending)
+
+            # Hand out the free slots: first to running jobs that are waiting, then to new jobs.
+            # A job racing several solvers gets as many of the free solver slots as it asked for.
+            for stage, limit in [("solve", self.solver_workers), ("generate", self.generation_workers)]:
+                in_use = sum(entry[6] for entry in running if entry[4] == stage)
+                for entry in running:
+                    if in_use >= limit:
+                        break
+                    if entry[5] == stage:
+                        entry[4], entry[5], entry[6] = stage, None, min(entry[6], limit - in_use)
+                        entry[2].send(entry[6])
+                        in_use += entry[6]
+
+            while len(pending) > 0 and sum(1 for entry in running if entry[4] == "generate") < self.generation_workers:
+                running.append(self._start(pending.pop(0)))
+
+            time.sleep(poll_interval)
+
+        summary = [(job.name, job.status, job.attempts, job.seconds, job.bound, job.error) for job in self.jobs]
+
+        sys.stdout.write("%-24s %-8s %8s %9s  %s\n" % ("job", "status", "attempts", "seconds", "bound"))
+        for name, status, attempts, seconds, bound, error in summary:
+            sys.stdout.write("%-24s %-8s %8d %9.1f  %s\n" % (name, status, attempts, seconds,
+                             bound if error is None else error))
+
+        if not summary_filename is None:
+            with open(summary_filename, "w") as f:
+                json.dump([dict(zip(["name", "status", "attempts", "seconds", "bound", "error"], row))
+                           for row in summary], f, indent=4)
+
+        return summary
+
+    def _exit_diagnostic(self, exitcode):
+        if exitcode == -signal.SIGXCPU:
+            return "CPU time limit of %s seconds exceeded" % self.cpu_time
+        if exitcode == -signal.SIGKILL:
+            return "killed (by the CPU time hard limit, or for lack of memory)"
+        if exitcode < 0:
+            return "killed by signal %d" % -exitcode
+        return "exited with code %d" % exitcode
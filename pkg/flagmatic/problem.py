@@ -31,15 +31,17 @@ Further development of Flagmatic is supported by ERC.
 http://cordis.europa.eu/project/rcn/104324_en.html
 """
 
-import gzip, json, os, sys
+import gzip, hashlib, json, os, sys, tempfile, time
+import cPickle
+import multiprocessing
 import numpy
 import itertools
-import pexpect
 import sage.all
 
 from sage.structure.sage_object import SageObject
 from sage.rings.all import Integer, Rational, QQ, ZZ, RDF
 from sage.functions.other import floor
+from sage.arith.all import binomial
 from sage.matrix.all import matrix, identity_matrix, block_matrix, block_diagonal_matrix
 from sage.modules.misc import gram_schmidt
 from sage.misc.misc import SAGE_TMP
@@ -47,7 +49,7 @@ from sage.combinat.all import Permutations, Combinations, Tuples
 from sage.matrix.constructor import ones_matrix, vector
 from copy import copy
 
-from hypergraph_flag import make_graph_block, print_graph_block
+from hypergraph_flag import make_graph_block, print_graph_block, get_combinations
 from flag import *
 from three_graph_flag import *
 from graph_flag import *
@@ -55,15 +57,128 @@ from oriented_graph_flag import *
 from multigraph_flag import *
 from construction import *
 from blowup_construction import *
+from sdp import *
 
-# pexpect in Sage 4.8 has a bug, which prevents it using commands with full paths.
-# So for now, CSDP has to be in a directory in $PATH.
 
-cdsp_cmd = "csdp"
-sdpa_cmd = "sdpa"
-sdpa_dd_cmd = "sdpa_dd"
-sdpa_qd_cmd = "sdpa_qd"
-dsdp_cmd = "dsdp"
+# The problem, setup function and solve_sdp arguments of the sweep in progress. Worker
+# processes are forked, so they inherit this rather than having it pickled.
+_sweep_context = None
+
+
+def _sweep_run(index, value, warm_start):
+    """
+    Solves one point of a sweep (see Problem.sweep), and returns the index, a row of
+    the results table, and the data needed to warm-start neighbouring points.
+    """
+    problem, setup_fn, solve_kwargs = _sweep_context
+    start_time = time.time()
+    try:
+        p = problem._copy_specification()
+        p._reset_after_products(problem._states["compute_products"])
+        setup_fn(p, value)
+        p.solve_sdp(warm_start=warm_start, **solve_kwargs)
+    except Exception as e:
+        return index, (value, None, None, None, time.time() - start_time, str(e)), None
+
+    bound = p._sdp_objective_value
+    row = (value, None if bound is None else float(bound), p._sdp_solver,
+           len(p._sdp_solver_iterations), time.time() - start_time, None)
+    return index, row, (p._sdp_solution, p._sdp_keys())
+
+
+# True in the worker processes of a sweep or of Problem._map_types, so that they run
+# their own per-type steps serially instead of each starting another pool.
+_in_worker_process = False
+
+
+def _set_worker_process():
+    global _in_worker_process
+    _in_worker_process = True
+
+
+# The per-type function being run by Problem._map_types. As with _sweep_context, the
+# worker processes inherit it when they are forked.
+_type_task_function = None
+
+
+def _type_task(ti):
+    return _pack_exact(_type_task_function(ti))
+
+
+class _PackedMatrix(object):
+    # A matrix over QQ, as a common denominator and a list of integer numerators, which is
+    # much quicker to send between processes than the matrix itself.
+
+    def __init__(self, M):
+        self.shape = (M.nrows(), M.ncols())
+        self.sparse = M.is_sparse()
+        self.subdivisions = M.subdivisions()
+        self.immutable = M.is_immutable()
+        d = M.denominator()
+        self.denominator = int(d)
+        self.entries = [(i, j, int(v * d)) for (i, j), v in M.dict().items()]
+
+    def unpack(self):
+        d = Integer(self.denominator)
+        M = matrix(QQ, self.shape[0], self.shape[1],
+                   dict(((i, j), Integer(v) / d) for i, j, v in self.entries), sparse=self.sparse)
+        M.subdivide(*self.subdivisions)
+        if self.immutable:
+            M.set_immutable()
+        return M
+
+
+def _pack_exact(x):
+    if isinstance(x, (list, tuple)):
+        return type(x)(_pack_exact(y) for y in x)
+    if hasattr(x, "nrows") and hasattr(x, "base_ring") and x.base_ring() == QQ:
+        return _PackedMatrix(x)
+    return x
+
+
+def _unpack_exact(x):
+    if isinstance(x, (list, tuple)):
+        return type(x)(_unpack_exact(y) for y in x)
+    if isinstance(x, _PackedMatrix):
+        return x.unpack()
+    return x
+
+
+def _flag_basis_key(flag_cls, field, tg, flags, Z, options):
+    """
+    Returns the name under which compute_flag_bases caches the basis for a type: a hash
+    of the flag class, the field, the type, its flags, its zero eigenvectors and the
+    options used. (Flags of different classes can have the same string form.)
+    """
+    h = hashlib.sha1()
+    h.update("flag basis 2\n%s\n%s\n" % (flag_cls.__name__, field))
+    h.update("%s\n%s\n%s\n" % (tg, " ".join(str(f) for f in flags), " ".join(str(o) for o in options)))
+    h.update("%s %d %d\n" % (Z.base_ring(), Z.nrows(), Z.ncols()))
+    for (i, j), v in sorted(Z.dict().items()):
+        h.update("%d %d %s\n" % (i, j, v))
+    return h.hexdigest()
+
+
+def _load_flag_basis(directory, key):
+    filename = os.path.join(directory, "flag-basis-%s.pickle.gz" % key)
+    if not os.path.exists(filename):
+        return None
+    try:
+        with gzip.open(filename, "rb") as f:
+            return cPickle.load(f)
+    except Exception:  # a partly written or unreadable file is just recomputed
+        return None
+
+
+def _save_flag_basis(directory, key, M):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filename = os.path.join(directory, "flag-basis-%s.pickle.gz" % key)
+    fd, temp_filename = tempfile.mkstemp(dir=directory)
+    os.close(fd)
+    with gzip.open(temp_filename, "wb") as f:
+        cPickle.dump(M, f, 2)
+    os.rename(temp_filename, filename)  # atomic, so concurrent runs never see half a file
 
 
 def block_structure(M):
@@ -84,6 +199,273 @@ def block_structure(M):
     return num_blocks, div_sizes, div_offsets
 
 
+def block_basis_entries(rarray, B, block_offsets):
+    """
+    Given an array of flag products, with rows (graph index, j, k, numerator, denominator)
+    where j <= k, and a rational basis B of the flags whose rows are divided into blocks
+    starting at ``block_offsets``, this function returns the entries of B P B^T that lie
+    in the diagonal blocks, where P is the symmetric matrix of products for each graph.
+    It returns arrays of graph indices, block indices, rows, columns (relative to the
+    block, with rows <= columns), numerators and denominators. Entries in the same
+    position are not summed.
+    """
+    nf = B.ncols()
+    entries = B.dict().items()
+
+    # Scale the rows of B to be integral, so that the entries stay exact.
+    scale = [Integer(1)] * B.nrows()
+    for (a, j), v in entries:
+        scale[a] = scale[a].lcm(v.denominator())
+    scale = numpy.array([int(x) for x in scale], dtype=object)
+
+    basis_rows = numpy.array([a for (a, j), v in entries], dtype=numpy.int64)
+    basis_cols = numpy.array([j for (a, j), v in entries], dtype=numpy.int64)
+    basis_values = numpy.array([int(v * scale[a]) for (a, j), v in entries], dtype=object)
+    order = numpy.argsort(basis_cols, kind="mergesort")
+    basis_rows, basis_values = basis_rows[order], basis_values[order]
+    col_ptr = numpy.searchsorted(basis_cols[order], numpy.arange(nf + 1))
+
+    # Each product with j != k is also entry (k, j) of P.
+    rarray = numpy.asarray(rarray, dtype=numpy.int64)
+    swapped = rarray[rarray[:, 1] != rarray[:, 2]][:, [0, 2, 1, 3, 4]]
+    P = numpy.concatenate([rarray, swapped])
+    js, ks = P[:, 1], P[:, 2]
+
+    # Entry (a, c) of B P B^T gets B[a, j] P[j, k] B[c, k] for every pair of nonzero
+    # entries B[a, j] and B[c, k].
+    nj = col_ptr[js + 1] - col_ptr[js]
+    nk = col_ptr[ks + 1] - col_ptr[ks]
+    counts = nj * nk
+    e = numpy.repeat(numpy.arange(len(P)), counts)
+    t = numpy.arange(len(e)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    p = col_ptr[js[e]] + t // nk[e]
+    q = col_ptr[ks[e]] + t % nk[e]
+    rows, cols = basis_rows[p], basis_rows[q]
+
+    block_offsets = numpy.array(block_offsets, dtype=numpy.int64)
+    row_blocks = numpy.searchsorted(block_offsets, rows, side="right") - 1
+    col_blocks = numpy.searchsorted(block_offsets, cols, side="right") - 1
+    keep = (rows <= cols) & (row_blocks == col_blocks)
+    e, p, q, rows, cols, blocks = e[keep], p[keep], q[keep], rows[keep], cols[keep], row_blocks[keep]
+
+    numerators = P[e, 3].astype(object) * basis_values[p] * basis_values[q]
+    denominators = P[e, 4].astype(object) * scale[rows] * scale[cols]
+    offsets = block_offsets[blocks]
+
+    return P[e, 0], blocks, rows - offsets, cols - offsets, numerators, denominators
+
+
+class IncrementalEchelon(object):
+    """
+    Finds a maximal set of linearly independent vectors, from vectors given one at a time.
+    A reduced basis of the vectors accepted so far is maintained, so that each new vector
+    is only reduced against the pivots, instead of echelonizing everything again.
+
+    Over QQ, this is done modulo two primes. Every accepted vector is reduced into the
+    basis of every prime in use, and a prime is only kept while its basis has as many
+    vectors as have been accepted (so that the accepted vectors are independent modulo
+    it). A new vector that is independent modulo such a prime is then independent over
+    QQ, so accepted vectors are always independent. A vector is rejected if it is
+    dependent modulo all the primes in use, so an independent vector is wrongly rejected
+    with negligible probability. Over other fields, once no prime can be used (because of
+    a denominator divisible by it, or an accepted vector that vanishes modulo it), or for
+    a non-zero vector that vanishes modulo all the primes, exact arithmetic is used.
+    """
+
+    primes = [1048573, 1048571]  # small enough that sums of products fit in 64 bits
+
+    def __init__(self, field, length):
+        self.field = field
+        self.length = length
+        self.rank = 0
+        self._vectors = []
+        self._exact = field != QQ
+        self._exact_rows = []
+        self._modular = [] if self._exact else [[p, numpy.zeros((0, length), dtype=numpy.int64), []]
+                                                for p in self.primes]
+
+    def add(self, values):
+        """
+        Adds the vector ``values`` (a list of field elements) if it is independent of the
+        vectors added before. Returns True if it was added.
+        """
+        values = list(values)
+
+        if not self._exact:
+            numerators = numpy.array([int(QQ(x).numerator()) for x in values], dtype=object)
+            denominators = numpy.array([int(QQ(x).denominator()) for x in values], dtype=object)
+            residues = []
+            vanishes = True
+            for m in self._modular:
+                p = m[0]
+                d = (denominators % p).astype(numpy.int64)
+                if not (d == 0).any():  # otherwise this prime can no longer be used
+                    v = (numerators % p).astype(numpy.int64) * _inverse_mod(d, p) % p
+                    vanishes = vanishes and not v.any()
+                    residues.append((m, self._reduce_modular(m, v)))
+            # A non-zero vector that is zero modulo every prime says nothing about them.
+            if len(residues) == 0 or (vanishes and numerators.any()):
+                self._use_exact()
+
+        if self._exact:
+            independent = self._add_exact(values)
+        else:
+            independent = any(len(numpy.flatnonzero(v)) > 0 for m, v in residues)
+            if independent:
+                # Keep only the primes modulo which the accepted vectors are still independent.
+                self._modular = []
+                for m, v in residues:
+                    if len(numpy.flatnonzero(v)) > 0:
+                        self._insert_modular(m, v)
+                        self._modular.append(m)
+            else:
+                self._modular = [m for m, v in residues]
+
+        if independent:
+            self._vectors.append(values)
+            self.rank += 1
+        return independent
+
+    def _use_exact(self):
+        self._exact = True
+        self._modular = []
+        for v in self._vectors:
+            self._add_exact(v)
+
+    def _reduce_modular(self, m, v):
+        p, R, pivots = m
+        if len(pivots) > 0:
+            v = (v - v[pivots].dot(R)) % p
+        return v
+
+    def _insert_modular(self, m, v):
+        p, R, pivots = m
+        c = numpy.flatnonzero(v)[0]
+        v = v * _inverse_mod(v[c:c + 1], p)[0] % p
+        m[1] = numpy.vstack([(R - numpy.outer(R[:, c], v)) % p, v])
+        pivots.append(c)
+
+    def _add_exact(self, values):
+        v = vector(self.field, values)
+        for c, row in self._exact_rows:
+            if v[c] != 0:
+                v -= v[c] * row
+        if v.is_zero():
+            return False
+        c = v.nonzero_positions()[0]
+        self._exact_rows.append((c, v / v[c]))
+        return True
+
+
+def _inverse_mod(a, p):
+    # Inverses of the entries of the int64 array a modulo the prime p, by Fermat.
+    result = numpy.ones_like(a)
+    base = a % p
+    e = p - 2
+    while e > 0:
+        if e & 1:
+            result = result * base % p
+        base = base * base % p
+        e >>= 1
+    return result
+
+
+def exact_solve_right(A, b):
+    """
+    Returns a column matrix x with A * x == b, where A has entries in QQ or in a quadratic
+    field, and raises ValueError if there is no solution. This is much faster than
+    A.solve_right(b) when the entries get large. See ExactSolver.
+    """
+    return ExactSolver(A).solve_right(b)
+
+
+class ExactSolver(object):
+    """
+    Solves A * x == b exactly for a fixed matrix A, and any number of right hand sides b,
+    where A has entries in QQ or in a quadratic field. The work that depends only on A is
+    done once, when the solver is created.
+
+    Over QQ, the rows are scaled to be integral, and a set of independent rows is chosen
+    (modulo primes, using IncrementalEchelon); each square integer system is then solved
+    by Sage, which uses p-adic lifting (IML) rather than fraction arithmetic. Over a
+    quadratic field QQ(w), the system is written as a rational system of twice the size
+    for the coordinates of x in the basis 1, w. In all cases the solution is certified by
+    checking A * x == b exactly.
+    """
+
+    def __init__(self, A):
+
+        self._A = A
+        self._field = F = A.base_ring()
+        self._rational = None
+
+        if F == QQ:
+            self._set_rational_system(A)
+
+        elif hasattr(F, "polynomial") and F.polynomial().degree() == 2:
+            # w^2 = -c1 w - c0, so (D0 + w D1)(x0 + w x1) = (D0 x0 - c0 D1 x1) + w (D1 x0 + (D0 - c1 D1) x1).
+            c0, c1, c2 = F.polynomial().list()
+            c0, c1 = c0 / c2, c1 / c2
+            D0, D1 = self._coords(A, 0), self._coords(A, 1)
+            self._set_rational_system(block_matrix([[D0, -c0 * D1], [D1, D0 - c1 * D1]], subdivide=False))
+
+    def _coords(self, M, i):
+        return M.apply_map(lambda z: self._field(z).list()[i], QQ)
+
+    def _set_rational_system(self, A):
+
+        num_rows, num_cols = A.nrows(), A.ncols()
+        if num_cols == 0:
+            self._rational = (A, [], [], None)
+            return
+        scales = [row.denominator() for row in A.rows()]
+        M = matrix(ZZ, [row * s for row, s in zip(A.rows(), scales)])
+
+        echelon = IncrementalEchelon(QQ, num_cols)
+        chosen = []
+        for i in range(num_rows):
+            if echelon.rank == num_cols:
+                break
+            if echelon.add(M.row(i)):
+                chosen.append(i)
+
+        # If A does not have full column rank, fall back on A.solve_right.
+        square = M.matrix_from_rows(chosen) if echelon.rank == num_cols else None
+        self._rational = (A, chosen, [scales[i] for i in chosen], square)
+
+    def _rational_solve_right(self, b):
+        # The solution is not certified.
+        A, chosen, scales, square = self._rational
+        if A.ncols() == 0:
+            return matrix(QQ, 0, b.ncols())
+        if square is None:
+            return A.solve_right(b)
+        rhs = matrix(QQ, [b.row(i) * s for i, s in zip(chosen, scales)])
+        return square.solve_right(rhs)
+
+    def solve_right(self, b):
+        """
+        Returns x with A * x == b, for a matrix b with the same number of rows as A, and
+        raises ValueError if there is no solution.
+        """
+        A, F = self._A, self._field
+
+        if F == QQ:
+            x = self._rational_solve_right(matrix(QQ, b))
+
+        elif self._rational is not None:
+            y = self._rational_solve_right(self._coords(b, 0).stack(self._coords(b, 1)))
+            r = A.ncols()
+            x = matrix(F, y[:r, :]) + F.gen() * matrix(F, y[r:, :])
+
+        else:
+            x = A.solve_right(b)
+
+        if A * x != b:
+            raise ValueError("matrix equation has no solutions")
+        return x
+
+
 def safe_gram_schmidt(M):
     """
     Performs Gram Schmidt orthogonalization using Sage functions. The returned matrix
@@ -115,6 +497,21 @@ def safe_gram_schmidt(M):
     return M
 
 
+def ldl_product_equals(R, M, Q):
+    """
+    Returns True if R * M * R.T == Q. Over QQ, the matrices are scaled to integer
+    matrices first, so that the products are done by FLINT without any fractions.
+    """
+    if R.base_ring() != QQ or M.base_ring() != QQ or Q.base_ring() != QQ:
+        return R * M * R.T == Q
+    r, m = R.denominator(), M.denominator()
+    scaled_Q = Q * (r * r * m)
+    if scaled_Q.denominator() != 1:
+        return False
+    Rz = matrix(ZZ, R * r, sparse=False)
+    return Rz * matrix(ZZ, M * m, sparse=False) * Rz.T == matrix(ZZ, scaled_Q, sparse=False)
+
+
 def LDLdecomposition(M):  # TODO: does this handle matrices with zero eigenvalues?
     MS = M.parent()
     D = MS.matrix()
@@ -131,6 +528,80 @@ def LDLdecomposition(M):  # TODO: does this handle matrices with zero eigenvalue
     return L, D
 
 
+def exact_ldl(M):
+    """
+    Returns a tuple (L, D), where L is lower unitriangular and D is diagonal with
+    non-negative entries, such that M = L * D * L.T, for a symmetric matrix M over QQ.
+    Returns None if M is not positive semidefinite, so this is an exact proof either way.
+
+    The elimination is fraction-free (Bareiss): M is scaled to an integer matrix, and
+    every intermediate entry is an integer (a minor of that matrix), held in a numpy
+    object array so that each step is a single array operation. Fractions are only made
+    when the entries of L and D are read off. A zero pivot is allowed if the rest of its
+    row is zero, in which case the step is skipped.
+    """
+    n = M.nrows()
+    m = M.denominator()
+
+    A = numpy.zeros((n, n), dtype=object)
+    for (i, j), v in (M * m).dict().items():
+        A[i, j] = int(v)
+
+    L_entries = dict(((i, i), 1) for i in range(n))
+    D_entries = {}
+    prev = 1
+
+    for k in range(n):
+        p = A[k, k]
+        if p == 0:
+            if any(x != 0 for x in A[k, k + 1:]):
+                return None
+            continue
+        if p < 0:
+            return None
+        col = A[k + 1:, k]
+        for i in numpy.flatnonzero(col != 0):
+            L_entries[(k + 1 + i, k)] = Integer(col[i]) / p
+        D_entries[(k, k)] = Integer(p) / (prev * m)
+        if k + 1 < n:
+            A[k + 1:, k + 1:] = (p * A[k + 1:, k + 1:] - numpy.outer(col, A[k, k + 1:])) // prev
+        prev = p
+
+    L = matrix(QQ, n, n, L_entries, sparse=M.is_sparse())
+    D = matrix(QQ, n, n, D_entries, sparse=M.is_sparse())
+    L.set_immutable()
+    D.set_immutable()
+    return L, D
+
+
+def certify_psd(M):
+    """
+    Checks that the symmetric matrix M is positive semidefinite. Returns None if it is
+    not, and otherwise a tuple (L, D) with M = L * D * L.T as in LDLdecomposition.
+
+    A float Cholesky decomposition is tried first, as a quick filter: if it fails and M
+    has a clearly negative eigenvalue, None is returned without any exact arithmetic.
+    Otherwise, over QQ, the proof is the exact LDL decomposition given by exact_ldl. Over
+    other fields, only the floating point check is made, and (None, None) is returned.
+    """
+    if M.nrows() == 0:
+        return M, M
+
+    MF = numpy.array(M.numpy(dtype=numpy.float64), dtype=numpy.float64).reshape(M.nrows(), M.ncols())
+    try:
+        numpy.linalg.cholesky(MF)
+    except numpy.linalg.linalg.LinAlgError:
+        if min(numpy.linalg.eigvalsh(MF)) < -1e-9 * max(1.0, abs(MF).max()):
+            return None
+
+    if M.base_ring() == QQ:
+        return exact_ldl(M)
+
+    if min(numpy.linalg.eigvalsh(MF)) < 0.0:
+        return None
+    return None, None
+
+
 class Problem(SageObject):
     r"""
     This is the principal class of flagmatic. Objects of this class represent Turán-type
@@ -253,6 +724,9 @@ class Problem(SageObject):
         Setting ``force`` to True allows states to be set irrespective of other
         states.
 
+        When a state is set to "yes" or "stale", the attributes listed in its "clears"
+        entry (caches of things derived from it) are deleted.
+
         """
 
         # We use tuples here because there is an order to the states.
@@ -287,7 +761,8 @@ class Problem(SageObject):
             }),
             ("compute_products", {
                 "requires": ["compute_flags"],
-                "depends": []
+                "depends": [],
+                "clears": ["_product_coefficients_cache"]
             }),
             ("set_active_types", {
                 "requires": ["compute_flags"],
@@ -299,11 +774,11 @@ class Problem(SageObject):
             }),
             ("write_sdp_input_file", {
                 "requires": ["set_block_matrix_structure"],
-                "depends": ["set_objective", "set_active_types"]
+                "depends": ["set_objective", "set_active_types", "set_block_matrix_structure"]
             }),
             ("write_sdp_initial_point_file", {
                 "requires": ["set_block_matrix_structure"],
-                "depends": ["set_objective", "set_active_types"]
+                "depends": ["set_objective", "set_active_types", "set_block_matrix_structure"]
             }),
             ("run_sdp_solver", {
                 "requires": ["write_sdp_input_file"],
@@ -335,7 +810,7 @@ class Problem(SageObject):
             }),
             ("check_exact", {
                 "requires": ["make_exact"],
-                "depends": ["meet_target_bound"]
+                "depends": ["make_exact", "meet_target_bound"]
             }),
             ("diagonalize", {
                 "requires": ["meet_target_bound", "check_exact"],
@@ -366,12 +841,14 @@ class Problem(SageObject):
             if action == "yes" and not all(self._states[sn] == "yes" for sn in states[state_name]["requires"]):
                 raise NotImplementedError("not ready for this yet!")
             self._states[state_name] = "yes"
+            self._clear_state_caches(states[state_name])
             for sn in states:
                 if state_name in states[sn]["depends"] and self._states[sn] == "yes":
                     self.state(sn, "stale")
 
         elif action == "stale":
             self._states[state_name] = "stale"
+            self._clear_state_caches(states[state_name])
             for sn in states:
                 if state_name in states[sn]["depends"]:
                     self.state(sn, "stale")
@@ -392,6 +869,11 @@ class Problem(SageObject):
 
         return self._states[state_name]
 
+    def _clear_state_caches(self, state_info):
+        for attr in state_info.get("clears", []):
+            if hasattr(self, attr):
+                delattr(self, attr)
+
 
     @property
     def flag_cls(self):
@@ -457,6 +939,8 @@ class Problem(SageObject):
         for g in self._graphs:    # Make all the graphs immutable
             g.set_immutable()
 
+        self._subgraph_counts_cache = {}
+
         self._compute_densities()
 
         sys.stdout.write("Generating types and flags...\n")
@@ -584,22 +1068,92 @@ class Problem(SageObject):
 
 
         
-    def _compute_densities(self):
+    def _subgraph_counts(self, k):
+        r"""
+        Returns a pair (columns, M). M is a sparse integer matrix, with a row for each
+        admissible graph and a column for each isomorphism class of graphs of order k
+        that occurs in some admissible graph; M[gi, ci] is the number of k-sets of
+        vertices of admissible graph gi that induce the graph with column ci. columns is
+        a dictionary mapping the string of a (minimal) graph to its column.
+
+        All the induced subgraphs of order k are found in a single pass, and the result
+        is cached until the admissible graphs change.
+        """
+        if not hasattr(self, "_subgraph_counts_cache"):
+            self._subgraph_counts_cache = {}
+
+        if k in self._subgraph_counts_cache:
+            return self._subgraph_counts_cache[k]
+
+        columns = {}
+        entries = {}
+
+        for gi in range(len(self._graphs)):
+            g = self._graphs[gi]
+            for hv in get_combinations(g.n, k):
+                ig = g.induced_subgraph(hv)
+                ig.make_minimal_isomorph()
+                ci = columns.setdefault(ig._repr_(), len(columns))
+                entries[(gi, ci)] = entries.get((gi, ci), 0) + 1
+
+        M = matrix(ZZ, len(self._graphs), len(columns), entries, sparse=True)
+        M.set_immutable()
+
+        self._subgraph_counts_cache[k] = (columns, M)
+        return columns, M
+
+    def _compute_densities(self, new_only=False):
+        r"""
+        Computes the density of each density graph in each admissible graph. If
+        ``new_only`` is True, only the density graphs that have been added since the last
+        call are computed.
+
+        Each density is a product of the (cached) sparse matrix of induced subgraph counts
+        with the vector of coefficients of the density graph. Density graphs with r
+        vertices (edges and non-edges) are instead given by ``subgraph_density``, which
+        uses the edge density.
+        """
+        if not new_only or not hasattr(self, "_densities"):
+            self._densities = []
+
+        if len(self._density_graphs) == len(self._densities):
+            return
+
+        num_graphs = len(self._graphs)
+        graph_indices = dict((self._graphs[gi]._repr_(), gi) for gi in range(num_graphs))
+
+        for dg in self._density_graphs[len(self._densities):]:
+
+            density_values = [Integer(0)] * num_graphs
+            terms_by_order = {}
+
+            for h, coeff in dg:
+                minh = copy(h)
+                minh.t = 0
+                minh.make_minimal_isomorph()
+                if minh.n == self._n:
+                    if minh._repr_() in graph_indices:
+                        density_values[graph_indices[minh._repr_()]] += coeff
+                elif minh.n == minh.r:
+                    # edge/non-edge density: subgraph_density uses edge_density, which is
+                    # not an induced count when edges have multiplicities
+                    for gi in range(num_graphs):
+                        density_values[gi] += coeff * self._graphs[gi].subgraph_density(minh)
+                elif minh.n < self._n:
+                    terms_by_order.setdefault(minh.n, []).append((minh._repr_(), coeff))
+                else:
+                    raise ValueError("density graph %s has more vertices than admissible graphs." % h)
+
+            for k, terms in terms_by_order.iteritems():
+                columns, M = self._subgraph_counts(k)
+                coeffs = [Integer(0)] * len(columns)
+                for hs, coeff in terms:
+                    if hs in columns:  # otherwise h is not a subgraph of any admissible graph
+                        coeffs[columns[hs]] += coeff
+                if len(columns) > 0:
+                    for gi, value in (M * vector(coeffs)).dict().iteritems():
+                        density_values[gi] += value / binomial(self._n, k)
 
-        self._densities = []
-        for dg in self._density_graphs:
-            density_values = []
-            for g in self._graphs:
-                dv = 0
-                for h, coeff in dg:
-                    if h.n == g.n:
-                        # comparison will be fast, as both g and h should have
-                        # _certified_minimal_isomorph set to True
-                        if g == h:
-                            dv += coeff
-                    else:
-                        dv += coeff * g.subgraph_density(h)
-                density_values.append(dv)
             self._densities.append(density_values)
 
     def set_density(self, *args):
@@ -1004,7 +1558,7 @@ class Problem(SageObject):
             else:
                 self._density_coeff_blocks[0].extend(new_density_indices)
                 
-        self._compute_densities()
+        self._compute_densities(new_only=True)
 
 
     def set_inactive_types(self, *args):
@@ -1240,7 +1794,7 @@ class Problem(SageObject):
             else:
                 sys.stdout.write("Warning: graph %d is already marked as sharp.\n" % si)
 
-    def change_solution_bases(self, use_blocks=True):
+    def change_solution_bases(self, use_blocks=True, workers=1, cache_directory=None):
         r"""
         Transforms the solution's Q matrices, so that they are (hopefully) positive definite. A
         construction should have been set previously, and this will be used to determine forced
@@ -1254,10 +1808,13 @@ class Problem(SageObject):
          - ``use_blocks`` - Boolean (default: True). Specifies whether to apply an additional
            change of basis so that the matrices have a block structure with two blocks. This uses
            the invariant anti-invariant idea of Razborov.
+
+         - ``workers``, ``cache_directory`` - passed to ``compute_flag_bases``, if the bases
+           have not been computed yet.
         """
 
         if self.state("compute_flag_bases") != "yes":
-            self.compute_flag_bases(use_blocks)
+            self.compute_flag_bases(use_blocks, workers=workers, cache_directory=cache_directory)
 
         self.state("transform_solution", "yes")
 
@@ -1267,10 +1824,30 @@ class Problem(SageObject):
 
         self._sdp_Qdash_matrices = []
 
+        if self._approximate_field == RDF and getattr(self, "_float_flag_bases", None) is None:
+            self._float_flag_bases = [B.numpy(dtype=numpy.float64).reshape(B.nrows(), B.ncols())
+                                      for B in self._flag_bases]
+
         for ti in range(num_types):
 
             B = self._flag_bases[ti]
-            if B.nrows() > 0:
+            if B.nrows() > 0 and self._approximate_field == RDF:
+                # B * Q * B.T with BLAS, keeping only the diagonal blocks.
+                num_blocks, block_sizes, block_offsets = block_structure(B)
+                BF = self._float_flag_bases[ti]
+                Q = numpy.asarray(self._sdp_Q_matrices[ti].numpy(), dtype=numpy.float64)
+                Q = Q.reshape(BF.shape[1], BF.shape[1])
+                M = numpy.zeros((B.nrows(), B.nrows()))
+                for bi in range(num_blocks):
+                    b = slice(block_offsets[bi], block_offsets[bi] + block_sizes[bi])
+                    BFb = BF[b, :]
+                    M[b, b] = BFb.dot(Q).dot(BFb.T)
+                M = matrix(RDF, M)
+                row_div = B.subdivisions()[0]
+                M.subdivide(row_div, row_div)
+                M.set_immutable()
+                self._sdp_Qdash_matrices.append(M)
+            elif B.nrows() > 0:
                 row_div = B.subdivisions()[0]
                 M = B * self._sdp_Q_matrices[ti] * B.T
                 M.subdivide(row_div, row_div)
@@ -1303,25 +1880,27 @@ class Problem(SageObject):
             sys.stdout.write("Type %d (%d flags) blocks: %s \n" % (ti, len(self._flags[ti]), block_sizes))
             self._block_bases.append(B)
 
-    def compute_flag_bases(self, use_blocks=True, keep_rows=False, use_smaller=False):
+    def compute_flag_bases(self, use_blocks=True, keep_rows=False, use_smaller=False, workers=1,
+                           cache_directory=None):
         r"""
         Computes a basis for the solution's Q matrices, using the construction to determine forced
         zero eigenvectors. This method is used by ``change_problem_bases`` and
         ``change_solution_bases``, and would not usually be invoked directly.
+
+        The bases of the types are computed in ``workers`` processes. If ``cache_directory``
+        is given, the basis of each type is saved there, under a hash of the type, its
+        flags and its zero eigenvectors, and is loaded from there instead of being
+        recomputed when it is needed again (for instance, when a script is rerun).
         """
         self.state("compute_flag_bases", "yes")
 
         num_types = len(self._types)
+        self._float_flag_bases = None  # the float copies used by change_solution_bases
 
         if use_blocks and self.state("compute_block_bases") != "yes":
             self.compute_block_bases()
 
-        self._flag_bases = []
-
-        sys.stdout.write("Creating bases")
-        sys.stdout.flush()
-
-        for ti in range(num_types):
+        def compute_basis(ti):
 
             if use_blocks:
                 num_blocks, block_sizes, block_offsets = block_structure(self._block_bases[ti])
@@ -1339,7 +1918,7 @@ class Problem(SageObject):
                 else:
                     B = Z
 
-                B = B.echelon_form()
+                B = matrix(B.base_ring(), B, sparse=True).echelon_form()
 
                 nzev = B.rank()
                 B = B[:nzev, :]
@@ -1351,7 +1930,7 @@ class Problem(SageObject):
                     pass
 
                 else:
-                    B = B.stack(B.right_kernel().basis_matrix())
+                    B = B.stack(matrix(B.base_ring(), B.right_kernel_matrix(), sparse=True))
 
                 if use_blocks:
                     B = B * self._block_bases[ti].subdivision(bi, 0)
@@ -1369,14 +1948,43 @@ class Problem(SageObject):
             else:
                 M = safe_gram_schmidt(M)
 
-            M.set_immutable()
-            self._flag_bases.append(M)
+            # Subdivisions are lost when matrices are pickled, so they are returned separately.
+            return M, M.subdivisions()
+
+        self._flag_bases = [None] * num_types
+        keys = [None] * num_types
+
+        if not cache_directory is None:
+            for ti in range(num_types):
+                keys[ti] = _flag_basis_key(self._flag_cls, self._field, self._types[ti], self._flags[ti],
+                                           self._zero_eigenvectors[ti], (use_blocks, keep_rows, use_smaller))
+                self._flag_bases[ti] = _load_flag_basis(cache_directory, keys[ti])
+
+        to_compute = [ti for ti in range(num_types) if self._flag_bases[ti] is None]
+        if len(to_compute) < num_types:
+            sys.stdout.write("Loaded %d bases from cache.\n" % (num_types - len(to_compute)))
+
+        sys.stdout.write("Creating bases")
+        sys.stdout.flush()
+
+        for ti, result in zip(to_compute, self._map_types(compute_basis, to_compute, workers)):
+
+            self._flag_bases[ti] = result
+            if not cache_directory is None:
+                _save_flag_basis(cache_directory, keys[ti], result)
 
             sys.stdout.write(".")
             sys.stdout.flush()
 
         sys.stdout.write("\n")
 
+        for ti in range(num_types):
+            M, subdivisions = self._flag_bases[ti]
+            M = copy(M)
+            M.subdivide(*subdivisions)
+            M.set_immutable()
+            self._flag_bases[ti] = M
+
         self._inverse_flag_bases = []
 
         for ti in range(num_types):
@@ -1388,18 +1996,68 @@ class Problem(SageObject):
                 MT.set_immutable()
                 self._inverse_flag_bases.append(MT)
                 for j in range(M.nrows()):
-                    M[j, :] /= sum([x ** 2 for x in M.row(j)])
+                    row = M.row(j)
+                    M.rescale_row(j, 1 / row.dot_product(row))
                 M.set_immutable()
                 self._flag_bases[ti] = M
 
             else:
                 for j in range(M.nrows()):
-                    M[j, :] /= sum([x ** 2 for x in M.row(j)])
+                    row = M.row(j)
+                    M.rescale_row(j, 1 / row.dot_product(row))
                 MT = M.T
                 MT.set_immutable()
                 self._inverse_flag_bases.append(MT)
 
 
+    def _product_coefficients(self, ti, view):
+        r"""
+        Returns the coefficients of the flag products of type ``ti`` (the values
+        numerator / denominator of the rows of ``_product_densities_arrays[ti]``) in the
+        form given by ``view``:
+
+         - "numerators", "denominators" - int64 arrays, with each fraction in lowest terms.
+
+         - "floats" - a float64 array.
+
+         - "rationals" - an object array of Sage rationals.
+
+        Each view is built the first time it is asked for, and kept until the products are
+        recomputed (the "compute_products" state clears the cache).
+        """
+        if not hasattr(self, "_product_coefficients_cache"):
+            self._product_coefficients_cache = {}
+        cache = self._product_coefficients_cache
+
+        if not (ti, view) in cache:
+
+            rarray = self._product_densities_arrays[ti]
+
+            if view in ["numerators", "denominators"]:
+                if len(rarray) == 0:
+                    numers, denoms = numpy.zeros(0, dtype=numpy.int64), numpy.ones(0, dtype=numpy.int64)
+                else:
+                    numers, denoms = rarray[:, 3].astype(numpy.int64), rarray[:, 4].astype(numpy.int64)
+                    g = numpy.gcd(numers, denoms)
+                    g[g == 0] = 1
+                    numers, denoms = numers // g, denoms // g
+                cache[(ti, "numerators")], cache[(ti, "denominators")] = numers, denoms
+
+            elif view == "floats":
+                cache[(ti, view)] = (self._product_coefficients(ti, "numerators").astype(numpy.float64)
+                                     / self._product_coefficients(ti, "denominators"))
+
+            elif view == "rationals":
+                cache[(ti, view)] = numpy.array([Integer(n) / Integer(d) for n, d in
+                                                 zip(self._product_coefficients(ti, "numerators"),
+                                                     self._product_coefficients(ti, "denominators"))],
+                                                dtype=object)
+
+            else:
+                raise ValueError("unknown view.")
+
+        return cache[(ti, view)]
+
     def compute_products(self):
         r"""
         Computes the products of the flags. This method is by default called from
@@ -1428,7 +2086,193 @@ class Problem(SageObject):
 
         sys.stdout.write("\n")
 
-    def _set_block_matrix_structure(self):
+    def derive(self, forbid=None, forbid_induced=None):
+        r"""
+        Returns a new Problem, which is the same as this one except that some additional
+        graphs are forbidden. As forbidding graphs can only remove admissible graphs, types
+        and flags, the new Problem is obtained by filtering the existing graphs, flags and
+        flag products, rather than by generating everything again.
+
+        The new Problem has the same densities, objective and mode as this one. Anything
+        computed after the flag products (construction, solution, exact bound) is not
+        carried over.
+
+        INPUT:
+
+         - ``forbid`` - (default: None) a Flag, string, or list of these things. These are
+           forbidden as subgraphs, as with ``forbid``.
+
+         - ``forbid_induced`` - (default: None) a Flag, string, or list of these things.
+           These are forbidden as induced subgraphs, as with ``forbid_induced``.
+
+        EXAMPLES:
+
+        sage: problem = GraphProblem(5, density="3:121323")
+        sage: subproblem = problem.derive(forbid_induced="3:12")
+        """
+        self.state("compute_flags", "ensure_yes")
+
+        new_problem = self._copy_specification()
+
+        if not forbid is None:
+            new_problem.forbid(forbid)
+        if not forbid_induced is None:
+            new_problem.forbid_induced(forbid_induced)
+
+        # _forbid sorts the lists, so find the new entries by identity.
+        def added(old, new):
+            old_ids = set(id(x) for x in old)
+            return [x for x in new if not id(x) in old_ids]
+
+        forbidden_edge_numbers = added(self._forbidden_edge_numbers, new_problem._forbidden_edge_numbers)
+        forbidden_graphs = added(self._forbidden_graphs, new_problem._forbidden_graphs)
+        forbidden_induced_graphs = added(self._forbidden_induced_graphs, new_problem._forbidden_induced_graphs)
+
+        def is_admissible(g):
+            if len(forbidden_edge_numbers) > 0 and g.has_forbidden_edge_numbers(forbidden_edge_numbers):
+                return False
+            if len(forbidden_graphs) > 0 and g.has_forbidden_graphs(forbidden_graphs):
+                return False
+            if len(forbidden_induced_graphs) > 0 and g.has_forbidden_graphs(forbidden_induced_graphs, induced=True):
+                return False
+            return True
+
+        def index_map(indices, size):
+            imap = -numpy.ones(size, dtype=numpy.int64)
+            imap[indices] = numpy.arange(len(indices))
+            return imap
+
+        num_graphs = len(self._graphs)
+        graph_indices = [gi for gi in range(num_graphs) if is_admissible(self._graphs[gi])]
+        graph_map = index_map(graph_indices, num_graphs)
+
+        new_problem._graphs = [self._graphs[gi] for gi in graph_indices]
+        new_problem._densities = [[dv[gi] for gi in graph_indices] for dv in self._densities]
+        new_problem._subgraph_counts_cache = {}
+        for k, (columns, M) in getattr(self, "_subgraph_counts_cache", {}).iteritems():
+            new_M = M.matrix_from_rows(graph_indices)
+            new_M.set_immutable()
+            new_problem._subgraph_counts_cache[k] = (columns, new_M)
+        sys.stdout.write("Kept %d of %d graphs.\n" % (len(graph_indices), num_graphs))
+
+        type_indices = [ti for ti in range(len(self._types)) if is_admissible(self._types[ti])]
+        if len(type_indices) < len(self._types):
+            sys.stdout.write("Removed types %s as they are no longer admissible.\n" %
+                             [ti for ti in range(len(self._types)) if not ti in type_indices])
+
+        new_problem._types = [self._types[ti] for ti in type_indices]
+        new_problem._flags = []
+        new_problem._active_types = [type_indices.index(ti) for ti in self._active_types if ti in type_indices]
+
+        if self.state("compute_products") == "yes":
+            new_problem._product_densities_arrays = []
+
+        for ti in type_indices:
+
+            num_flags = len(self._flags[ti])
+            flag_indices = [fi for fi in range(num_flags) if is_admissible(self._flags[ti][fi])]
+            new_problem._flags.append([self._flags[ti][fi] for fi in flag_indices])
+
+            if self.state("compute_products") != "yes":
+                continue
+
+            flag_map = index_map(flag_indices, num_flags)
+            rarray = self._product_densities_arrays[ti]
+            keep = ((graph_map[rarray[:, 0]] >= 0) & (flag_map[rarray[:, 1]] >= 0)
+                    & (flag_map[rarray[:, 2]] >= 0))
+            new_rarray = rarray[keep, :]
+            new_rarray[:, 0] = graph_map[new_rarray[:, 0]]
+            new_rarray[:, 1] = flag_map[new_rarray[:, 1]]
+            new_rarray[:, 2] = flag_map[new_rarray[:, 2]]
+            new_problem._product_densities_arrays.append(new_rarray)
+
+        sys.stdout.write("Kept %s flags.\n" % [len(L) for L in new_problem._flags])
+
+        new_problem._reset_after_products(self._states["compute_products"])
+
+        return new_problem
+
+    def _copy_specification(self):
+        # Returns a shallow copy of the problem, which shares the graphs, flags and flag
+        # products, but has its own forbidden graphs, densities and assumptions.
+
+        new_problem = copy(self)
+        new_problem._states = copy(self._states)
+        new_problem._product_coefficients_cache = {}
+        new_problem._forbidden_edge_numbers = copy(self._forbidden_edge_numbers)
+        new_problem._forbidden_graphs = copy(self._forbidden_graphs)
+        new_problem._forbidden_induced_graphs = copy(self._forbidden_induced_graphs)
+
+        # Don't let densities or assumptions added to one problem leak into the other.
+        new_problem._density_graphs = copy(self._density_graphs)
+        new_problem._densities = copy(self._densities)
+        new_problem._active_densities = copy(self._active_densities)
+        new_problem._density_coeff_blocks = [copy(db) for db in self._density_coeff_blocks]
+        for attr in ["_assumptions", "_assumption_flags", "_axioms", "_axiom_flags"]:
+            if hasattr(self, attr):
+                setattr(new_problem, attr, copy(getattr(self, attr)))
+
+        return new_problem
+
+    def _reset_after_products(self, compute_products_state):
+        # Everything after the flag products has to be redone.
+
+        for state_name in self._states:
+            if state_name in ["specify", "set_objective", "compute_flags"]:
+                self._states[state_name] = "yes"
+            elif state_name == "compute_products":
+                self._states[state_name] = compute_products_state
+            else:
+                self._states[state_name] = "no"
+
+        for attr in ["_block_bases", "_flag_bases", "_float_flag_bases", "_inverse_flag_bases",
+                     "_zero_eigenvectors", "_sharp_graphs", "_sharp_graph_densities",
+                     "_block_matrix_structure",
+                     "_sdp_Q_matrices", "_sdp_Qdash_matrices", "_sdp_density_coeffs", "_sdp_bounds",
+                     "_exact_Q_matrices", "_exact_Qdash_matrices", "_exact_density_coeffs",
+                     "_exact_diagonal_matrices", "_exact_r_matrices", "_exact_ldl_factors",
+                     "_bounds", "_bound", "_sdp_solution", "_sdp_block_sizes", "_sdp_num_constraints", "_sdp_bases"]:
+            if hasattr(self, attr):
+                delattr(self, attr)
+
+        self._stable = False
+        self._robustly_stable = False
+        self._perfectly_stable = False
+
+    def _sdp_working_directory(self):
+        r"""
+        Returns the directory in which the SDP files for this problem are written and the
+        solver is run. Each problem gets its own directory in the Sage temporary directory,
+        so several problems can be solved at once by threads or processes. A copy of a
+        problem, or a problem in a forked process, gets a new directory.
+        """
+        owner = (os.getpid(), id(self))
+        if getattr(self, "_sdp_directory_owner", None) != owner or not os.path.isdir(self._sdp_directory):
+            self._sdp_directory = tempfile.mkdtemp(prefix="sdp-", dir=unicode(SAGE_TMP))
+            self._sdp_directory_owner = owner
+        return self._sdp_directory
+
+    def _set_block_matrix_structure(self, use_block_bases=False, use_flag_bases=False):
+        # Each type's Q matrix can be written as B^T Q' B for a basis B, so that the SDP is
+        # solved for Q', which is block diagonal. If use_block_bases is True, B is the basis
+        # given by compute_block_bases, with an invariant and an anti-invariant block. If
+        # use_flag_bases is True, B is the basis given by compute_flag_bases, which omits the
+        # zero eigenvectors forced by the construction (facial reduction). The offsets are
+        # then rows of B, rather than flag indices. The bases used are kept in _sdp_bases.
+
+        if use_flag_bases:
+            if self.state("compute_flag_bases") != "yes":
+                self.compute_flag_bases()
+            self._sdp_bases = self._flag_bases
+        elif use_block_bases:
+            if self.state("compute_block_bases") != "yes":
+                self.compute_block_bases()
+            self._sdp_bases = self._block_bases
+        else:
+            self._sdp_bases = None
+
+        if not self._sdp_bases is None and any(B.base_ring() != QQ for B in self._sdp_bases):
+            raise NotImplementedError("the bases must be rational.")
 
         self.state("set_block_matrix_structure", "yes")
 
@@ -1436,7 +2280,10 @@ class Problem(SageObject):
 
         for ti in self._active_types:
 
-            num_blocks, block_sizes, block_offsets = 1, [len(self._flags[ti])], [0]
+            if self._sdp_bases is None:
+                num_blocks, block_sizes, block_offsets = 1, [len(self._flags[ti])], [0]
+            else:
+                num_blocks, block_sizes, block_offsets = block_structure(self._sdp_bases[ti])
 
             # Remove zero-sized blocks
             bi = 0
@@ -1472,7 +2319,8 @@ class Problem(SageObject):
     def solve_sdp(self, show_output=False, solver="csdp",
         force_sharp_graphs=False, force_zero_eigenvectors=False,
         check_solution=True, tolerance=1e-5, show_sorted=False, show_all=False,
-        use_initial_point=False, import_solution_file=None):
+        use_initial_point=False, import_solution_file=None, race=False, monitor=None,
+        warm_start=None, use_block_bases=False, use_flag_bases=False, limits=None):
         r"""
         Solves a semi-definite program to get a bound on the problem.
 
@@ -1494,6 +2342,14 @@ class Problem(SageObject):
             directory listed in PATH. The name of the solver should be "csdp", "sdpa", "sdpa_dd",
             "sdpa_qd" or "dsdp".
 
+            Alternatively, ``solver`` can be "ipm", to use the built-in interior-point solver
+            (see ``InteriorPointBackend``), or any ``SDPBackend`` instance. These solve the SDP
+            in-process, without writing an input file; this is convenient for small problems.
+
+            ``solver`` can also be a list of external solvers, such as ["csdp", "sdpa", "dsdp"].
+            They are tried in turn until one succeeds, or raced if ``race`` is True. The
+            solver that was used is stored in ``_sdp_solver``.
+
          - ``force_sharp_graphs`` - Boolean (default: False). If True, then the SDP is set up so
            that graphs that are supposed to be sharp are not given any "slack". Generally, this
            option is not particularly useful. It can sometimes improve the "quality" of a solution.
@@ -1517,7 +2373,7 @@ class Problem(SageObject):
             are annotated with a "C". (If these sets are not identical, then there is a problem.)
 
           - ``use_initial_point`` - Boolean (default: False). Whether to write an initial point
-            file for the SDP solver. The initial point file is not used unless the solver is CSDP.
+            file for the SDP solver. The initial point file is used by CSDP and SDPA.
             Using an initial point can speed up the computation, but occasionally causes problems;
             so this option is False by default.
 
@@ -1525,17 +2381,117 @@ class Problem(SageObject):
             solver will not be run; instead the output file from a previous run of an SDP solver
             will be read. Care should be taken to ensure that the file being imported is for
             exactly the same problem, as minimal sanity-checking is done.
+
+          - ``race`` - Boolean (default: False). If True, and ``solver`` is a list, then the
+            solvers that can be found are run in parallel, and the first one to produce a
+            solution that is feasible (to within 1e-5) is used; the others are killed. The
+            winner is remembered, and tried first on later problems of the same kind and order.
+
+          - ``monitor`` - SolverMonitor or None (default: None). If given, it is passed each
+            iteration reported by the solver, and can display a progress bar, call callbacks,
+            or stop the solver early (in which case a ValueError is raised). Its ``max_gap``
+            is a looser stopping tolerance, with which the solver still returns a solution.
+            For example, ``SolverMonitor(progress_bar=True, max_time=3600)``. The iterations
+            of the last run (or of the winner of a race) are stored in
+            ``_sdp_solver_iterations``.
+
+          - ``warm_start`` - Problem, SDPSolution or None (default: None). If a previously
+            solved Problem is given, its SDP solution is used as the starting point: the
+            entries are matched up by the canonical forms of the graphs, types and flags, so
+            the problem may differ a little (e.g. by a forbidden graph or an assumption). An
+            SDPSolution must be for an SDP with exactly the same structure. The point is
+            perturbed to be strictly feasible. It is used by CSDP, SDPA and the built-in
+            solver, and replaces ``use_initial_point``.
+
+          - ``use_block_bases`` - Boolean (default: False). If True, each type's Q matrix is
+            written in the basis given by ``compute_block_bases``, in which it splits into an
+            invariant and an anti-invariant block, so the SDP has two smaller blocks per type
+            instead of one. The solution is mapped back to the flag basis, so the rest of the
+            pipeline is unchanged. This cannot be used with ``force_zero_eigenvectors`` or
+            ``use_initial_point``.
+
+          - ``use_flag_bases`` - Boolean (default: False). If True, each type's Q matrix is
+            written in the basis given by ``compute_flag_bases``, which leaves out the zero
+            eigenvectors forced by the construction (and uses the invariant/anti-invariant
+            blocks). The SDP then has smaller blocks, which are strictly feasible if the
+            construction is right; this is faster, better conditioned, and makes ``make_exact``
+            more likely to succeed. A construction must have been set. The solution is mapped
+            back to the flag basis, as with ``use_block_bases``.
+
+          - ``limits`` - SolverLimits or None (default: None). Wall-clock, CPU time and
+            address space limits for the external solver process, e.g.
+            ``SolverLimits(wall_time=86400, memory=32 * 2^30)``. If the solver hits one, a
+            SolverLimitExceeded exception (a ValueError) is raised, which says which limit
+            it was. The solver's peak memory use and CPU time are sampled while it runs,
+            and stored in ``_sdp_solver_telemetry`` (a SolverTelemetry). When racing, that
+            of the winner is stored there, and that of every solver in
+            ``_sdp_race_telemetry`` (a dictionary keyed by solver).
         """
 
+        if use_flag_bases:
+            self.state("set_construction", "ensure_yes")
+            if self.state("compute_flag_bases") != "yes":
+                self.compute_flag_bases()
+            bases = self._flag_bases
+        elif use_block_bases:
+            if self.state("compute_block_bases") != "yes":
+                self.compute_block_bases()
+            bases = self._block_bases
+        else:
+            bases = None
+
+        if (self.state("set_block_matrix_structure") != "yes"
+                or not getattr(self, "_sdp_bases", None) is bases):
+            self._set_block_matrix_structure(use_block_bases=use_block_bases, use_flag_bases=use_flag_bases)
+
+        if isinstance(solver, (list, tuple)):
+            for s in solver:
+                if not s in external_solvers:
+                    raise ValueError("only external solvers can be given in a list.")
+            external = True
+        else:
+            external = solver in external_solvers
+
+        if import_solution_file is None and not external:
+
+            backend = sdp_backend(solver)
+            if not limits is None:
+                if isinstance(backend, ExternalSolverBackend):
+                    backend = copy(backend)
+                    backend.limits = limits
+                else:
+                    sys.stdout.write("Warning: limits only apply to external solvers; ignoring them.\n")
+
+            self._solve_sdp_with_backend(backend, show_output=show_output,
+                force_sharp_graphs=force_sharp_graphs, force_zero_eigenvectors=force_zero_eigenvectors,
+                monitor=monitor, warm_start=warm_start)
+
+            if check_solution:
+                self.check_solution(tolerance=tolerance, show_sorted=show_sorted, show_all=show_all)
+            return
+
         if import_solution_file is None:
 
-            if self.state("write_sdp_input_file") != "yes":
+            # The file is rewritten if it was written with a different precision (for
+            # example, by an earlier run of CSDP when SDPA-QD is now being used).
+            digits = 64 if "sdpa_qd" in solver else None
+            if (self.state("write_sdp_input_file") != "yes"
+                    or getattr(self, "_sdp_input_digits", None) != digits):
                 self.write_sdp_input_file(force_sharp_graphs=force_sharp_graphs,
-                                          force_zero_eigenvectors=force_zero_eigenvectors)
-            if use_initial_point and self.state("write_sdp_initial_point_file") != "yes":
-                self.write_sdp_initial_point_file()
+                                          force_zero_eigenvectors=force_zero_eigenvectors,
+                                          digits=digits)
+            if not warm_start is None:
+                initial_point_filename = os.path.join(self._sdp_working_directory(), "sdp.warm-s")
+                self._warm_start_point(warm_start).write_initial_point(initial_point_filename)
+            elif use_initial_point:
+                if self.state("write_sdp_initial_point_file") != "yes":
+                    self.write_sdp_initial_point_file()
+                initial_point_filename = self._sdp_initial_point_filename
+            else:
+                initial_point_filename = None
             self._run_sdp_solver(show_output=show_output, solver=solver,
-                                 use_initial_point=use_initial_point)
+                                 initial_point_filename=initial_point_filename, race=race, monitor=monitor,
+                                 limits=limits)
 
         else:
 
@@ -1548,145 +2504,239 @@ class Problem(SageObject):
         if check_solution:
             self.check_solution(tolerance=tolerance, show_sorted=show_sorted, show_all=show_all)
 
-    # TODO: add option for forcing sharps
+    def _sdp_keys(self):
+        # Canonical keys for the constraints, and for the blocks and their rows, of the SDP
+        # built by _sdp_data. These are used to carry a solution over to a related problem.
+
+        graph_keys = [repr(g) for g in self._graphs]
+        constraint_keys = [("graph", k) for k in graph_keys]
+        constraint_keys.extend(("density block", i) for i in range(len(self._density_coeff_blocks)))
+
+        block_keys = [("delta", [0])]
+        for ti, size, offset in self._block_matrix_structure:
+            if not self._sdp_bases is None:
+                # rows of the basis are keyed by the flags they involve
+                B = self._sdp_bases[ti]
+                row_keys = [tuple(sorted(repr(self._flags[ti][j]) for j in B.nonzero_positions_in_row(a)))
+                            for a in range(offset, offset + size)]
+                seen = {}
+                for i, k in enumerate(row_keys):
+                    seen[k] = seen.get(k, -1) + 1
+                    row_keys[i] = (k, seen[k])
+                block_keys.append((("type basis", repr(self._types[ti]), offset), row_keys))
+            else:
+                block_keys.append((("type", repr(self._types[ti]), offset),
+                                   [repr(f) for f in self._flags[ti][offset:offset + size]]))
+        block_keys.append(("slack", graph_keys))
+        block_keys.append(("densities", range(len(self._active_densities))))
+
+        return constraint_keys, block_keys
 
-    def write_sdp_input_file(self, force_sharp_graphs=False, force_zero_eigenvectors=False):
+    def _warm_start_point(self, warm_start, margin=1e-3):
         r"""
-        Writes an input file for the SDP solver, specifying the SDP to be solved. This method is
-        by default called by ``solve_sdp``.
+        Returns an SDPSolution for this problem's SDP made from ``warm_start`` (see
+        ``solve_sdp``), perturbed to be strictly feasible.
+        """
+        block_sizes = self._sdp_block_sizes
+        dims = [abs(bs) for bs in block_sizes]
 
-        INPUT:
+        if isinstance(warm_start, SDPSolution):
 
-         - ``force_sharp_graphs`` - Boolean (default: False). If True, then the SDP is set up so
-           that graphs that are supposed to be sharp are not given any "slack". Generally, this
-           option is not particularly useful. It can sometimes improve the "quality" of a solution.
-        """
-        num_graphs = len(self._graphs)
-        num_types = len(self._types)
-        num_active_densities = len(self._active_densities)
-        num_density_coeff_blocks = len(self._density_coeff_blocks)
+            if [M.shape[0] for M in warm_start.X] != dims or len(warm_start.y) != self._sdp_num_constraints:
+                raise ValueError("warm start solution does not match the SDP.")
+            X, y, Z = warm_start.X, warm_start.y, warm_start.Z
 
-        if num_active_densities < 1:
-            raise NotImplementedError("there must be at least one active density.")
+        else:
 
-        if num_density_coeff_blocks < 1:
-            raise NotImplementedError("there must be at least one density coefficient block.")
+            if isinstance(warm_start, tuple):  # (solution, keys), as passed around by sweep
+                old_solution, (old_constraint_keys, old_block_keys) = warm_start
+            elif hasattr(warm_start, "_sdp_solution"):
+                old_solution = warm_start._sdp_solution
+                old_constraint_keys, old_block_keys = warm_start._sdp_keys()
+            else:
+                raise ValueError("warm start problem has not been solved.")
+            constraint_keys, block_keys = self._sdp_keys()
+
+            old_constraints = dict((k, i) for i, k in enumerate(old_constraint_keys))
+            y = numpy.zeros(self._sdp_num_constraints)
+            for i, k in enumerate(constraint_keys):
+                if k in old_constraints:
+                    y[i] = old_solution.y[old_constraints[k]]
+
+            old_blocks = dict((k[0], (bi, k[1])) for bi, k in enumerate(old_block_keys))
+            X = [numpy.zeros((d, d)) for d in dims]
+            Z = [numpy.zeros((d, d)) for d in dims]
+            for bi, (key, row_keys) in enumerate(block_keys):
+                if not key in old_blocks:
+                    continue
+                old_bi, old_row_keys = old_blocks[key]
+                old_rows = dict((k, j) for j, k in enumerate(old_row_keys))
+                new_indices = [j for j, k in enumerate(row_keys) if k in old_rows]
+                old_indices = [old_rows[row_keys[j]] for j in new_indices]
+                new_ix, old_ix = numpy.ix_(new_indices, new_indices), numpy.ix_(old_indices, old_indices)
+                X[bi][new_ix] = old_solution.X[old_bi][old_ix]
+                Z[bi][new_ix] = old_solution.Z[old_bi][old_ix]
+
+            matched = sum(1 for k in constraint_keys if k in old_constraints)
+            sys.stdout.write("Warm start matched %d of %d constraints.\n" % (matched, len(constraint_keys)))
+
+        X = strictly_feasible(X, margin)
+        Z = strictly_feasible(Z, margin)
+        for bi in range(len(block_sizes)):
+            if block_sizes[bi] < 0:
+                X[bi] = numpy.diag(numpy.diag(X[bi]))
+                Z[bi] = numpy.diag(numpy.diag(Z[bi]))
+
+        return SDPSolution(X, numpy.array(y, dtype=numpy.float64), Z)
+
+    def sweep(self, param_values, setup_fn, workers=1, warm_start=True, **kwargs):
+        r"""
+        Solves a family of problems that differ only in their objective, densities or
+        assumptions; for example, a degree axiom over a range of values. The graphs, flags
+        and flag products are computed once, and then for each parameter value a copy of
+        the problem is made, ``setup_fn(copy, value)`` is called on it, and its SDP is
+        solved. Returns a table: a list of rows (value, bound, solver, iterations, seconds,
+        error), in the order of ``param_values``. ``bound`` is the SDP objective value, and
+        ``error`` is None unless the solve raised an exception.
 
-        if self.state("set_block_matrix_structure") != "yes":
-            self._set_block_matrix_structure()
-        total_num_blocks = len(self._block_matrix_structure)
+        INPUT:
 
-        if force_zero_eigenvectors:
-            num_extra_matrices = sum(self._zero_eigenvectors[ti].nrows() for ti in self._active_types)
-        else:
-            num_extra_matrices = 0
+         - ``param_values`` - a list of parameter values.
 
-        self.state("write_sdp_input_file", "yes")
+         - ``setup_fn`` - a function taking a problem and a value, which sets the objective,
+           densities or assumptions of the problem. It must not forbid graphs or change the
+           order of the problem.
 
-        self._sdp_input_filename = os.path.join(unicode(SAGE_TMP), "sdp.dat-s")
+         - ``workers`` - Integer (default: 1). The number of processes to solve the SDPs in.
+           Within these processes, any ``workers`` option of the methods called (such as
+           ``make_exact``) is ignored, and the per-type steps are run serially, so that
+           at most this many processes are used.
 
-        sys.stdout.write("Writing SDP input file...\n")
+         - ``warm_start`` - Boolean (default: True). Whether to warm-start each solve from
+           the solution for the nearest parameter value that has already been solved.
 
-        with open(self._sdp_input_filename, "w") as f:
+        Other keyword arguments are passed to ``solve_sdp`` (``check_solution`` defaults
+        to False).
 
-            # num constraints
-            f.write("%d\n" % (num_graphs + num_density_coeff_blocks + num_extra_matrices,))
+        EXAMPLES:
 
-            # num blocks in each constraint
-            f.write("%d\n" % (total_num_blocks + 3 + (1 if force_zero_eigenvectors else 0),))
+        sage: problem = GraphAxiomsProblem(6, forbid=(3, 3))
+        sage: table = problem.sweep([i / 10 for i in range(1, 6)],
+                  lambda p, v: p.make_degree_problem(v), workers=4)
+        """
+        global _sweep_context
 
-            # block sizes
-            f.write("1 ")
-            for b in self._block_matrix_structure:
-                f.write("%d " % b[1])
+        self.state("compute_flags", "ensure_yes")
+        if self.state("compute_products") != "yes":
+            self.compute_products()
 
-            f.write("-%d -%d" % (num_graphs, num_active_densities))
-            if force_zero_eigenvectors:
-                f.write(" -%d" % num_extra_matrices)
-            f.write("\n")
+        kwargs.setdefault("check_solution", False)
+        param_values = list(param_values)
+        num_values = len(param_values)
 
-            # RHS of the SDP problem
-            f.write("0.0 " * num_graphs)
-            f.write("1.0 " * num_density_coeff_blocks)
-            f.write("0.0 " * num_extra_matrices)
-            f.write("\n")
+        def distance(i, j):
+            try:
+                return abs(float(param_values[i]) - float(param_values[j]))
+            except (TypeError, ValueError):
+                return abs(i - j)
 
-            # objective function (\delta)
-            if not self._minimize:
-                f.write("0 1 1 1 -1.0\n")
-            else:
-                f.write("0 1 1 1 1.0\n")
+        rows = [None] * num_values
+        neighbours = {}
 
-            if force_zero_eigenvectors:
-                for mi in range(num_extra_matrices):
-                    f.write("0 %d %d %d %s\n" % (total_num_blocks + 4, mi + 1, mi + 1, "1.0" if self._minimize else "-1.0"))
+        def nearest(i):
+            if not warm_start or len(neighbours) == 0:
+                return None
+            return neighbours[min(neighbours, key=lambda j: distance(i, j))]
 
-            # slack vars and bound c for each constraint
-            for i in range(num_graphs):
-                if not self._minimize:
-                    f.write("%d 1 1 1 -1.0\n" % (i + 1,))
-                else:
-                    f.write("%d 1 1 1 1.0\n" % (i + 1,))
-                # if not graph sharp, add buffer var to make constraint equality
-                if not (force_sharp_graphs and i in self._sharp_graphs):
-                    f.write("%d %d %d %d 1.0\n" % (i + 1, total_num_blocks + 2, i + 1, i + 1))
+        def record(result):
+            index, row, data = result
+            rows[index] = row
+            if not data is None:
+                neighbours[index] = data
+            sys.stdout.write("Sweep: %s -> %s (%d of %d done).\n" % (row[0], row[1],
+                sum(1 for r in rows if not r is None), num_values))
 
-            # add objective function to the SDP
-            for i in range(num_graphs):
-                for j in range(num_active_densities):
-                    d = self._densities[self._active_densities[j]][i]
-                    if d != 0:
-                        if self._minimize:
-                            d *= -1
-                        f.write("%d %d %d %d %s\n" % (i + 1, total_num_blocks + 3, j + 1, j + 1, d.n(digits=64)))
-
-            # set constant equal to 1
-            for i in range(num_density_coeff_blocks):
-                for di in self._density_coeff_blocks[i]:
-                    if di in self._active_densities:
-                        j = self._active_densities.index(di)
-                        f.write("%d %d %d %d 1.0\n" % (num_graphs + i + 1, total_num_blocks + 3, j + 1, j + 1))
-
-            # fill block_matrix with entries stored in product_densities_arrays
-            for ti in self._active_types:
+        _sweep_context = (self, setup_fn, kwargs)
 
-                num_blocks, block_sizes, block_offsets, block_indices = self._get_block_matrix_structure(ti)
+        try:
+            if workers <= 1:
+                for i in range(num_values):
+                    record(_sweep_run(i, param_values[i], nearest(i)))
+            else:
+                pool = multiprocessing.Pool(workers, initializer=_set_worker_process)
+                try:
+                    pending = range(num_values)
+                    running = []
+                    while len(pending) > 0 or len(running) > 0:
+                        while len(pending) > 0 and len(running) < workers:
+                            i = pending.pop(0)
+                            running.append(pool.apply_async(_sweep_run, (i, param_values[i], nearest(i))))
+                        time.sleep(0.1)
+                        for r in [r for r in running if r.ready()]:
+                            running.remove(r)
+                            record(r.get())
+                finally:
+                    pool.terminate()
+                    pool.join()
+        finally:
+            _sweep_context = None
+
+        sys.stdout.write("%-20s %-24s %-8s %6s %9s\n" % ("value", "bound", "solver", "iters", "seconds"))
+        for value, bound, solver, iterations, seconds, error in rows:
+            if error is None:
+                sys.stdout.write("%-20s %-24s %-8s %6s %9.1f\n" % (value, bound, solver, iterations, seconds))
+            else:
+                sys.stdout.write("%-20s failed: %s\n" % (value, error))
 
-                for row in self._product_densities_arrays[ti]:
-                    gi = row[0]
-                    j = row[1]
-                    k = row[2]
-                    bi = num_blocks - 1
-                    if bi > 0:
-                        while block_offsets[bi] > j:
-                            bi -= 1
-                        j -= block_offsets[bi]
-                        k -= block_offsets[bi]
-                    value = Integer(row[3]) / Integer(row[4])
-                    f.write("%d %d %d %d %s\n" %
-                            (gi + 1, block_indices[bi] + 2, j + 1, k + 1, value.n(digits=64)))
-
-            # TODO: get working with blocks, inactive types
-            if force_zero_eigenvectors:
-                mi = 0
-                for ti in self._active_types:
-                    nf = len(self._flags[ti])
-                    for zi in range(self._zero_eigenvectors[ti].nrows()):
-                        for j in range(nf):
-                            for k in range(j, nf):
-                                value = self._zero_eigenvectors[ti][zi, j] * self._zero_eigenvectors[ti][zi, k]
-                                if value != 0:
-                                    f.write("%d %d %d %d %s\n" %
-                                            (num_graphs + num_density_coeff_blocks + mi + 1, ti + 2, j + 1, k + 1, value.n(digits=64)))
-                        f.write("%d %d %d %d -1.0\n" % (num_graphs + num_density_coeff_blocks + mi + 1, total_num_blocks + 4, mi + 1, mi + 1))
-                        mi += 1
+        return rows
 
-    # TODO: handle no sharp graphs
+    # TODO: add option for forcing sharps
 
-    def write_sdp_initial_point_file(self, small_change=1/Integer(10)):
+    def write_sdp_input_file(self, force_sharp_graphs=False, force_zero_eigenvectors=False,
+                             digits=None, filename=None):
         r"""
-        Writes an initial point file for the SDP solver. The zero matrix gives a feasible primal
-        point. If a construction has been set, then this will be used to generate a feasible dual
+        Writes an input file for the SDP solver, specifying the SDP to be solved. This method is
+        by default called by ``solve_sdp``.
+
+        INPUT:
+
+         - ``force_sharp_graphs`` - Boolean (default: False). If True, then the SDP is set up so
+           that graphs that are supposed to be sharp are not given any "slack". Generally, this
+           option is not particularly useful. It can sometimes improve the "quality" of a solution.
+
+         - ``digits`` - Integer or None (default: None). If None, the coefficients are written
+           in double precision, which is all that CSDP, SDPA and DSDP can read. Otherwise they
+           are written rounded to this number of decimal places; ``solve_sdp`` uses 64 digits
+           for "sdpa_qd".
+
+         - ``filename`` - String or None (default: None). Where to write the file; by default
+           it is written to "sdp.dat-s" in the problem's working directory. If the filename ends
+           in ".gz", the file is gzip-compressed (the SDP solvers cannot read such files, but
+           they take up much less space when keeping SDPs around).
+        """
+        sdp = self._sdp_data(force_sharp_graphs=force_sharp_graphs,
+                             force_zero_eigenvectors=force_zero_eigenvectors)
+
+        self.state("write_sdp_input_file", "yes")
+
+        self._sdp_block_sizes = sdp.block_sizes
+        self._sdp_num_constraints = sdp.num_constraints
+
+        if filename is None:
+            filename = os.path.join(self._sdp_working_directory(), "sdp.dat-s")
+        self._sdp_input_filename = filename
+        self._sdp_input_digits = digits
+
+        sys.stdout.write("Writing SDP input file...\n")
+
+        sdp.write(self._sdp_input_filename, digits=digits)
+
+    # TODO: handle no sharp graphs
+
+    def write_sdp_initial_point_file(self, small_change=1/Integer(10)):
+        r"""
+        Writes an initial point file for the SDP solver. The zero matrix gives a feasible primal
+        point. If a construction has been set, then this will be used to generate a feasible dual
         point, otherwise a zero matrix will be used for this as well. Using this method can reduce
         the time it takes the SDP solver to find a solution - typically by a third.
 
@@ -1702,10 +2752,13 @@ class Problem(SageObject):
         num_types = len(self._types)
         num_active_densities = len(self._active_densities)
 
-        self._sdp_initial_point_filename = os.path.join(unicode(SAGE_TMP), "sdp.ini-s")
+        self._sdp_initial_point_filename = os.path.join(self._sdp_working_directory(), "sdp.ini-s")
 
         if self.state("set_block_matrix_structure") != "yes":
             self._set_block_matrix_structure()
+
+        if not self._sdp_bases is None:
+            raise NotImplementedError("initial point files are not supported with SDP bases; use warm_start.")
         total_num_blocks = len(self._block_matrix_structure)
 
         self.state("write_sdp_initial_point_file", "yes")
@@ -1735,14 +2788,14 @@ class Problem(SageObject):
                     nf = len(self._flags[ti])
                     z_matrix = matrix(self._field, nf, nf)
 
-                    for row in self._product_densities_arrays[ti]:
+                    values = self._product_coefficients(ti, "rationals")
+                    for row, value in zip(self._product_densities_arrays[ti], values):
                         gi = row[0]
                         if not gi in self._sharp_graphs:
                             continue
                         si = self._sharp_graphs.index(gi)
                         j = row[1]
                         k = row[2]
-                        value = Integer(row[3]) / Integer(row[4])
                         z_matrix[j, k] += value * self._sharp_graph_densities[si]
 
                     for j in range(nf):
@@ -1850,167 +2903,279 @@ class Problem(SageObject):
 
     # TODO: report error if problem infeasible
 
-    def _run_sdp_solver(self, show_output=False, solver="csdp", use_initial_point=False):
+    def _run_sdp_solver(self, show_output=False, solver="csdp", initial_point_filename=None,
+                        race=False, monitor=None, limits=None):
 
         self.state("run_sdp_solver", "yes")
 
-        previous_directory = os.getcwd()
-        os.chdir(unicode(SAGE_TMP))
+        key = (self.__class__.__name__, self._n)
+        if isinstance(solver, basestring):
+            solvers = [solver]
+        else:
+            solvers = preferred_solver_order(key, solver)
+
+        if monitor is None:
+            monitor = SolverMonitor()
+        self._sdp_solver_iterations = []
+        self._sdp_solver_telemetry = None
+
+        if race:
+
+            self._sdp_race_telemetry = {}
+            solver, returncode, output, obj_val, output_filename = race_external_solvers(
+                solvers, self._sdp_input_filename, self._sdp_working_directory(),
+                initial_point_filename=initial_point_filename, show_output=show_output,
+                limits=limits, monitor=monitor, telemetry=self._sdp_race_telemetry)
+            self._sdp_solver_iterations = monitor.iterations
+            self._sdp_solver_telemetry = self._sdp_race_telemetry[solver]
+            sys.stdout.write("Solver peak memory %.1f MiB, CPU time %.1fs.\n" % (
+                self._sdp_solver_telemetry.peak_rss / 2.0 ** 20, self._sdp_solver_telemetry.cpu_time))
+            if returncode is None:
+                raise ValueError("SDP solver stopped: %s." % monitor.stop_reason)
+            remember_solver(key, solver)
+            sys.stdout.write("Solver %s won.\n" % solver)
 
-        if solver == "csdp":
-            cmd = "%s %s sdp.out" % (cdsp_cmd, self._sdp_input_filename)
+        else:
 
-            if use_initial_point and self.state("write_sdp_initial_point_file") == "yes":
-                cmd += " %s" % self._sdp_initial_point_filename
+            for solver in solvers:
+                if solver != solvers[-1] and not solver_available(solver):
+                    sys.stdout.write("Solver %s not found; trying the next one.\n" % solver)
+                    continue
+                sys.stdout.write("Running SDP solver...\n")
+                self._sdp_solver_telemetry = SolverTelemetry()
+                try:
+                    returncode, output, obj_val, output_filename = run_external_solver(solver,
+                        self._sdp_input_filename, self._sdp_working_directory(),
+                        initial_point_filename=initial_point_filename, show_output=show_output,
+                        monitor=monitor, limits=limits, telemetry=self._sdp_solver_telemetry)
+                except OSError as e:
+                    if solver == solvers[-1]:
+                        raise
+                    sys.stdout.write("Solver %s could not be run (%s); trying the next one.\n" % (solver, e))
+                    continue
+                self._sdp_solver_iterations = monitor.iterations
+                sys.stdout.write("Solver peak memory %.1f MiB, CPU time %.1fs.\n" % (
+                    self._sdp_solver_telemetry.peak_rss / 2.0 ** 20, self._sdp_solver_telemetry.cpu_time))
+                if returncode is None:
+                    raise ValueError("SDP solver stopped: %s." % monitor.stop_reason)
+                if solver == solvers[-1] or solver_succeeded(solver, returncode, output, obj_val):
+                    break
+                sys.stdout.write("Solver %s failed; trying the next one.\n" % solver)
 
-        elif solver == "dsdp":
-            cmd = "%s %s -gaptol 1e-18 -print 1 -save sdp.out" % (dsdp_cmd, self._sdp_input_filename)
+        # For maximization problems, the objective value returned by the SDP solver
+        # must be negated. DSDP seems to print the absolute value.
+        if not obj_val is None:
+            obj_val = self._approximate_field(obj_val)
+            if solver != "dsdp" and not self._minimize:
+                obj_val *= -1
 
-        elif solver == "sdpa":
-            cmd = "%s -ds %s -o sdpa.out" % (sdpa_cmd, self._sdp_input_filename)
+        self._sdp_solver = solver
+        self._sdp_objective_value = obj_val
+        self._sdp_solver_output = output
+        self._sdp_solver_returncode = returncode
 
-        elif solver == "sdpa_dd":
-            cmd = "%s -ds %s -o sdpa.out" % (sdpa_dd_cmd, self._sdp_input_filename)
+        sys.stdout.write("Returncode is %d. Objective value is %s.\n" % (
+            self._sdp_solver_returncode, obj_val))
 
-        elif solver == "sdpa_qd":
-            cmd = "%s -ds %s -o sdpa.out" % (sdpa_qd_cmd, self._sdp_input_filename)
+        self._sdp_output_filename = output_filename
 
-        else:
-            raise ValueError("unknown solver.")
+    def _sdp_data(self, force_sharp_graphs=False, force_zero_eigenvectors=False):
+        r"""
+        Returns the SDP that is solved by ``solve_sdp``, as a BlockSparseSDP with exact
+        rational entries.
+        """
+        num_graphs = len(self._graphs)
+        num_active_densities = len(self._active_densities)
+        num_density_coeff_blocks = len(self._density_coeff_blocks)
 
-        sys.stdout.write("Running SDP solver...\n")
+        if num_active_densities < 1:
+            raise NotImplementedError("there must be at least one active density.")
 
-        # For maximization problems, the objective value returned by the SDP solver
-        # must be negated.
-        obj_value_factor = 1.0 if self._minimize else -1.0
+        if num_density_coeff_blocks < 1:
+            raise NotImplementedError("there must be at least one density coefficient block.")
 
-        p = pexpect.spawn(cmd, timeout=60 * 60 * 24 * 7)
-        obj_val = None
-        self._sdp_solver_output = ""
-        while True:
-            if p.eof():
-                break
-            try:
-                sys.stdout.write("Reading output file...\n")
-                p.expect("\r\n")
-                line = p.before.strip() + "\n"
-                self._sdp_solver_output += line
-
-                if show_output:
-                    sys.stdout.write(line)
-
-                if "Primal objective value:" in line:  # CSDP
-                    obj_val = self._approximate_field(line.split()[-1]) * obj_value_factor
-                elif "objValPrimal" in line:  # SDPA
-                    obj_val = self._approximate_field(line.split()[-1]) * obj_value_factor
-                elif "DSDP Solution" in line:  # DSDP: seems to print absolute value
-                    obj_val = self._approximate_field(line.split()[-1])
-
-            except pexpect.EOF:
-                break
+        if self.state("set_block_matrix_structure") != "yes":
+            self._set_block_matrix_structure()
+        total_num_blocks = len(self._block_matrix_structure)
 
-        p.close()
-        self._sdp_solver_returncode = p.exitstatus
+        if force_zero_eigenvectors:
+            num_extra_matrices = sum(self._zero_eigenvectors[ti].nrows() for ti in self._active_types)
+        else:
+            num_extra_matrices = 0
 
-        sys.stdout.write("Returncode is %d. Objective value is %s.\n" % (
-            self._sdp_solver_returncode, obj_val))
+        sign = 1 if self._minimize else -1
 
-        # TODO: if program is infeasible, a returncode of 1 is given,
-        # and output contains "infeasible"
+        block_sizes = [1] + [b[1] for b in self._block_matrix_structure] + [-num_graphs, -num_active_densities]
+        if force_zero_eigenvectors:
+            block_sizes.append(-num_extra_matrices)
+        b = [0.0] * num_graphs + [1.0] * num_density_coeff_blocks + [0.0] * num_extra_matrices
+
+        # Entries are collected as arrays of (matrix, block, row, col, numerator, denominator).
+        entries = []
+
+        def add(mats, blocks, rows, cols, numers, denoms=1):
+            n = len(numpy.atleast_1d(numers))
+            entries.append([numpy.broadcast_to(numpy.asarray(a, dtype=dt), n) for a, dt in
+                            zip((mats, blocks, rows, cols, numers, denoms), [numpy.int64] * 4 + [object] * 2)])
+
+        def add_rationals(mats, blocks, rows, cols, values):
+            values = [QQ(v) if v in QQ else v.n(prec=256).exact_rational() for v in values]
+            add(mats, blocks, rows, cols, [int(v.numerator()) for v in values],
+                [int(v.denominator()) for v in values])
+
+        # objective function (\delta), and bound c for each constraint
+        add(numpy.arange(num_graphs + 1), 0, 0, 0, [sign] * (num_graphs + 1))
+
+        # slack vars
+        slack = numpy.array([i for i in range(num_graphs)
+                             if not (force_sharp_graphs and i in self._sharp_graphs)], dtype=numpy.int64)
+        add(slack + 1, total_num_blocks + 1, slack, slack, [1] * len(slack))
+
+        # add objective function to the SDP
+        for j in range(num_active_densities):
+            d = self._densities[self._active_densities[j]]
+            gis = numpy.array([i for i in range(num_graphs) if d[i] != 0], dtype=numpy.int64)
+            add_rationals(gis + 1, total_num_blocks + 2, j, j, [-sign * d[i] for i in gis])
+
+        # set constant equal to 1
+        for i in range(num_density_coeff_blocks):
+            js = [self._active_densities.index(di) for di in self._density_coeff_blocks[i]
+                  if di in self._active_densities]
+            add(num_graphs + i + 1, total_num_blocks + 2, js, js, [1] * len(js))
+
+        # fill block_matrix with entries stored in product_densities_arrays
+        for ti in self._active_types:
 
-        if "sdpa" in solver:
+            num_blocks, block_sizes_ti, block_offsets, block_indices = self._get_block_matrix_structure(ti)
+            rarray = self._product_densities_arrays[ti]
+            if len(rarray) == 0 or num_blocks == 0:
+                continue
+            if not self._sdp_bases is None:
+                gis, bi, rows, cols, numers, denoms = block_basis_entries(rarray, self._sdp_bases[ti],
+                                                                          block_offsets)
+                add(gis + 1, numpy.array(block_indices)[bi] + 1, rows, cols, numers, denoms)
+                continue
+            bi = numpy.searchsorted(numpy.array(block_offsets), rarray[:, 1], side="right") - 1
+            offsets = numpy.array(block_offsets)[bi]
+            add(rarray[:, 0] + 1, numpy.array(block_indices)[bi] + 1, rarray[:, 1] - offsets,
+                rarray[:, 2] - offsets, self._product_coefficients(ti, "numerators"),
+                self._product_coefficients(ti, "denominators"))
 
-            with open("sdpa.out", "r") as inf:
-                with open("sdp.out", "w") as f:
+        if force_zero_eigenvectors:
+            mi = 0
+            add(numpy.arange(num_extra_matrices) * 0, total_num_blocks + 3,
+                numpy.arange(num_extra_matrices), numpy.arange(num_extra_matrices), [sign] * num_extra_matrices)
+            for ti in self._active_types:
+                num_blocks, block_sizes_ti, block_offsets, block_indices = self._get_block_matrix_structure(ti)
+                if num_blocks != 1 or not self._sdp_bases is None:
+                    raise NotImplementedError("force_zero_eigenvectors requires one block per type.")
+                nf = len(self._flags[ti])
+                js, ks = numpy.triu_indices(nf)
+                for zi in range(self._zero_eigenvectors[ti].nrows()):
+                    row = self._zero_eigenvectors[ti][zi]
+                    nonzero = [i for i in range(len(js)) if row[js[i]] != 0 and row[ks[i]] != 0]
+                    mi_index = num_graphs + num_density_coeff_blocks + mi + 1
+                    add_rationals(mi_index, block_indices[0] + 1, js[nonzero], ks[nonzero],
+                                  [row[js[i]] * row[ks[i]] for i in nonzero])
+                    add(mi_index, total_num_blocks + 3, mi, mi, [-1])
+                    mi += 1
+
+        columns = [numpy.concatenate([e[i] for e in entries]) for i in range(6)]
+
+        return BlockSparseSDP(b, block_sizes, *columns)
+
+    def _solve_sdp_with_backend(self, backend, show_output=False,
+                                force_sharp_graphs=False, force_zero_eigenvectors=False,
+                                monitor=None, warm_start=None):
+
+        sdp = self._sdp_data(force_sharp_graphs=force_sharp_graphs,
+                             force_zero_eigenvectors=force_zero_eigenvectors)
+
+        self._sdp_block_sizes = sdp.block_sizes
+        self._sdp_num_constraints = sdp.num_constraints
+
+        initial_point = None
+        if not warm_start is None:
+            initial_point = self._warm_start_point(warm_start)
 
-                    found, diagonal = False, False
-                    t, row, col = 0, 1, 1
+        self.state("run_sdp_solver", "yes")
 
-                    for line in inf:
-                        if line[:6] == "yMat =":
-                            break
-                    else:
-                        raise ValueError
+        sys.stdout.write("Running SDP solver (%s)...\n" % backend.name)
 
-                    for line in inf:
+        if monitor is None:
+            monitor = SolverMonitor()
+        self._sdp_solver_iterations = monitor.iterations
 
-                        if line == "}":
-                            break
-                        elif line[:3] == "{ {":
-                            t += 1
-                            row = 1
-                            diagonal = False
-                        elif line[:2] == "{+" or line[:2] == "{-":
-                            t += 1
-                            row = 1
-                            diagonal = True
-
-                        line = line.replace("{", "")
-                        line = line.replace("}", "")
-                        col = 1
-                        for a in line.split(","):
-                            try:
-                                v = a.strip()
-                                vf = float(v)  # only done to see if we get ValueError
-                                if diagonal:
-                                    f.write("2 %d %d %d %s\n" % (t, row, col, v))
-                                    row += 1
-                                elif row <= col:
-                                    f.write("2 %d %d %d %s\n" % (t, row, col, v))
-                                col += 1
-                            except ValueError:
-                                pass
-
-                        if col > 1:  # at least one number found...
-                            row += 1
-
-        self._sdp_output_filename = os.path.join(unicode(SAGE_TMP), "sdp.out")
-        os.chdir(previous_directory)
-
-    # TODO: read in dual solution
+        solution = backend.solve(sdp, show_output=show_output, monitor=monitor,
+                                 initial_point=initial_point)
+        self._sdp_solver_iterations = monitor.iterations
 
-    def _read_sdp_output_file(self):
+        obj_val = None
+        if not solution.primal_objective is None:
+            obj_val = self._approximate_field(solution.primal_objective)
+            if not self._minimize:
+                obj_val *= -1
 
-        self.state("read_solution", "yes")
+        self._sdp_solver = backend.name
+        self._sdp_objective_value = obj_val
+        self._sdp_solver_output = solution.output
+        self._sdp_solver_returncode = solution.status
 
-        num_graphs = len(self._graphs)
-        num_types = len(self._types)
-        num_densities = len(self._densities)
+        sys.stdout.write("Returncode is %d. Objective value is %s.\n" % (
+            self._sdp_solver_returncode, obj_val))
+
+        self._load_sdp_solution(solution)
+
+    def _read_sdp_output_file(self):
 
         if self.state("set_block_matrix_structure") != "yes":
             self._set_block_matrix_structure()
-        num_blocks = len(self._block_matrix_structure)
 
-        with open(self._sdp_output_filename, "r") as f:
+        if not hasattr(self, "_sdp_block_sizes"):  # e.g. when importing a solution file
+            self._sdp_block_sizes = ([1] + [b[1] for b in self._block_matrix_structure]
+                                     + [-len(self._graphs), -len(self._active_densities)])
+            self._sdp_num_constraints = len(self._graphs) + len(self._density_coeff_blocks)
 
-            self._sdp_Q_matrices = [matrix(self._approximate_field,
-                len(self._flags[ti]), len(self._flags[ti])) for ti in range(num_types)]
+        self._load_sdp_solution(read_sdp_solution_file(self._sdp_output_filename,
+                                self._sdp_block_sizes, self._sdp_num_constraints))
 
-            self._sdp_density_coeffs = [self._approximate_field(0) for i in range(num_densities)]
+    def _load_sdp_solution(self, solution):
+        # Sets the Q matrices and density coefficients from an SDPSolution, whose X blocks
+        # are laid out as in _sdp_data.
 
-            for line in f:
-                numbers = line.split()
-                if numbers[0] != "2":
-                    continue
-                bi = int(numbers[1]) - 2
-                if bi == num_blocks + 1:
-                    j = int(numbers[2]) - 1
-                    di = self._active_densities[j]
-                    self._sdp_density_coeffs[di] = self._approximate_field(numbers[4])
-                    continue
-                if bi < 0 or bi >= num_blocks:
-                    continue
-                j = int(numbers[2]) - 1
-                k = int(numbers[3]) - 1
-                ti, size, offset = self._block_matrix_structure[bi]
-                j += offset
-                k += offset
+        self.state("read_solution", "yes")
+
+        self._sdp_solution = solution
+
+        num_types = len(self._types)
+        num_blocks = len(self._block_matrix_structure)
 
-                self._sdp_Q_matrices[ti][j, k] = self._approximate_field(numbers[4])
-                self._sdp_Q_matrices[ti][k, j] = self._sdp_Q_matrices[ti][j, k]
+        bases = self._sdp_bases
+        sizes = [len(self._flags[ti]) if bases is None else bases[ti].nrows() for ti in range(num_types)]
+        Q_arrays = [numpy.zeros((sizes[ti], sizes[ti])) for ti in range(num_types)]
+        for bi in range(num_blocks):
+            ti, size, offset = self._block_matrix_structure[bi]
+            Q_arrays[ti][offset:offset + size, offset:offset + size] = solution.X[bi + 1]
 
+        # Map Q' in the basis B back to the flag basis: Q = B^T Q' B.
+        if not bases is None:
+            for ti in range(num_types):
+                B = bases[ti].numpy(dtype=numpy.float64).reshape(sizes[ti], len(self._flags[ti]))
+                Q_arrays[ti] = B.T.dot(Q_arrays[ti]).dot(B)
+
+        self._sdp_Q_matrices = []
         for ti in range(num_types):
-            self._sdp_Q_matrices[ti].set_immutable()
+            if self._approximate_field == RDF:
+                Q = matrix(RDF, Q_arrays[ti])
+            else:
+                Q = matrix(self._approximate_field, Q_arrays[ti].tolist())
+            Q.set_immutable()
+            self._sdp_Q_matrices.append(Q)
+
+        self._sdp_density_coeffs = [self._approximate_field(0) for i in range(len(self._densities))]
+        D = numpy.diag(solution.X[num_blocks + 2])
+        for j in range(len(self._active_densities)):
+            self._sdp_density_coeffs[self._active_densities[j]] = self._approximate_field(D[j])
 
     def check_solution(self, tolerance=1e-5, show_sorted=False, show_all=False):
         r"""
@@ -2041,55 +3206,58 @@ class Problem(SageObject):
 
         sys.stdout.write("Checking numerical bound...\n")
 
-        fbounds = [sum([self._densities[j][i] * self._sdp_density_coeffs[j] for j in range(num_densities)]) for i in range(num_graphs)]
+        # Everything is done in float64. For each type, the products form a sparse
+        # (graphs x flag pairs) matrix, and the contribution to each graph's bound is the
+        # product of this with the vector of entries of Q: one weighted bincount.
+
+        density_coeffs = numpy.array([float(c) for c in self._sdp_density_coeffs])
+        densities = numpy.array([[float(x) for x in dv] for dv in self._densities]).reshape(num_densities, num_graphs)
+        fbounds = density_coeffs.dot(densities)
+
+        sign = -1.0 if self._minimize else 1.0
 
         for ti in self._active_types:
-            for row in self._product_densities_arrays[ti]:
-                gi, j, k, numer, denom = row
-                d = Integer(numer) / Integer(denom)
-                value = self._sdp_Q_matrices[ti][j, k]
-                if j != k:
-                    d *= 2
-                if not self._minimize:
-                    fbounds[gi] += d * value
-                else:
-                    fbounds[gi] -= d * value
+            rarray = self._product_densities_arrays[ti]
+            if len(rarray) == 0:
+                continue
+            Q = numpy.array(self._sdp_Q_matrices[ti].numpy() if self._approximate_field == RDF
+                            else [[float(x) for x in row] for row in self._sdp_Q_matrices[ti].rows()],
+                            dtype=numpy.float64).reshape(len(self._flags[ti]), len(self._flags[ti]))
+            weights = self._product_coefficients(ti, "floats").copy()
+            weights[rarray[:, 1] != rarray[:, 2]] *= 2
+            fbounds += sign * numpy.bincount(rarray[:, 0], weights=weights * Q[rarray[:, 1], rarray[:, 2]],
+                                             minlength=num_graphs)
 
-        if not self._minimize:
-            bound = max(fbounds)
-        else:
-            bound = min(fbounds)
+        bound = fbounds.min() if self._minimize else fbounds.max()
 
-        self._sdp_bounds = fbounds
+        self._sdp_bounds = [self._approximate_field(x) for x in fbounds]
 
         if self.state("set_construction") == "yes":
 
-            if abs(bound - self._approximate_field(self._target_bound)) < tolerance:
+            if abs(bound - float(self._approximate_field(self._target_bound))) < tolerance:
                 sys.stdout.write("Bound of %s appears to have been met.\n" % self._target_bound)
             else:
                 sys.stdout.write("Warning: bound of %s appears to have not been met.\n" % self._target_bound)
                 return
-            sharp_graphs = self._sharp_graphs
+            sharp_graphs = set(self._sharp_graphs)
         else:
-            sharp_graphs = []  # set dummy sharp_graphs
+            sharp_graphs = set()  # set dummy sharp_graphs
 
-        apparently_sharp_graphs = [gi for gi in range(num_graphs) if abs(fbounds[gi] - bound) < tolerance]
+        is_apparently_sharp = numpy.abs(fbounds - bound) < tolerance
+        apparently_sharp_graphs = numpy.flatnonzero(is_apparently_sharp).tolist()
 
         if show_sorted or show_all:
 
-            if not self._minimize:
-                sorted_indices = sorted(range(num_graphs), key=lambda i: -fbounds[i])
-            else:
-                sorted_indices = sorted(range(num_graphs), key=lambda i: fbounds[i])
+            sorted_indices = numpy.argsort(fbounds if self._minimize else -fbounds, kind="mergesort").tolist()
 
             for gi in sorted_indices:
-                if gi in apparently_sharp_graphs:
+                if is_apparently_sharp[gi]:
                     sys.stdout.write("S")
                 elif not show_all:
                     break
                 else:
                     sys.stdout.write(" ")
-                if gi in self._sharp_graphs:
+                if gi in sharp_graphs:
                     sys.stdout.write("C")
                 else:
                     sys.stdout.write(" ")
@@ -2104,8 +3272,8 @@ class Problem(SageObject):
             for gi in apparently_sharp_graphs:
                 sys.stdout.write("%.12f : graph %d (%s)\n" % (fbounds[gi], gi, self._graphs[gi]))
 
-        extra_sharp_graphs = [gi for gi in apparently_sharp_graphs if not gi in self._sharp_graphs]
-        missing_sharp_graphs = [gi for gi in self._sharp_graphs if not gi in apparently_sharp_graphs]
+        extra_sharp_graphs = [gi for gi in apparently_sharp_graphs if not gi in sharp_graphs]
+        missing_sharp_graphs = [gi for gi in self._sharp_graphs if not is_apparently_sharp[gi]]
 
         if len(extra_sharp_graphs) > 0:
             sys.stdout.write("Warning: additional sharp graphs: %s\n" % (extra_sharp_graphs,))
@@ -2230,18 +3398,48 @@ class Problem(SageObject):
         sys.path.remove(directory)
         sys.dont_write_bytecode = dont_write_bytecode
 
+    def _map_types(self, function, type_indices, workers=1):
+        r"""
+        Yields ``function(ti)`` for each ti in ``type_indices``, in order. If ``workers`` is
+        more than 1, the calls are made in a pool of that many processes, and matrices over
+        QQ are sent back in a compact form. The function does not have to be picklable.
+        In a worker process (of a sweep, or of another pool), the calls are made serially.
+        """
+        global _type_task_function
+
+        type_indices = list(type_indices)
+
+        if workers <= 1 or len(type_indices) <= 1 or _in_worker_process:
+            for ti in type_indices:
+                yield function(ti)
+            return
+
+        _type_task_function = function
+        pool = multiprocessing.Pool(min(workers, len(type_indices)), initializer=_set_worker_process)
+        try:
+            for result in pool.imap(_type_task, type_indices):
+                yield _unpack_exact(result)
+        finally:
+            pool.terminate()
+            pool.join()
+            _type_task_function = None
+
     def make_exact(self, denominator=1024, meet_target_bound=True,
                    protect=None, use_densities=True, use_blocks=True, rank=None, show_changes=False,
-                   check_exact_bound=True, diagonalize=True):
+                   check_exact_bound=True, diagonalize=True, workers=1, cache_directory=None):
         r"""
         Makes an exact bound for the problem using the approximate floating point bound
         found by the SDP solver.
 
         INPUT:
 
-         - ``denominator`` - Integer (default: 1024). The denominator to use when
-            rounding. Higher numbers will cause the solution to be perturbed less, but can
-            cause the resulting certificates to be larger.
+         - ``denominator`` - Integer, or list of integers (default: 1024). The denominator
+            to use when rounding. Higher numbers will cause the solution to be perturbed
+            less, but can cause the resulting certificates to be larger. If a list is
+            given, the denominators are tried in increasing order, and the first one for
+            which the Q matrices are positive semidefinite and the bound is valid is
+            kept. The R and DR matrices (and the choice of DR columns) are computed only
+            once, for all the denominators. In this case the bound is always checked.
 
          - ``meet_target_bound`` - Boolean (default: True). Determines whether the
            solution should be coerced to meet the target bound. If this is False, then a
@@ -2275,31 +3473,126 @@ class Problem(SageObject):
           - ``diagonalize`` - Boolean (default: True). Whether to diagonalize the Q
              matrices afterwards. If ``meet_target_bound`` is False, the Q matrices are
              always diagonalized.
+
+          - ``workers`` - Integer (default: 1). The number of processes in which to do the
+             per-type work: rounding, and (passed on to ``check_exact_bound`` and
+             ``diagonalize``) the eigenvalue checks, LDL decompositions and verification.
+             The flag bases are also computed in this many processes.
+
+          - ``cache_directory`` - String or None (default: None). A directory in which to
+             cache the flag bases (see ``compute_flag_bases``), so that rerunning a script
+             does not compute them again.
+
+        EXAMPLES:
+
+        To try the denominators 2^10, 2^14, 2^17 and 2^20 in turn:
+
+        sage: problem.make_exact([2^10, 2^14, 2^17, 2^20])
         """
 
+        if isinstance(denominator, (list, tuple)):
+            denominators = sorted(set(denominator))
+            if len(denominators) == 0:
+                raise ValueError("no denominators given.")
+        else:
+            denominators = [denominator]
+
         if meet_target_bound and self.state("set_construction") != "yes":
             meet_target_bound = False
             sys.stdout.write("No target bound to meet.\n")
 
         if meet_target_bound:
-            self.change_solution_bases(use_blocks=use_blocks)
-            num_sharps = len(self._sharp_graphs)
+            self.change_solution_bases(use_blocks=use_blocks, workers=workers, cache_directory=cache_directory)
         else:
             self._sdp_Qdash_matrices = self._sdp_Q_matrices
-            # if non-tight, we don't have a separate diagonalization step
-            self._exact_diagonal_matrices = []
-            self._exact_r_matrices = []
-            num_sharps = 0
 
-        self.state("make_exact", "yes")
+        if protect is None:
+            protect = []
+
+        system = None
+
+        for attempt, denominator in enumerate(denominators):
+
+            final = attempt == len(denominators) - 1
+
+            if len(denominators) > 1:
+                sys.stdout.write("Trying denominator %s.\n" % denominator)
+
+            if not meet_target_bound:
+                # if non-tight, we don't have a separate diagonalization step
+                self._exact_diagonal_matrices = []
+                self._exact_r_matrices = []
+
+            self.state("make_exact", "yes")
+
+            if not self._round_exact_solution(denominator, meet_target_bound, workers):
+                if final:
+                    return
+                continue
+
+            if meet_target_bound:
+
+                self.state("meet_target_bound", "yes")
+
+                if system is None:
+                    system = self._exact_adjustment_system(protect, use_densities, rank)
+
+                try:
+                    self._adjust_exact_solution(system, show_changes)
+                except ValueError:
+                    if final:
+                        if rank is None:
+                            raise ValueError("could not meet bound.")
+                        else:
+                            raise ValueError("could not meet bound (try increasing the value of ``rank``).")
+                    sys.stdout.write("Could not meet bound with denominator %s.\n" % denominator)
+                    continue
+
+            for ti in range(len(self._types)):
+                self._exact_Qdash_matrices[ti].set_immutable()
+
+            if len(denominators) == 1:
+                if check_exact_bound:
+                    self.check_exact_bound(workers=workers)
+                return
+
+            self.check_exact_bound(diagonalize=False, workers=workers)
+
+            if self._exact_bound_is_valid():
+                sys.stdout.write("Denominator %s gives a valid bound.\n" % denominator)
+                if meet_target_bound and diagonalize:
+                    self.diagonalize(workers=workers)
+                return
 
+        sys.stdout.write("None of the denominators gave a valid bound.\n")
+
+    def _exact_bound_is_valid(self):
+        r"""
+        Returns True if ``check_exact_bound`` found the Q matrices and density coefficients
+        to be valid, and (if the solution was adjusted to meet the target bound) no graph
+        violates the target bound.
+        """
+        if self.state("check_exact") != "yes":
+            return False
+        if self.state("meet_target_bound") != "yes":
+            return True
+        if self._field == QQ:
+            bound, target = self._bound, self._target_bound
+        else:
+            bound, target = float(self._bound), float(self._target_bound)
+        return bound >= target if self._minimize else bound <= target
+
+    def _round_exact_solution(self, denominator, meet_target_bound, workers=1):
+        r"""
+        Rounds the Q' matrices and density coefficients of the SDP solution to multiples
+        of 1 / ``denominator``, setting ``_exact_Qdash_matrices`` and
+        ``_exact_density_coeffs``. If ``meet_target_bound`` is False, each matrix is
+        rounded via its Cholesky decomposition. Returns False if a Cholesky decomposition
+        could not be computed.
+        """
         num_types = len(self._types)
-        num_graphs = len(self._graphs)
         num_densities = len(self._densities)
 
-        if protect is None:
-            protect = []
-
         q_sizes = [self._sdp_Qdash_matrices[ti].nrows() for ti in range(num_types)]
 
         def rationalize(f):
@@ -2307,9 +3600,7 @@ class Problem(SageObject):
 
         sys.stdout.write("Rounding matrices")
 
-        self._exact_Qdash_matrices = []
-
-        for ti in range(num_types):
+        def round_type(ti):
 
             if meet_target_bound:
 
@@ -2320,6 +3611,7 @@ class Problem(SageObject):
                         if value != 0:
                             M[j, k] = value
                             M[k, j] = value
+                L = None
 
             else:
 
@@ -2329,22 +3621,34 @@ class Problem(SageObject):
                     # LF = self._sdp_Qdash_matrices[ti].cholesky_decomposition()
                 except numpy.linalg.linalg.LinAlgError:
                 # except ValueError:
-                    sys.stdout.write("Could not compute Cholesky decomposition for type %d.\n" % ti)
-                    return
+                    return None
                 L = matrix(QQ, q_sizes[ti], q_sizes[ti], sparse=True)
                 for j in range(q_sizes[ti]):
                     for k in range(j + 1):  # only lower triangle
                         L[j, k] = rationalize(LF[j, k])
                 L.set_immutable()
                 M = L * L.T
-                if not meet_target_bound:
-                    D = identity_matrix(QQ, q_sizes[ti], sparse=True)
-                    D.set_immutable()
-                    self._exact_diagonal_matrices.append(D)
-                    self._exact_r_matrices.append(L)
-            
+
             row_div = self._sdp_Qdash_matrices[ti].subdivisions()[0]
             M.subdivide(row_div, row_div)
+            return M, L
+
+        self._exact_Qdash_matrices = []
+        self._exact_ldl_factors = None
+
+        for ti, result in enumerate(self._map_types(round_type, range(num_types), workers)):
+
+            if result is None:
+                sys.stdout.write("Could not compute Cholesky decomposition for type %d.\n" % ti)
+                return False
+
+            M, L = result
+            if not meet_target_bound:
+                D = identity_matrix(QQ, q_sizes[ti], sparse=True)
+                D.set_immutable()
+                self._exact_diagonal_matrices.append(D)
+                self._exact_r_matrices.append(L)
+
             self._exact_Qdash_matrices.append(matrix(self._field, M))
             sys.stdout.write(".")
             sys.stdout.flush()
@@ -2363,192 +3667,232 @@ class Problem(SageObject):
             if not j in self._active_densities:
                 self._exact_density_coeffs[j] = Integer(0)
 
-        if meet_target_bound:
-
-            self.state("meet_target_bound", "yes")
+        return True
 
-            triples = [(ti, j, k) for ti in self._active_types for j in range(q_sizes[ti])
-                       for k in range(j, q_sizes[ti])]
+    def _exact_adjustment_system(self, protect, use_densities, rank):
+        r"""
+        Constructs the R matrix, and chooses the columns of the DR matrix: the density
+        coefficients and entries of the Q' matrices that ``make_exact`` will adjust to
+        meet the target bound. None of this depends on the rounding denominator, so it is
+        done once for all the denominators tried. Returns a dictionary, which is passed
+        to ``_adjust_exact_solution``.
+        """
+        num_types = len(self._types)
+        num_densities = len(self._densities)
+        num_sharps = len(self._sharp_graphs)
 
-            num_triples = len(triples)
-            triples.sort()
-            triple_to_index = dict((triples[i], i) for i in range(num_triples))
+        q_sizes = [self._sdp_Qdash_matrices[ti].nrows() for ti in range(num_types)]
 
-            R = matrix(self._field, num_sharps, num_triples, sparse=True)
+        triples = [(ti, j, k) for ti in self._active_types for j in range(q_sizes[ti])
+                   for k in range(j, q_sizes[ti])]
 
-            sys.stdout.write("Constructing R matrix")
+        num_triples = len(triples)
+        triples.sort()
 
-            # TODO: only use triples that correspond to middle blocks.
+        sys.stdout.write("Constructing R matrix")
 
-            for ti in self._active_types:
+        # TODO: only use triples that correspond to middle blocks.
 
-                Ds = [matrix(QQ, len(self._flags[ti]), len(self._flags[ti]))
-                      for si in range(num_sharps)]
-
-                for row in self._product_densities_arrays[ti]:
-                    gi = row[0]
-                    if not gi in self._sharp_graphs:
-                        continue
-                    si = self._sharp_graphs.index(gi)
-                    j = row[1]
-                    k = row[2]
-                    value = Integer(row[3]) / Integer(row[4])
-                    Ds[si][j, k] = value
-                    Ds[si][k, j] = value
-
-                if self.state("transform_solution") == "yes":
-                    B = self._inverse_flag_bases[ti]
-                    for si in range(num_sharps):
-                        Ds[si] = B.T * Ds[si] * B
-
-                for si in range(num_sharps):
-                    for j in range(q_sizes[ti]):
-                        for k in range(j, q_sizes[ti]):
-                            trip = (ti, j, k)
-                            value = Ds[si][j, k]
-                            if j != k:
-                                value *= 2
-                            if self._minimize:
-                                value *= -1
-                            R[si, triple_to_index[trip]] = value
+        R_entries = {}
+        col_offset = 0
+        for ti in sorted(self._active_types):
+            R_entries.update(self._r_matrix_entries(ti, col_offset))
+            col_offset += q_sizes[ti] * (q_sizes[ti] + 1) / 2
+            sys.stdout.write(".")
+            sys.stdout.flush()
+        sys.stdout.write("\n")
 
-                sys.stdout.write(".")
-                sys.stdout.flush()
-            sys.stdout.write("\n")
+        R = matrix(self._field, num_sharps, num_triples, R_entries, sparse=True)
 
-            density_cols_to_use = []
-            DR = matrix(self._field, num_sharps, 0)  # sparsity harms performance too much here
-            EDR = DR.T
+        density_cols_to_use = []
+        DR_columns = []
+        echelon = IncrementalEchelon(self._field, num_sharps)
 
-            sys.stdout.write("Constructing DR matrix")
+        sys.stdout.write("Constructing DR matrix")
 
-            # Only if there is more than one density
-            if num_densities > 1 and use_densities:
+        # Only if there is more than one density
+        if num_densities > 1 and use_densities:
 
-                for j in self._active_densities:
+            for j in self._active_densities:
 
-                    if not rank is None and DR.ncols() == rank:
-                        break
+                if not rank is None and echelon.rank == rank:
+                    break
 
-                    new_col = matrix(QQ, [[self._densities[j][gi]] for gi in self._sharp_graphs])
-                    if new_col.is_zero():
-                        continue
-                    EDR = EDR.stack(new_col.T)
-                    EDR.echelonize()
-                    if EDR[-1, :].is_zero():
-                        EDR = EDR[:-1, :]
-                        sys.stdout.write("~")
-                        sys.stdout.flush()
-                        continue
-
-                    DR = DR.augment(new_col)
-                    density_cols_to_use.append(j)
-                    sys.stdout.write(".")
+                new_col = [self._densities[j][gi] for gi in self._sharp_graphs]
+                if all(x == 0 for x in new_col):
+                    continue
+                if not echelon.add(new_col):
+                    sys.stdout.write("~")
                     sys.stdout.flush()
+                    continue
 
-                sys.stdout.write("\n")
-                sys.stdout.write("DR matrix (density part) has rank %d.\n" % DR.ncols())
+                DR_columns.append(new_col)
+                density_cols_to_use.append(j)
+                sys.stdout.write(".")
+                sys.stdout.flush()
 
-            col_norms = {}
-            for i in range(num_triples):
-                n = sum(x**2 for x in R.column(i))
-                if n != 0:
-                    col_norms[i] = n
+            sys.stdout.write("\n")
+            sys.stdout.write("DR matrix (density part) has rank %d.\n" % echelon.rank)
 
-            # Use columns with greatest non-zero norm - change minus to plus to
-            # use smallest columns (not sure which is best, or maybe middle?)
+        R_columns = R.transpose().rows()
+        col_norms = {}
+        for i in range(num_triples):
+            n = sum(x**2 for x in R_columns[i].dict().values())
+            if n != 0:
+                col_norms[i] = n
 
-            cols_in_order = sorted(col_norms.keys(), key = lambda i : -col_norms[i])
-            cols_to_use = []
+        # Use columns with greatest non-zero norm - change minus to plus to
+        # use smallest columns (not sure which is best, or maybe middle?)
 
-            for i in cols_in_order:
+        cols_in_order = sorted(col_norms.keys(), key = lambda i : -col_norms[i])
+        cols_to_use = []
 
-                if not rank is None and DR.ncols() == rank:
-                    break
+        for i in cols_in_order:
 
-                ti, j, k = triples[i]
-                if ti in protect:  # don't use protected types
-                    continue
-                new_col = R[:, i: i + 1]
-                if new_col.is_zero():
-                    continue
-                EDR = EDR.stack(new_col.T)
-                EDR.echelonize()
-                if EDR[-1, :].is_zero():
-                    EDR = EDR[:-1, :]
-                    sys.stdout.write("~")
-                    sys.stdout.flush()
-                    continue
+            if not rank is None and echelon.rank == rank:
+                break
 
-                DR = DR.augment(new_col)
-                cols_to_use.append(i)
-                sys.stdout.write(".")
+            ti, j, k = triples[i]
+            if ti in protect:  # don't use protected types
+                continue
+            new_col = R_columns[i].list()
+            if not echelon.add(new_col):
+                sys.stdout.write("~")
                 sys.stdout.flush()
+                continue
 
-            sys.stdout.write("\n")
-            sys.stdout.write("DR matrix has rank %d.\n" % DR.ncols())
+            DR_columns.append(new_col)
+            cols_to_use.append(i)
+            sys.stdout.write(".")
+            sys.stdout.flush()
 
-            T = matrix(self._field, num_sharps, 1)
+        if len(DR_columns) > 0:
+            DR = matrix(self._field, DR_columns).T  # sparsity harms performance too much here
+        else:
+            DR = matrix(self._field, num_sharps, 0)
 
-            for si in range(num_sharps):
+        sys.stdout.write("\n")
+        sys.stdout.write("DR matrix has rank %d.\n" % DR.ncols())
+
+        # The entries of R that are not adjusted, for computing the right hand side.
+        unused = set(cols_to_use)
+        fixed_entries = [(si, triples[i], value) for (si, i), value in R.dict().items() if not i in unused]
+
+        return {
+            "triples": triples,
+            "density_cols_to_use": density_cols_to_use,
+            "cols_to_use": cols_to_use,
+            "fixed_entries": fixed_entries,
+            "solver": ExactSolver(DR)
+        }
 
-                gi = self._sharp_graphs[si]
-                T[si, 0] = self._target_bound
+    def _adjust_exact_solution(self, system, show_changes=False):
+        r"""
+        Adjusts the chosen entries of the rounded Q' matrices and density coefficients so
+        that every sharp graph has density exactly equal to the target bound. ``system``
+        is the dictionary returned by ``_exact_adjustment_system``. Raises ValueError if
+        this is not possible.
+        """
+        num_densities = len(self._densities)
+        num_sharps = len(self._sharp_graphs)
+        triples = system["triples"]
+        density_cols_to_use = system["density_cols_to_use"]
+        cols_to_use = system["cols_to_use"]
 
-                for j in range(num_densities):
-                    if not j in density_cols_to_use:
-                        T[si, 0] -= self._exact_density_coeffs[j] * self._densities[j][gi]
+        T = matrix(self._field, num_sharps, 1)
 
-                for i in range(num_triples):
-                    if not i in cols_to_use:
-                        ti, j, k = triples[i]
-                        T[si, 0] -= self._exact_Qdash_matrices[ti][j, k] * R[si, i]
+        for si in range(num_sharps):
 
-            FDR = matrix(self._field, DR)
-            try:
-                X = FDR.solve_right(T)
-            except ValueError:
-                if rank is None:
-                    raise ValueError("could not meet bound.")
-                else:
-                    raise ValueError("could not meet bound (try increasing the value of ``rank``).")
-
-            RX = matrix(self._approximate_field, X.nrows(), 1)
-
-            for i in range(len(density_cols_to_use)):
-                di = density_cols_to_use[i]
-                RX[i, 0] = self._exact_density_coeffs[di]
-                self._exact_density_coeffs[di] = X[i, 0]
-
-            for i in range(len(density_cols_to_use), X.nrows()):
-                ti, j, k = triples[cols_to_use[i - len(density_cols_to_use)]]
-                RX[i, 0] = self._sdp_Qdash_matrices[ti][j, k]
-                self._exact_Qdash_matrices[ti][j, k] = X[i, 0]
-                self._exact_Qdash_matrices[ti][k, j] = X[i, 0]
-
-            if show_changes:
-                for i in range(X.nrows()):
-                    sys.stdout.write("%.11s -> %.11s " % (RX[i,0], RDF(X[i,0])))
-                    if i < len(density_cols_to_use):
-                        sys.stdout.write("(density %d)\n" % density_cols_to_use[i])
-                    else:
-                        sys.stdout.write("(matrix %d, entry [%d, %d])\n" % triples[cols_to_use[i - len(density_cols_to_use)]])
+            gi = self._sharp_graphs[si]
+            T[si, 0] = self._target_bound
 
-        for ti in range(num_types):
-            self._exact_Qdash_matrices[ti].set_immutable()
+            for j in range(num_densities):
+                if not j in density_cols_to_use:
+                    T[si, 0] -= self._exact_density_coeffs[j] * self._densities[j][gi]
+
+        for si, (ti, j, k), value in system["fixed_entries"]:
+            T[si, 0] -= self._exact_Qdash_matrices[ti][j, k] * value
+
+        X = system["solver"].solve_right(T)
 
-        if check_exact_bound:
-            self.check_exact_bound()
+        RX = matrix(self._approximate_field, X.nrows(), 1)
 
-    def check_exact_bound(self, diagonalize=True):
+        for i in range(len(density_cols_to_use)):
+            di = density_cols_to_use[i]
+            RX[i, 0] = self._exact_density_coeffs[di]
+            self._exact_density_coeffs[di] = X[i, 0]
+
+        for i in range(len(density_cols_to_use), X.nrows()):
+            ti, j, k = triples[cols_to_use[i - len(density_cols_to_use)]]
+            RX[i, 0] = self._sdp_Qdash_matrices[ti][j, k]
+            self._exact_Qdash_matrices[ti][j, k] = X[i, 0]
+            self._exact_Qdash_matrices[ti][k, j] = X[i, 0]
+
+        if show_changes:
+            for i in range(X.nrows()):
+                sys.stdout.write("%.11s -> %.11s " % (RX[i,0], RDF(X[i,0])))
+                if i < len(density_cols_to_use):
+                    sys.stdout.write("(density %d)\n" % density_cols_to_use[i])
+                else:
+                    sys.stdout.write("(matrix %d, entry [%d, %d])\n" % triples[cols_to_use[i - len(density_cols_to_use)]])
+
+    def _r_matrix_entries(self, ti, col_offset):
+        r"""
+        Returns the entries of the R matrix used by ``make_exact`` for type ``ti``, as a
+        dictionary. Row si of R holds the coefficients of the upper triangle of Q' (for
+        type ti, starting at column ``col_offset``) in the density of sharp graph si; that
+        is, the upper triangle of B^T P B, where P is the matrix of flag products for the
+        sharp graph, and B is ``_inverse_flag_bases[ti]`` if the solution was transformed.
+
+        The products of all the sharp graphs are put side by side in one sparse matrix H, so
+        that B^T H (I x B) gives every B^T P B at once.
+        """
+        num_sharps = len(self._sharp_graphs)
+        if num_sharps == 0:
+            return {}
+        nf = len(self._flags[ti])
+        transformed = self.state("transform_solution") == "yes"
+        q = self._inverse_flag_bases[ti].ncols() if transformed else nf
+
+        sharp_index = -numpy.ones(len(self._graphs), dtype=numpy.int64)
+        sharp_index[self._sharp_graphs] = numpy.arange(num_sharps)
+        rarray = self._product_densities_arrays[ti]
+        values = self._product_coefficients(ti, "rationals")
+        if len(rarray) > 0:
+            keep = sharp_index[rarray[:, 0]] >= 0
+            rarray, values = rarray[keep], values[keep]
+        sis = sharp_index[rarray[:, 0]] if len(rarray) > 0 else []
+
+        if not transformed:
+            Ps = [((si, row[1], row[2]), value) for si, row, value in zip(sis, rarray, values)]
+        else:
+            H = {}
+            for si, row, value in zip(sis, rarray, values):
+                j, k = row[1], row[2]
+                H[(j, si * nf + k)] = H[(k, si * nf + j)] = value
+            H = matrix(self._field, nf, num_sharps * nf, H, sparse=True)
+            B = self._inverse_flag_bases[ti]
+            Z = B.T * (H * block_diagonal_matrix([B] * num_sharps, sparse=True))
+            Ps = [((c // q, j, c % q), value) for (j, c), value in Z.dict().items() if j <= c % q]
+
+        sign = -1 if self._minimize else 1
+        entries = {}
+        for (si, j, k), value in Ps:
+            si, j, k = int(si), int(j), int(k)
+            col = col_offset + j * q - j * (j - 1) / 2 + k - j
+            entries[(si, col)] = sign * value if j == k else 2 * sign * value
+        return entries
+
+    def check_exact_bound(self, diagonalize=True, workers=1):
         r"""
         Usually called by ``make_exact``. If the solution was transformed, then computes
         the Q matrices from the Q' matrices. If the solution was adjusted to meet the
-        target bound, the Q matrices are checked (numerically) for negative eigenvalues.
-        In all cases the bound is checked.
+        target bound, the Q' matrices are checked to be positive semidefinite (see
+        ``certify_psd``); over QQ this is proved by an exact LDL decomposition, which is
+        kept for ``diagonalize``. In all cases the bound is checked.
 
         If ``diagonalize`` is set to True, then ``diagonalize`` will be called at the
-        end.
+        end. The per-type work is done in ``workers`` processes.
         """
         num_types = len(self._types)
         num_graphs = len(self._graphs)
@@ -2564,56 +3908,64 @@ class Problem(SageObject):
         # If we didn't try to meet the target bound, then the method of rounding is_exact
         # guaranteed to produce positive-semidefinite matrices.
         if self.state("meet_target_bound") == "yes":
+            def certify(ti):
+                return certify_psd(self._exact_Qdash_matrices[ti])
+
+            sys.stdout.write("Checking matrices are positive semidefinite")
+
+            self._exact_ldl_factors = [None] * num_types
             negative_types = []
-            very_small_types = []
-            for ti in self._active_types:
-                if self._exact_Qdash_matrices[ti].nrows() > 0:
-                    eigvals = sorted(numpy.linalg.eigvalsh(self._exact_Qdash_matrices[ti]))
-                    if eigvals[0] < 0.0:
-                        negative_types.append(ti)
-                    elif eigvals[0] < 1e-6:
-                        very_small_types.append(ti)
+            for ti, factors in zip(self._active_types, self._map_types(certify, self._active_types, workers)):
+                if factors is None:
+                    negative_types.append(ti)
+                else:
+                    self._exact_ldl_factors[ti] = factors
+                sys.stdout.write(".")
+                sys.stdout.flush()
+            sys.stdout.write("\n")
 
             if len(negative_types) > 0:
                 sys.stdout.write("Warning! Types %s have negative eigenvalues, so the bound is not valid.\n" % negative_types)
                 return
-            sys.stdout.write("All eigenvalues appear to be positive.\n")
-            if len(very_small_types) > 0:
-                sys.stdout.write("Types %s have very small eigenvalues (but this is probably OK).\n" % very_small_types)
+            if self._field == QQ:
+                sys.stdout.write("All matrices are positive semidefinite (exact LDL decompositions found).\n")
+            else:
+                sys.stdout.write("All eigenvalues appear to be positive.\n")
 
         self.state("check_exact", "yes")
 
         self._exact_Q_matrices = []
 
         if self.state("transform_solution") == "yes":
-            for ti in range(num_types):
+            def transform(ti):
                 B = self._inverse_flag_bases[ti]
-                M = B * self._exact_Qdash_matrices[ti] * B.T
-                self._exact_Q_matrices.append(M)
+                return B * self._exact_Qdash_matrices[ti] * B.T
+            self._exact_Q_matrices = list(self._map_types(transform, range(num_types), workers))
         else:
             self._exact_Q_matrices = self._exact_Qdash_matrices
 
-        bounds = [sum([self._densities[j][i] * self._exact_density_coeffs[j]
-                  for j in range(num_densities)]) for i in range(num_graphs)]
-
-        for ti in self._active_types:
-            for row in self._product_densities_arrays[ti]:
-                gi, j, k, numer, denom = row
-                d = Integer(numer) / Integer(denom)
-                value = self._exact_Q_matrices[ti][j, k]
-                if j != k:
-                    value *= 2
-                if not self._minimize:
-                    bounds[gi] += d * value
-                else:
-                    bounds[gi] -= d * value
-
         if self._field == QQ:
+            numerators, denominator = self._exact_bound_numerators()
+            bounds = [Integer(n) / denominator for n in numerators]
             if not self._minimize:
-                bound = max(bounds)
+                bound = bounds[max(range(num_graphs), key=lambda gi: numerators[gi])]
             else:
-                bound = min(bounds)
+                bound = bounds[min(range(num_graphs), key=lambda gi: numerators[gi])]
         else:
+            bounds = [sum([self._densities[j][i] * self._exact_density_coeffs[j]
+                      for j in range(num_densities)]) for i in range(num_graphs)]
+
+            for ti in self._active_types:
+                for row, d in zip(self._product_densities_arrays[ti], self._product_coefficients(ti, "rationals")):
+                    gi, j, k = row[:3]
+                    value = self._exact_Q_matrices[ti][j, k]
+                    if j != k:
+                        value *= 2
+                    if not self._minimize:
+                        bounds[gi] += d * value
+                    else:
+                        bounds[gi] -= d * value
+
             # Sorting doesn't currently work for number fields with embeddings, so use float approximation.
             # TODO: Check if Sage 5.0 fixes this.
             if not self._minimize:
@@ -2629,23 +3981,28 @@ class Problem(SageObject):
             return
 
         if self._field == QQ:
+            # compare numerator * target denominator with target numerator * denominator
+            target = QQ(self._target_bound)
+            scaled_target = int(target.numerator() * denominator)
+            td = int(target.denominator())
             if not self._minimize:
-                violators = [gi for gi in range(num_graphs) if bounds[gi] > self._target_bound]
+                violators = [gi for gi in range(num_graphs) if numerators[gi] * td > scaled_target]
             else:
-                violators = [gi for gi in range(num_graphs) if bounds[gi] < self._target_bound]
+                violators = [gi for gi in range(num_graphs) if numerators[gi] * td < scaled_target]
+            sharp = [gi for gi in range(num_graphs) if numerators[gi] * td == scaled_target]
         else:
             if not self._minimize:
                 violators = [gi for gi in range(num_graphs) if float(bounds[gi]) > float(self._target_bound)]
             else:
                 violators = [gi for gi in range(num_graphs) if float(bounds[gi]) < float(self._target_bound)]
+            sharp = [gi for gi in range(num_graphs) if bounds[gi] == self._target_bound]
 
         sys.stdout.write("Bound of %s attained by:\n" % self._target_bound)
         unexpectedly_sharp = []
-        for gi in range(num_graphs):
-            if bounds[gi] == self._target_bound:
-                sys.stdout.write("%s : graph %d (%s)\n" % (bounds[gi], gi, self._graphs[gi]))
-                if not gi in self._sharp_graphs:
-                    unexpectedly_sharp.append(gi)
+        for gi in sharp:
+            sys.stdout.write("%s : graph %d (%s)\n" % (bounds[gi], gi, self._graphs[gi]))
+            if not gi in self._sharp_graphs:
+                unexpectedly_sharp.append(gi)
 
         if len(unexpectedly_sharp) > 0:
             sys.stdout.write("Warning: the following graphs unexpectedly attain the bound: %s\n"
@@ -2657,15 +4014,74 @@ class Problem(SageObject):
                 sys.stdout.write("%s : graph %d (%s)\n" % (bounds[gi], gi, self._graphs[gi]))
 
         if diagonalize:
-            self.diagonalize()
+            self.diagonalize(workers=workers)
+
+    def _exact_bound_numerators(self):
+        r"""
+        Computes the bounds given by the exact solution for every graph, when the field is
+        QQ, without any fraction arithmetic: the density coefficients, Q matrices and flag
+        products are each scaled to integers by a common denominator, and the bounds are
+        computed with integer matrices and arrays of Python integers. Returns a list of the
+        numerators of the bounds, and their common denominator.
+        """
+        num_graphs = len(self._graphs)
+
+        # the densities part: an integer (FLINT) matrix-vector product
+        D = matrix(QQ, self._densities).T
+        coeffs = vector(QQ, self._exact_density_coeffs)
+        d_den, c_den = D.denominator(), coeffs.denominator()
+        density_part = matrix(ZZ, D * d_den) * vector(ZZ, coeffs * c_den)
+        density_den = d_den * c_den
+
+        # the products part: sum of numer / denom * Q[j, k] (twice for j != k) for each graph
+        q_den = Integer(1)
+        p_den = Integer(1)
+        for ti in self._active_types:
+            q_den = q_den.lcm(self._exact_Q_matrices[ti].denominator())
+            for d in numpy.unique(self._product_coefficients(ti, "denominators")):
+                p_den = p_den.lcm(int(d))
 
-    def diagonalize(self):
+        gis, values = [], []
+        for ti in self._active_types:
+            rarray = self._product_densities_arrays[ti]
+            if len(rarray) == 0:
+                continue
+            Q = self._exact_Q_matrices[ti]
+            Qz = numpy.array([int(x) for x in (Q * q_den).list()], dtype=object).reshape(Q.nrows(), Q.ncols())
+            denoms, inverse = numpy.unique(self._product_coefficients(ti, "denominators"), return_inverse=True)
+            factors = numpy.array([int(p_den // int(d)) for d in denoms], dtype=object)[inverse]
+            js, ks = rarray[:, 1], rarray[:, 2]
+            gis.append(rarray[:, 0])
+            values.append(self._product_coefficients(ti, "numerators").astype(object) * factors * numpy.where(js != ks, 2, 1).astype(object)
+                          * Qz[js, ks])
+
+        product_part = numpy.zeros(num_graphs, dtype=object)
+        if len(gis) > 0:
+            gis, values = numpy.concatenate(gis), numpy.concatenate(values)
+            order = numpy.argsort(gis, kind="mergesort")
+            gis, values = gis[order], values[order]
+            starts = numpy.flatnonzero(numpy.concatenate([[True], gis[1:] != gis[:-1]]))
+            product_part[gis[starts]] = numpy.add.reduceat(values, starts)
+
+        denominator = Integer(density_den).lcm(p_den * q_den)
+        density_scale = int(denominator // density_den)
+        product_scale = int(denominator // (p_den * q_den))
+        sign = -1 if self._minimize else 1
+
+        numerators = [int(density_part[gi]) * density_scale + sign * product_part[gi] * product_scale
+                      for gi in range(num_graphs)]
+        return numerators, denominator
+
+    def diagonalize(self, workers=1):
         r"""
         For each matrix Q, produces a matrix R and a diagonal matrix M such that
         Q = R * M * R.T, where R.T denotes the transpose of R. Usually called from
         ``make_exact``. Note that if the solution has not been adjusted to meet a target
         bound, a simpler method of rounding is performed, and diagonalization is done
         at the same time.
+
+        Each type is decomposed and verified separately, in ``workers`` processes. The
+        exact LDL decompositions found by ``check_exact_bound`` are reused.
         """
 
         self.state("diagonalize", "yes")
@@ -2673,26 +4089,26 @@ class Problem(SageObject):
         self._exact_diagonal_matrices = []
         self._exact_r_matrices = []
 
-        sys.stdout.write("Diagonalizing")
+        transformed = self.state("transform_solution") == "yes"
+        ldl_factors = getattr(self, "_exact_ldl_factors", None)
 
-        for ti in range(len(self._types)):
-            R, M = LDLdecomposition(self._exact_Qdash_matrices[ti])
-            self._exact_diagonal_matrices.append(M)
-            if self.state("transform_solution") == "yes":
+        def decompose(ti):
+            if not ldl_factors is None and not ldl_factors[ti] is None and not ldl_factors[ti][0] is None:
+                R, M = ldl_factors[ti]  # found by check_exact_bound
+            else:
+                R, M = LDLdecomposition(self._exact_Qdash_matrices[ti])
+            if transformed:
                 R = self._inverse_flag_bases[ti] * R
-            self._exact_r_matrices.append(R)
-            sys.stdout.write(".")
-            sys.stdout.flush()
-        sys.stdout.write("\n")
-
-        # Q can now be computed as Q = R * M * R.T
+            # Q can now be computed as Q = R * M * R.T
+            return R, M, ldl_product_equals(R, M, self._exact_Q_matrices[ti])
 
-        sys.stdout.write("Verifying")
+        sys.stdout.write("Diagonalizing and verifying")
 
-        for ti in range(len(self._types)):
-            Q = self._exact_r_matrices[ti] * self._exact_diagonal_matrices[ti] * self._exact_r_matrices[ti].T
-            if Q != self._exact_Q_matrices[ti]:
-                raise ValueError  # TODO: choose appropriate error
+        for ti, (R, M, verified) in enumerate(self._map_types(decompose, range(len(self._types)), workers)):
+            if not verified:
+                raise ValueError  # TODO: choose appropriate error
+            self._exact_diagonal_matrices.append(M)
+            self._exact_r_matrices.append(R)
             sys.stdout.write(".")
             sys.stdout.flush()
         sys.stdout.write("\n")
@@ -3120,26 +4536,19 @@ class Problem(SageObject):
             print tgraph, "is uniquely embeddable into", fgraph, "and different vertices of", fgraph, "attach differently to", tgraph+".\n"
 
         # --------- CLAIM 1 ----------
-        self.forbid(tgraph)
-        # reset states
-        for state_name, state_value in self._states.items():
-            if state_name == 'specify':
-                self._states[state_name] = "yes"
-            else:
-                self._states[state_name] = "no"
-        self.generate_flags(order=self._n)
-        self.write_sdp_input_file()
-        self.solve_sdp(import_solution_file=None)
-        self.make_exact()
+        # re-use graphs, flags and products, rather than generating from scratch
+        newproblem = self.derive(forbid=tgraph)
+        newproblem.solve_sdp(import_solution_file=None)
+        newproblem.make_exact()
 
         if not self._minimize:
-            if self._bound < thebound:
-                print "Forbidding", Tgraph, "yields a bound of", self._bound, "which is strictly less than", str(thebound)+"."
+            if newproblem._bound < thebound:
+                print "Forbidding", Tgraph, "yields a bound of", newproblem._bound, "which is strictly less than", str(thebound)+"."
                 claim1 = True
 
         if self._minimize:
-            if self._bound > thebound:
-                print "Forbidding", Tgraph, "yields a bound of", self._bound, "which is strictly more than", str(thebound)+"."
+            if newproblem._bound > thebound:
+                print "Forbidding", Tgraph, "yields a bound of", newproblem._bound, "which is strictly more than", str(thebound)+"."
                 claim1 = True
             
 
@@ -3155,7 +4564,7 @@ class Problem(SageObject):
         if claim1 and claim2 and claim3 and claim4:
             self._stable = True
             print "\nOooh la la - early Christmas! The problem is stable!\n"
-            self.write_certificate("cert2.js")
+            newproblem.write_certificate("cert2.js")
             print "Certificates written into 'cert1.js' and 'cert2.js'."
         return
         
@@ -3449,17 +4858,7 @@ class Problem(SageObject):
         newproblem = None
         
         if Tgraph.n > 1:
-            newproblem = GraphProblem(order=self._n,
-                                       forbid_induced=self._forbidden_induced_graphs+[tgraph],
-                                       forbid=self._forbidden_graphs,
-                                       forbid_homomorphic_images=self._forbid_homomorphic_images,
-                                       density=self._density_graphs[0],
-                                       minimize=self._minimize,
-                                       type_orders=self._type_orders,
-                                       types=self._types_from_input,
-                                       max_flags=self._max_flags,
-                                       compute_products=self._compute_products,
-                                       mode=self._mode)
+            newproblem = self.derive(forbid_induced=tgraph)
 
             """
             # NOTE: this used to be here instead of above before correction!!
@@ -3666,17 +5065,7 @@ class Problem(SageObject):
 
 
         original_bound = self._bound
-        perfstabproblem = GraphProblem(order=self._n,
-                                  forbid_induced=self._forbidden_induced_graphs+[str(Fgraph)],
-                                  forbid=self._forbidden_graphs,
-                                  forbid_homomorphic_images=self._forbid_homomorphic_images,
-                                  density=self._density_graphs[0],
-                                  minimize=self._minimize,
-                                  type_orders=self._type_orders,
-                                  types=self._types_from_input,
-                                  max_flags=self._max_flags,
-                                  compute_products=self._compute_products,
-                                  mode=self._mode)
+        perfstabproblem = self.derive(forbid_induced=str(Fgraph))
         
         perfstabproblem.solve_sdp(solver="csdp")
         perfstabproblem.make_exact()
@@ -0,0 +1,1527 @@
+"""
+
+flagmatic 2
+
+Copyright (c) 2012, E. R. Vaughan. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1) Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+
+2) Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation and/or
+other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+Further development of Flagmatic is supported by ERC.
+http://cordis.europa.eu/project/rcn/104324_en.html
+"""
+
+import gzip
+import os
+import pty
+import re
+import resource
+import select
+import signal
+import sys
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy
+from copy import copy
+from distutils.spawn import find_executable
+from fractions import Fraction
+
+# The module's state (the solver commands, solver_slot and so on) is not exported, as
+# it must be changed here, as sdp.solver_slot for instance, to have any effect.
+__all__ = ["external_solvers", "BlockSparseSDP", "decimal_strings", "SDPSolution",
+           "strictly_feasible", "SDPBackend", "solver_command", "write_solver_parameters",
+           "parse_objective_value", "solver_succeeded", "solver_available", "SolverIteration",
+           "parse_iteration", "SolverMonitor", "SolverLimits", "SolverTelemetry",
+           "SolverLimitExceeded", "run_external_solver", "race_external_solvers",
+           "remember_solver", "preferred_solver_order", "read_sdpa_output_file",
+           "read_sdp_solution_file", "ExternalSolverBackend", "InteriorPointBackend",
+           "sdp_backend"]
+
+# The SDP solvers have to be in a directory in $PATH.
+
+cdsp_cmd = "csdp"
+sdpa_cmd = "sdpa"
+sdpa_dd_cmd = "sdpa_dd"
+sdpa_qd_cmd = "sdpa_qd"
+dsdp_cmd = "dsdp"
+
+external_solvers = ["csdp", "sdpa", "sdpa_dd", "sdpa_qd", "dsdp"]
+
+# If not None, an object with acquire() and release() methods, which is held while an
+# external solver runs. BatchRunner uses this to limit the number of solvers run at once.
+# acquire(count) asks for a slot for each of count solvers, waits for at least one, and
+# returns how many were granted; release() gives them all back.
+solver_slot = None
+
+# If not None, the SolverLimits used for external solvers when none are given.
+# BatchRunner uses this to limit the memory of the solvers that its jobs run.
+default_solver_limits = None
+
+
+class BlockSparseSDP(object):
+    r"""
+    A semi-definite program in the form used by CSDP:
+
+        maximize tr(C X) subject to tr(A_i X) = b_i for 1 <= i <= m, X >= 0,
+
+    with dual
+
+        minimize b.y subject to sum_i y_i A_i - C = Z >= 0.
+
+    X, Z, C and the A_i are block diagonal. ``block_sizes`` follows the SDPA
+    convention: a negative size means that the block is diagonal.
+
+    The nonzero entries of C and the A_i are held as parallel numpy arrays:
+    ``matrices`` (0 for C, i for A_i), ``blocks`` (0-based), ``rows`` and ``cols``
+    (0-based, with rows <= cols) and ``values``. Entries with the same (matrix, block,
+    row, col) are summed.
+
+    If ``denominators`` is given, then the entries are rational: ``values`` holds their
+    numerators, and both arrays should contain integers. The exact values are kept in
+    ``numerators`` and ``denominators`` so that the SDP can be written out to any
+    precision; ``values`` is always the float64 approximation.
+    """
+
+    def __init__(self, b, block_sizes, matrices, blocks, rows, cols, values, denominators=None):
+
+        self.b = numpy.asarray(b, dtype=numpy.float64)
+        self.block_sizes = [int(bs) for bs in block_sizes]
+        self.matrices = numpy.asarray(matrices, dtype=numpy.int64)
+        self.blocks = numpy.asarray(blocks, dtype=numpy.int64)
+        self.rows = numpy.asarray(rows, dtype=numpy.int64)
+        self.cols = numpy.asarray(cols, dtype=numpy.int64)
+
+        if denominators is None:
+            self.numerators, self.denominators = None, None
+            self.values = numpy.asarray(values, dtype=numpy.float64)
+        else:
+            self.numerators = numpy.asarray(values, dtype=object)
+            self.denominators = numpy.asarray(denominators, dtype=object)
+            self.values = (self.numerators.astype(numpy.float64)
+                           / self.denominators.astype(numpy.float64))
+
+        swap = self.rows > self.cols
+        if swap.any():
+            self.rows[swap], self.cols[swap] = self.cols[swap], self.rows[swap].copy()
+
+    @classmethod
+    def read(cls, filename):
+        r"""
+        Reads an SDP from a file in SDPA sparse format (such as one written by ``write``).
+        The values are read as doubles.
+        """
+        opener = gzip.open if filename.endswith(".gz") else open
+        with opener(filename, "rb") as f:
+            lines = [line for line in f.read().splitlines()
+                     if line.strip() != "" and not line.lstrip()[:1] in ["*", '"']]
+
+        header = [re.sub(r"[,{}()]", " ", line).split() for line in lines[:4]]
+        num_constraints, num_blocks = int(header[0][0]), int(header[1][0])
+        block_sizes = [int(bs) for bs in header[2][:num_blocks]]
+        b = numpy.array(header[3][:num_constraints], dtype=numpy.float64)
+
+        entries = [line.split() for line in lines[4:]]
+        if any(len(entry) != 5 for entry in entries):
+            raise ValueError("malformed SDPA input file.")
+        data = numpy.array(entries, dtype=numpy.float64).reshape(-1, 5)
+        ints = data[:, :4].astype(numpy.int64)
+
+        return cls(b, block_sizes, ints[:, 0], ints[:, 1] - 1, ints[:, 2] - 1, ints[:, 3] - 1,
+                   data[:, 4])
+
+    def residuals(self, solution):
+        r"""
+        Returns the relative primal and dual infeasibilities of the SDPSolution
+        ``solution``: the norms of b - (tr(A_i X))_i and of sum_i y_i A_i - C - Z, divided
+        by 1 + the norm of b and 1 + the norm of C respectively.
+        """
+        (mats, blocks, rows, cols), values = self._merged_entries()
+        m = self.num_constraints
+        twice = numpy.where(rows == cols, 1.0, 2.0)
+
+        x = numpy.zeros(len(values))
+        for bi in range(self.num_blocks):
+            sel = blocks == bi
+            x[sel] = solution.X[bi][rows[sel], cols[sel]]
+        AX = numpy.bincount(mats, weights=values * twice * x, minlength=m + 1)[1:]
+        primal = numpy.linalg.norm(self.b - AX) / (1.0 + numpy.linalg.norm(self.b))
+
+        coefficients = numpy.append(-1.0, numpy.asarray(solution.y, dtype=numpy.float64))[mats]
+        squares = 0.0
+        for bi in range(self.num_blocks):
+            sel = blocks == bi
+            R = -numpy.array(solution.Z[bi], dtype=numpy.float64)
+            numpy.add.at(R, (rows[sel], cols[sel]), coefficients[sel] * values[sel])
+            off = sel & (rows != cols)
+            numpy.add.at(R, (cols[off], rows[off]), coefficients[off] * values[off])
+            squares += numpy.sum(R * R)
+        c_norm = numpy.sqrt(numpy.sum((twice * values * values)[mats == 0]))
+        dual = numpy.sqrt(squares) / (1.0 + c_norm)
+
+        return primal, dual
+
+    @property
+    def num_constraints(self):
+        return len(self.b)
+
+    @property
+    def num_blocks(self):
+        return len(self.block_sizes)
+
+    def _merged_entries(self, exact=False):
+        # Sorts the entries, sums those with the same position, and drops zeros. If exact
+        # is True, the values are returned as (numerators, denominators).
+
+        order = numpy.lexsort((self.cols, self.rows, self.blocks, self.matrices))
+        keys = [a[order] for a in (self.matrices, self.blocks, self.rows, self.cols)]
+
+        new_group = numpy.ones(len(order), dtype=bool)
+        if len(order) > 0:
+            new_group[1:] = numpy.any([k[1:] != k[:-1] for k in keys], axis=0)
+        starts = numpy.flatnonzero(new_group)
+        keys = [k[starts] for k in keys]
+
+        if not exact:
+            values = numpy.add.reduceat(self.values[order], starts) if len(order) > 0 else self.values
+            nonzero = values != 0
+            return [k[nonzero] for k in keys], values[nonzero]
+
+        numerators = self.numerators[order][starts]
+        denominators = self.denominators[order][starts]
+        counts = numpy.diff(numpy.append(starts, len(order)))
+        for gi in numpy.flatnonzero(counts > 1):
+            total = sum((Fraction(int(self.numerators[i]), int(self.denominators[i]))
+                         for i in order[starts[gi]:starts[gi] + counts[gi]]), Fraction(0))
+            numerators[gi], denominators[gi] = total.numerator, total.denominator
+        nonzero = numerators != 0
+        return [k[nonzero] for k in keys], (numerators[nonzero], denominators[nonzero])
+
+    def write(self, f, digits=None, buffer_size=65536):
+        r"""
+        Writes the SDP in SDPA sparse format. Entries in the same position are merged.
+
+        INPUT:
+
+         - ``f`` - a filename or a file object. If a filename ending in ".gz" is given, the
+           output is gzip-compressed. A file object can be a pipe to another process.
+
+         - ``digits`` - Integer or None (default: None). If None, the values are written
+           as doubles (this is all that CSDP, SDPA and DSDP read). Otherwise, the exact
+           rational values (if known) are rounded to this many decimal places, for the
+           extended precision solvers.
+
+         - ``buffer_size`` - Integer (default: 65536). The number of entries that are
+           formatted before each write.
+        """
+        if isinstance(f, basestring):
+            opener = gzip.open if f.endswith(".gz") else open
+            with opener(f, "wb") as g:
+                self.write(g, digits=digits, buffer_size=buffer_size)
+            return
+
+        exact = not digits is None and not self.numerators is None
+        keys, values = self._merged_entries(exact=exact)
+        keys = [k + 1 for k in keys]
+        keys[0] -= 1  # matrix 0 is C
+
+        if exact:
+            strings = decimal_strings(values[0], values[1], digits)
+        else:
+            strings = [repr(float(v)) for v in values] if digits is None else \
+                      ["%.*g" % (digits, v) for v in values]
+
+        f.write("%d\n" % self.num_constraints)
+        f.write("%d\n" % self.num_blocks)
+        f.write(" ".join("%d" % bs for bs in self.block_sizes) + "\n")
+        f.write(" ".join(repr(float(x)) for x in self.b) + "\n")
+
+        columns = [k.tolist() for k in keys]
+        for i in range(0, len(strings), buffer_size):
+            f.write("".join("%d %d %d %d %s\n" % entry for entry in
+                    zip(*[c[i:i + buffer_size] for c in columns + [strings]])))
+
+
+def decimal_strings(numerators, denominators, digits):
+    r"""
+    Returns a list of decimal strings for the rationals ``numerators[i] / denominators[i]``,
+    correctly rounded to ``digits`` decimal places. The arithmetic is done on whole numpy
+    object arrays of integers.
+    """
+    numerators = numpy.asarray(numerators, dtype=object)
+    denominators = numpy.asarray(denominators, dtype=object)
+    negative = (numerators < 0) != (denominators < 0)
+    scale = 10 ** digits
+    q = (2 * abs(numerators) * scale + abs(denominators)) // (2 * abs(denominators))
+    whole, fraction = q // scale, q % scale
+    signs = numpy.where(negative & (q != 0), "-", "")
+    return ["%s%d.%0*d" % (s, w, digits, r) for s, w, r in zip(signs, whole, fraction)]
+
+
+class SDPSolution(object):
+    r"""
+    The result of solving a BlockSparseSDP. ``X`` and ``Z`` are lists of numpy arrays,
+    one for each block (diagonal blocks are given as square arrays too), and ``y`` is a
+    numpy array. ``primal_objective`` is tr(C X) and ``dual_objective`` is b.y.
+    """
+
+    def __init__(self, X, y, Z, primal_objective=None, dual_objective=None, status=0,
+                 iterations=None, output=""):
+
+        self.X = X
+        self.y = y
+        self.Z = Z
+        self.primal_objective = primal_objective
+        self.dual_objective = dual_objective
+        self.status = status
+        self.iterations = iterations
+        self.output = output
+
+    def write_initial_point(self, filename):
+        r"""
+        Writes the solution as an initial point file, in the format read by CSDP (and by
+        SDPA with its -is option): y on the first line, followed by the entries of Z
+        (matrix 1) and X (matrix 2).
+        """
+        with open(filename, "w") as f:
+            f.write(" ".join(repr(float(v)) for v in self.y) + "\n")
+            for mi, matrices in ((1, self.Z), (2, self.X)):
+                for bi in range(len(matrices)):
+                    M = matrices[bi]
+                    rows, cols = numpy.nonzero(numpy.triu(M))
+                    f.write("".join("%d %d %d %d %r\n" % (mi, bi + 1, j + 1, k + 1, float(M[j, k]))
+                                    for j, k in zip(rows.tolist(), cols.tolist())))
+
+
+def strictly_feasible(matrices, margin=1e-3):
+    r"""
+    Returns copies of the symmetric matrices ``matrices``, with a multiple of the identity
+    added to each where necessary so that its smallest eigenvalue is at least ``margin``
+    times the largest absolute eigenvalue (or ``margin``, if that is larger). This turns
+    a solution of a nearby SDP into an interior starting point.
+    """
+    result = []
+    for M in matrices:
+        M = 0.5 * (M + M.T)
+        if M.shape[0] == 0:
+            result.append(M)
+            continue
+        eigenvalues = numpy.linalg.eigvalsh(M)
+        target = margin * max(1.0, numpy.max(numpy.abs(eigenvalues)))
+        if eigenvalues[0] < target:
+            M = M + (target - eigenvalues[0]) * numpy.eye(M.shape[0])
+        result.append(M)
+    return result
+
+
+class SDPBackend(object):
+    r"""
+    Base class for SDP solvers. Subclasses implement ``solve``, which takes a
+    BlockSparseSDP and returns an SDPSolution. If a SolverMonitor is given, it is
+    told about each iteration, and the solve is abandoned (raising ValueError) if
+    the monitor asks for it to be stopped. ``initial_point`` is an SDPSolution to
+    start from, if the solver supports it; it should be strictly feasible (see
+    ``strictly_feasible``).
+    """
+
+    name = None
+
+    def solve(self, sdp, show_output=False, monitor=None, initial_point=None):
+        raise NotImplementedError
+
+
+def solver_command(solver, input_filename, initial_point_filename=None, max_gap=None):
+    r"""
+    Returns the command line that runs ``solver`` on ``input_filename``, and the name
+    of the output file it writes (in its working directory). DSDP does not read an
+    initial point file, so ``initial_point_filename`` is ignored for it.
+
+    If ``max_gap`` is given, the solver stops once its relative duality gap is below it.
+    CSDP and SDPA read this from a parameter file in their working directory, which
+    must be written with ``write_solver_parameters``.
+    """
+    if solver == "csdp":
+        cmd = "%s %s sdp.out" % (cdsp_cmd, input_filename)
+
+        if not initial_point_filename is None:
+            cmd += " %s" % initial_point_filename
+
+        return cmd, "sdp.out"
+
+    elif solver == "dsdp":
+        gaptol = 1e-18 if max_gap is None else float(max_gap)
+        return "%s %s -gaptol %r -print 1 -save sdp.out" % (dsdp_cmd, input_filename, gaptol), "sdp.out"
+
+    elif solver == "sdpa":
+        cmd = "%s -ds %s -o sdpa.out" % (sdpa_cmd, input_filename)
+
+    elif solver == "sdpa_dd":
+        cmd = "%s -ds %s -o sdpa.out" % (sdpa_dd_cmd, input_filename)
+
+    elif solver == "sdpa_qd":
+        cmd = "%s -ds %s -o sdpa.out" % (sdpa_qd_cmd, input_filename)
+
+    else:
+        raise ValueError("unknown solver.")
+
+    # SDPA reads initial points in the same format as CSDP.
+    if not initial_point_filename is None:
+        cmd += " -is %s" % initial_point_filename
+
+    if not max_gap is None:
+        cmd += " -p param.sdpa"
+
+    return cmd, "sdpa.out"
+
+
+# CSDP reads these in order, so every one must be present. The defaults are CSDP's own.
+_csdp_parameters = ["axtol=1.0e-8", "atytol=1.0e-8", "objtol=%r", "pinftol=1.0e8",
+                    "dinftol=1.0e8", "maxiter=100", "minstepfrac=0.90", "maxstepfrac=0.97",
+                    "minstepp=1.0e-8", "minstepd=1.0e-8", "usexzgap=1", "tweakgap=0",
+                    "affine=0", "printlevel=1", "perturbobj=1", "fastmode=0"]
+
+# The SDPA parameter file, with SDPA's defaults except for epsilonStar and epsilonDash.
+_sdpa_parameters = ["100 unsigned int maxIteration;",
+                    "%r double 0.0 < epsilonStar;",
+                    "1.0E2 double 0.0 < lambdaStar;",
+                    "2.0 double 1.0 < omegaStar;",
+                    "-1.0E5 double lowerBound;",
+                    "1.0E5 double upperBound;",
+                    "0.1 double 0.0 <= betaStar < 1.0;",
+                    "0.2 double 0.0 <= betaBar < 1.0, betaStar <= betaBar;",
+                    "0.9 double 0.0 < gammaStar < 1.0;",
+                    "%r double 0.0 < epsilonDash;",
+                    "%+8.3e char* xPrint",
+                    "%+8.3e char* XPrint",
+                    "%+8.3e char* YPrint",
+                    "%+10.16e char* infPrint"]
+
+
+def write_solver_parameters(solver, directory, max_gap=None):
+    r"""
+    Writes the parameter file that makes ``solver`` stop once its relative duality gap
+    is below ``max_gap``, in ``directory`` (the solver's working directory). If
+    ``max_gap`` is None, any parameter file left there by an earlier run is removed, so
+    that the solver uses its default tolerances.
+    """
+    if solver == "csdp":
+        filename, template = os.path.join(directory, "param.csdp"), _csdp_parameters
+    elif "sdpa" in solver:
+        filename, template = os.path.join(directory, "param.sdpa"), _sdpa_parameters
+    else:
+        return
+
+    if max_gap is None:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+
+    lines = [line.replace("%r", repr(float(max_gap))) for line in template]
+    with open(filename, "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+
+
+def parse_objective_value(line):
+    r"""
+    Returns the primal objective value (as a string) if ``line`` of solver output reports
+    it, and None otherwise. Note that DSDP seems to print the absolute value.
+    """
+    if "Primal objective value:" in line:  # CSDP
+        return line.split()[-1]
+    elif "objValPrimal" in line:  # SDPA
+        return line.split()[-1]
+    elif "DSDP Solution" in line:  # DSDP
+        return line.split()[-1]
+    return None
+
+
+def solver_succeeded(solver, returncode, output, obj_val):
+    r"""
+    Whether a run of ``solver`` appears to have found an optimal solution. SDPA exits
+    with returncode 0 even when it fails, so its reported phase is checked instead.
+    """
+    if obj_val is None:
+        return False
+    if "sdpa" in solver:
+        return "pdOPT" in output
+    return returncode == 0
+
+
+def solver_available(solver):
+    r"""
+    Whether the command for ``solver`` can be found in PATH.
+    """
+    cmd = solver_command(solver, "")[0].split()[0]
+    return not find_executable(cmd) is None
+
+
+class SolverIteration(object):
+    r"""
+    One iteration reported by an SDP solver: the primal and dual objective values (in
+    the solver's own sign convention), the relative duality gap, and the number of
+    seconds since the solver was started.
+    """
+
+    def __init__(self, iteration, primal_objective, dual_objective, time):
+
+        self.iteration = iteration
+        self.primal_objective = primal_objective
+        self.dual_objective = dual_objective
+        self.gap = abs(dual_objective - primal_objective) / (
+            1.0 + abs(primal_objective) + abs(dual_objective))
+        self.time = time
+
+    def __repr__(self):
+        return "SolverIteration(%d, pobj=%.8e, dobj=%.8e, gap=%.2e, time=%.1fs)" % (
+            self.iteration, self.primal_objective, self.dual_objective, self.gap, self.time)
+
+
+def parse_iteration(solver, line):
+    r"""
+    Returns (iteration, primal objective, dual objective) if ``line`` of output from
+    ``solver`` is an iteration report, and None otherwise.
+    """
+    tokens = line.split()
+    try:
+        if solver in ["csdp", "ipm"]:
+            # Iter:  3 Ap: 9.00e-01 Pobj:  1.2e+00 Ad: 9.00e-01 Dobj:  1.3e+00
+            if len(tokens) > 0 and tokens[0] == "Iter:":
+                return (int(tokens[1]), float(tokens[tokens.index("Pobj:") + 1]),
+                        float(tokens[tokens.index("Dobj:") + 1]))
+        elif "sdpa" in solver:
+            # iteration, mu, thetaP, thetaD, objP, objD, alphaP, alphaD, beta
+            if len(tokens) == 9 and tokens[0].isdigit():
+                return int(tokens[0]), float(tokens[4]), float(tokens[5])
+        elif solver == "dsdp":
+            # iteration, PP objective, DD objective, PInfeas, DInfeas, ...
+            if len(tokens) >= 5 and tokens[0].isdigit():
+                return int(tokens[0]), float(tokens[1]), float(tokens[2])
+    except (ValueError, IndexError):
+        pass
+    return None
+
+
+class SolverMonitor(object):
+    r"""
+    Watches an SDP solver as it runs. Each iteration the solver reports is parsed into a
+    SolverIteration, stored in ``iterations``, and passed to the callbacks.
+
+    INPUT:
+
+     - ``callbacks`` - a list of functions (default: None). Each is called with every
+       SolverIteration; if one returns True, the solver is stopped.
+
+     - ``progress_bar`` - Boolean (default: False). Whether to display a progress bar,
+       based on how close the gap is to ``target_gap``.
+
+     - ``max_gap`` - Number or None (default: None). If given, the solver finishes once
+       the gap is less than this, and returns the solution it has reached. External
+       solvers are given this as their own stopping tolerance (see
+       ``write_solver_parameters``); the built-in solver returns its last iterate, with
+       a non-zero status. ``gap_reached`` records whether the gap was reached.
+
+     - ``max_time`` - Number or None (default: None). If given, the solver is stopped
+       after this many seconds.
+
+     - ``target_gap`` - Number (default: 1e-7). The gap at which the progress bar is full.
+
+    A solver that is stopped (by the time limit or a callback) does not write a solution,
+    so this is for cutting short solves that are taking too long, or for seeing roughly
+    how far a problem gets. The reason for stopping is in ``stop_reason``.
+    """
+
+    def __init__(self, callbacks=None, progress_bar=False, max_gap=None, max_time=None,
+                 target_gap=1e-7):
+
+        self.callbacks = [] if callbacks is None else list(callbacks)
+        self.progress_bar = progress_bar
+        self.max_gap = max_gap
+        self.max_time = max_time
+        self.target_gap = target_gap
+        self.start()
+
+    def start(self, solver=None):
+        self.solver = solver
+        self.iterations = []
+        self.stop_reason = None
+        self.gap_reached = False
+        self._start_time = time.time()
+
+    def elapsed(self):
+        return time.time() - self._start_time
+
+    def check_time(self):
+        r"""
+        Returns True if the solver should be stopped because it has run out of time.
+        """
+        if self.stop_reason is None and not self.max_time is None and self.elapsed() > self.max_time:
+            self.stop_reason = "time limit of %s seconds reached" % self.max_time
+        return not self.stop_reason is None
+
+    def line(self, line):
+        r"""
+        Processes a line of solver output. Returns True if the solver should be stopped.
+        """
+        it = parse_iteration(self.solver, line)
+        if it is None:
+            return self.check_time()
+        return self.iteration(SolverIteration(it[0], it[1], it[2], self.elapsed()))
+
+    def iteration(self, event):
+        r"""
+        Records a SolverIteration. Returns True if the solver should be stopped.
+        """
+        self.iterations.append(event)
+
+        for callback in self.callbacks:
+            if callback(event) and self.stop_reason is None:
+                self.stop_reason = "stopped by callback"
+
+        if self.progress_bar:
+            width = 40
+            done = numpy.log10(max(event.gap, 1e-300)) / numpy.log10(self.target_gap)
+            done = int(width * min(1.0, max(0.0, done)))
+            sys.stdout.write("\r[%s%s] iteration %d, gap %.2e, %.1fs" % (
+                "#" * done, "." * (width - done), event.iteration, event.gap, event.time))
+            sys.stdout.flush()
+
+        if not self.max_gap is None and event.gap < self.max_gap:
+            self.gap_reached = True
+
+        return self.check_time()
+
+    def finish(self):
+        if self.progress_bar and len(self.iterations) > 0:
+            sys.stdout.write("\n")
+
+
+class SolverLimits(object):
+    r"""
+    Resource limits for an external SDP solver process.
+
+    INPUT:
+
+     - ``wall_time`` - Number or None (default: None). The wall-clock limit, in seconds.
+
+     - ``cpu_time`` - Number or None (default: None). The CPU time limit, in seconds.
+
+     - ``memory`` - Integer or None (default: None). The address space limit, in bytes.
+
+    The CPU time and address space limits are set with setrlimit in the solver process,
+    so that a solver that needs too much memory fails to allocate it, rather than taking
+    the whole machine down.
+    """
+
+    def __init__(self, wall_time=None, cpu_time=None, memory=None):
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.memory = memory
+
+    def __repr__(self):
+        return "SolverLimits(wall_time=%s, cpu_time=%s, memory=%s)" % (
+            self.wall_time, self.cpu_time, self.memory)
+
+    def apply(self):
+        # Called in the solver process, just before it starts.
+        if not self.cpu_time is None:
+            cpu_time = int(numpy.ceil(self.cpu_time))
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, cpu_time + 5))
+        if not self.memory is None:
+            resource.setrlimit(resource.RLIMIT_AS, (int(self.memory), int(self.memory)))
+
+
+class SolverTelemetry(object):
+    r"""
+    Samples the memory and CPU usage of a solver process (from /proc, so only on Linux).
+    ``samples`` is a list of (seconds, rss, cpu_time) tuples; ``peak_rss`` and
+    ``peak_virtual`` are in bytes, and ``cpu_time`` and ``wall_time`` in seconds.
+    """
+
+    def __init__(self, sample_interval=1.0):
+        self.sample_interval = sample_interval
+        self.samples = []
+        self.peak_rss = 0
+        self.peak_virtual = 0
+        self.cpu_time = 0.0
+        self.wall_time = 0.0
+        self._start_time = time.time()
+        self._last_sample = None
+
+    def __repr__(self):
+        return "SolverTelemetry(peak_rss=%.1f MiB, cpu_time=%.1fs, wall_time=%.1fs)" % (
+            self.peak_rss / 2.0 ** 20, self.cpu_time, self.wall_time)
+
+    def sample(self, pid, force=False):
+        now = time.time()
+        self.wall_time = now - self._start_time
+        if not force and not self._last_sample is None and now - self._last_sample < self.sample_interval:
+            return
+        self._last_sample = now
+        try:
+            with open("/proc/%d/status" % pid) as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+            with open("/proc/%d/stat" % pid) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (IOError, OSError, ValueError):  # the process has gone, or no /proc
+            return
+        kb = lambda key: int(status.get(key, "0 kB").split()[0]) * 1024
+        rss = kb("VmRSS")
+        self.peak_rss = max(self.peak_rss, kb("VmHWM"), rss)
+        self.peak_virtual = max(self.peak_virtual, kb("VmPeak"))
+        # utime and stime are fields 14 and 15 of /proc/pid/stat
+        self.cpu_time = (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+        self.samples.append((self.wall_time, rss, self.cpu_time))
+
+
+class SolverLimitExceeded(ValueError):
+    r"""
+    Raised when an external SDP solver is stopped by one of its SolverLimits. ``limit``
+    is "wall_time", "cpu_time" or "memory", and ``telemetry`` is the SolverTelemetry of
+    the run, so that a caller can decide whether to retry with a smaller problem.
+    """
+
+    def __init__(self, solver, limit, limits, telemetry):
+        self.solver = solver
+        self.limit = limit
+        self.limits = limits
+        self.telemetry = telemetry
+        if limit == "memory":
+            value = "%.1f MiB" % (limits.memory / 2.0 ** 20)
+        else:
+            value = "%ss" % getattr(limits, limit)
+        ValueError.__init__(self, "%s exceeded its %s limit of %s (peak RSS %.1f MiB, peak virtual "
+                            "memory %.1f MiB, CPU time %.1fs, wall time %.1fs)." % (
+                                solver, limit.replace("_", " "), value,
+                                telemetry.peak_rss / 2.0 ** 20, telemetry.peak_virtual / 2.0 ** 20,
+                                telemetry.cpu_time, telemetry.wall_time))
+
+
+def _exceeded_limit(limits, telemetry, returncode, output):
+    # Works out which resource limit (if any) made a solver that exited by itself fail.
+    # Solvers stopped by a monitor or the wall-clock limit have no returncode, and the
+    # caller knows why they were stopped.
+    if limits is None or returncode is None or returncode == 0:
+        return None
+    if not limits.cpu_time is None:
+        # The soft limit sends SIGXCPU; the hard limit, 5 seconds later, sends SIGKILL.
+        if returncode == -signal.SIGXCPU or (returncode == -signal.SIGKILL and
+                                             telemetry.cpu_time >= limits.cpu_time):
+            return "cpu_time"
+    if not limits.memory is None and returncode != -signal.SIGXCPU:
+        # Allocations fail at the address space limit, and the solver exits or aborts.
+        if telemetry.peak_virtual >= 0.9 * limits.memory or (
+                returncode > 0 or returncode in [-signal.SIGABRT, -signal.SIGSEGV]) and \
+                re.search(r"alloc|memory", output, re.IGNORECASE):
+            return "memory"
+    return None
+
+
+def run_external_solver(solver, input_filename, directory, initial_point_filename=None,
+                        show_output=False, monitor=None, poll_interval=0.1, limits=None,
+                        telemetry=None):
+    r"""
+    Runs one of the external solvers listed in ``external_solvers`` on an SDPA input
+    file, in ``directory``. The output file is in the solver's own format; see
+    ``read_sdp_solution_file``.
+
+    The solver's output is read through a pseudo-terminal (so that the solver does not
+    buffer it), without blocking, and passed line by line to ``monitor`` (a new
+    SolverMonitor if None), which may stop the solver. The monitor's ``max_gap`` is
+    given to the solver as its stopping tolerance, so that it still writes a solution.
+
+    Returns a tuple (returncode, output, objective, output_filename). ``objective``
+    is the string of the objective value printed by the solver (or None). If the solver
+    was stopped by the monitor, the returncode is None.
+
+    If ``limits`` (a SolverLimits, by default ``default_solver_limits``) is given, the
+    solver is run with those limits, and SolverLimitExceeded is raised if it hits one. The solver's memory and CPU usage are
+    sampled into ``telemetry`` (a SolverTelemetry), if given.
+    """
+    if monitor is None:
+        monitor = SolverMonitor()
+    if telemetry is None:
+        telemetry = SolverTelemetry()
+    if limits is None:
+        limits = default_solver_limits
+
+    cmd, output_name = solver_command(solver, input_filename, initial_point_filename,
+                                      max_gap=monitor.max_gap)
+    write_solver_parameters(solver, directory, monitor.max_gap)
+
+    if not solver_slot is None:
+        solver_slot.acquire()
+    try:
+        monitor.start(solver)
+        result = _run_external_solver(cmd, output_name, directory, show_output, monitor,
+                                      poll_interval, limits, telemetry)
+    finally:
+        if not solver_slot is None:
+            solver_slot.release()
+
+    returncode, output, obj_val, output_filename, stop_limit = result
+    if returncode is None:
+        limit = stop_limit  # None if the monitor stopped the solver
+    else:
+        limit = _exceeded_limit(limits, telemetry, returncode, output)
+    if not limit is None:
+        raise SolverLimitExceeded(solver, limit, limits, telemetry)
+    return returncode, output, obj_val, output_filename
+
+
+def _run_external_solver(cmd, output_name, directory, show_output, monitor, poll_interval,
+                         limits, telemetry):
+
+    master, slave = pty.openpty()
+    p = subprocess.Popen(shlex.split(cmd), cwd=directory, stdin=slave, stdout=slave,
+                         stderr=slave, close_fds=True,
+                         preexec_fn=None if limits is None else limits.apply)
+    os.close(slave)
+    wall_time = None if limits is None else limits.wall_time
+
+    obj_val = None
+    lines = []
+    pending = ""
+    stopped = False
+
+    def process(line):
+        if show_output:
+            sys.stdout.write(line + "\n")
+        lines.append(line)
+        return monitor.line(line)
+
+    timed_out = False
+
+    try:
+        while True:
+            telemetry.sample(p.pid)
+            if not wall_time is None and telemetry.wall_time > wall_time:
+                timed_out = True
+                p.kill()
+                break
+            ready = select.select([master], [], [], poll_interval)[0]
+            if ready:
+                try:
+                    data = os.read(master, 65536)
+                except OSError:  # raised on Linux once the solver has exited
+                    data = ""
+                if data == "":
+                    break
+                pending += data.replace("\r", "")
+                new_lines = pending.split("\n")
+                pending = new_lines.pop()
+                for line in new_lines:
+                    value = parse_objective_value(line)
+                    if not value is None:
+                        obj_val = value
+                    if process(line.strip()) and not stopped:
+                        stopped = True
+                        p.terminate()
+            elif p.poll() is not None:
+                break
+            elif monitor.check_time() and not stopped:
+                stopped = True
+                p.terminate()
+        if pending.strip() != "":
+            process(pending.strip())
+    finally:
+        telemetry.sample(p.pid, force=True)
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+        os.close(master)
+        monitor.finish()
+
+    output = "".join(line + "\n" for line in lines)
+
+    if stopped or timed_out:
+        return None, output, obj_val, None, "wall_time" if timed_out else None
+
+    returncode = p.returncode
+
+    # TODO: if program is infeasible, a returncode of 1 is given,
+    # and output contains "infeasible"
+
+    return returncode, output, obj_val, os.path.join(directory, output_name), None
+
+
+def race_external_solvers(solvers, input_filename, directory, initial_point_filename=None,
+                          show_output=False, poll_interval=0.1, limits=None, tolerance=1e-5,
+                          monitor=None, telemetry=None):
+    r"""
+    Runs several external solvers in parallel on the same SDPA input file, each in its
+    own subdirectory of ``directory``. The first solver to finish with a solution that
+    passes ``solver_succeeded``, and whose primal and dual infeasibilities (see
+    ``BlockSparseSDP.residuals``) are less than ``tolerance``, wins; the others are
+    killed. Solvers that cannot be found in PATH are skipped. The initial point file, if
+    given, is passed to every solver that can read one (see ``solver_command``).
+
+    Each solver holds a ``solver_slot`` while it runs. The first slot is waited for, but
+    only as many solvers are raced (in the order given) as there are slots to be had.
+
+    Each solver's output is passed to its own copy of ``monitor`` (without the progress
+    bar), so that the time limit and callbacks can stop the race, and the ``max_gap`` is
+    given to every solver. Afterwards ``monitor`` holds the iterations of the winner.
+
+    Returns a tuple (solver, returncode, output, objective, output_filename). If the race
+    was stopped by the monitor, the returncode and output_filename are None.
+
+    If ``limits`` (a SolverLimits, by default ``default_solver_limits``) is given, each
+    solver is run with those limits. If the wall-clock limit is reached, all the solvers are killed and SolverLimitExceeded is
+    raised. Each solver's memory and CPU usage is sampled into a SolverTelemetry, which
+    is stored in ``telemetry`` (a dictionary), if given, under the solver's name.
+    """
+    available = []
+    for solver in solvers:
+        if solver_available(solver):
+            available.append(solver)
+        else:
+            sys.stdout.write("Solver %s not found; skipping it.\n" % solver)
+
+    if len(available) == 0:
+        raise ValueError("none of the solvers %s could be found." % ", ".join(solvers))
+
+    if monitor is None:
+        monitor = SolverMonitor()
+    if telemetry is None:
+        telemetry = {}
+    if limits is None:
+        limits = default_solver_limits
+
+    if not solver_slot is None:
+        available = available[:solver_slot.acquire(len(available))]
+    try:
+        return _race_external_solvers(available, input_filename, directory, initial_point_filename,
+                                      show_output, poll_interval, limits, tolerance, monitor,
+                                      telemetry)
+    finally:
+        if not solver_slot is None:
+            solver_slot.release()
+
+
+def _verify_solution(sdp, filename, tolerance):
+    # Returns None if the solution in filename is nearly feasible for sdp, and otherwise
+    # the reason it is not.
+    try:
+        solution = read_sdp_solution_file(filename, sdp.block_sizes, sdp.num_constraints)
+        primal, dual = sdp.residuals(solution)
+    except (IOError, ValueError, IndexError) as e:
+        return "unreadable solution: %s" % e
+    if not (primal < tolerance and dual < tolerance):
+        return "infeasibilities %.2e and %.2e" % (primal, dual)
+    return None
+
+
+class _Racer(object):
+    # A solver process in a race, with its log file, its copy of the monitor, and its
+    # telemetry.
+
+    def __init__(self, solver, directory, input_filename, initial_point_filename, limits, monitor):
+
+        self.solver = solver
+        self.subdirectory = os.path.join(directory, solver)
+        if not os.path.isdir(self.subdirectory):
+            os.makedirs(self.subdirectory)
+
+        self.monitor = copy(monitor)
+        self.monitor.callbacks = list(monitor.callbacks)
+        self.monitor.progress_bar = False
+        self.monitor.start(solver)
+        self.telemetry = SolverTelemetry()
+
+        cmd, self.output_name = solver_command(solver, input_filename, initial_point_filename,
+                                               max_gap=monitor.max_gap)
+        write_solver_parameters(solver, self.subdirectory, monitor.max_gap)
+        self.log_filename = os.path.join(self.subdirectory, "output.txt")
+        self.log = open(self.log_filename, "w")
+        self.reader = os.open(self.log_filename, os.O_RDONLY)
+        self.pending = ""
+        self.process = subprocess.Popen(shlex.split(cmd), cwd=self.subdirectory, stdout=self.log,
+                                        stderr=subprocess.STDOUT,
+                                        preexec_fn=None if limits is None else limits.apply)
+
+    def read(self):
+        # Passes the new lines of output to the monitor. Returns True if it says stop.
+        while True:
+            data = os.read(self.reader, 65536)
+            if data == "":
+                break
+            self.pending += data.replace("\r", "")
+        lines = self.pending.split("\n")
+        self.pending = lines.pop()
+        stop = False
+        for line in lines:
+            stop = self.monitor.line(line.strip()) or stop
+        return stop
+
+    def close(self):
+        self.telemetry.sample(self.process.pid, force=True)
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.log.close()
+        os.close(self.reader)
+
+
+def _race_external_solvers(solvers, input_filename, directory, initial_point_filename,
+                           show_output, poll_interval, limits, tolerance, monitor, telemetry):
+
+    sdp = BlockSparseSDP.read(input_filename)
+    running = {}
+    start_time = time.time()
+    monitor.start(None)
+
+    winner = None
+    stopped = None
+    try:
+        for solver in solvers:
+            running[solver] = _Racer(solver, directory, input_filename, initial_point_filename,
+                                     limits, monitor)
+            telemetry[solver] = running[solver].telemetry
+
+        sys.stdout.write("Racing %s...\n" % ", ".join(sorted(running.keys())))
+
+        while len(running) > 0 and winner is None and stopped is None:
+            time.sleep(poll_interval)
+            for racer in running.values():
+                racer.telemetry.sample(racer.process.pid)
+            if not limits is None and not limits.wall_time is None and time.time() - start_time > limits.wall_time:
+                # Report the solver that has used the most memory.
+                racer = max(running.values(), key=lambda r: r.telemetry.peak_rss)
+                raise SolverLimitExceeded(", ".join(sorted(running.keys())), "wall_time", limits,
+                                          racer.telemetry)
+            for solver in list(running.keys()):
+                racer = running[solver]
+                returncode = racer.process.poll()
+                if racer.read() or racer.monitor.check_time():
+                    stopped = racer
+                    break
+                if returncode is None:
+                    continue
+                racer.close()
+                del running[solver]
+                with open(racer.log_filename, "r") as f:
+                    output = f.read()
+                obj_val = None
+                for line in output.splitlines():
+                    value = parse_objective_value(line)
+                    if not value is None:
+                        obj_val = value
+                if solver_succeeded(solver, returncode, output, obj_val):
+                    output_filename = os.path.join(racer.subdirectory, racer.output_name)
+                    rejection = _verify_solution(sdp, output_filename, tolerance)
+                    if rejection is None:
+                        winner = (racer, returncode, output, obj_val, output_filename)
+                        break
+                    sys.stdout.write("Solver %s finished, but its solution was rejected (%s).\n" % (
+                        solver, rejection))
+                    continue
+                limit = _exceeded_limit(limits, racer.telemetry, returncode, output)
+                sys.stdout.write("Solver %s failed (returncode %d%s).\n" % (solver, returncode,
+                                 "" if limit is None else ", %s limit" % limit.replace("_", " ")))
+    finally:
+        for racer in running.values():
+            racer.close()
+
+    if not stopped is None:
+        monitor.solver, monitor.iterations = stopped.solver, stopped.monitor.iterations
+        monitor.stop_reason = stopped.monitor.stop_reason
+        with open(stopped.log_filename, "r") as f:
+            output = f.read()
+        return stopped.solver, None, output, None, None
+
+    if winner is None:
+        raise ValueError("none of the solvers succeeded.")
+
+    racer, returncode, output, obj_val, output_filename = winner
+    monitor.solver, monitor.iterations = racer.solver, racer.monitor.iterations
+    monitor.gap_reached = racer.monitor.gap_reached
+
+    if show_output:
+        sys.stdout.write(output)
+
+    return racer.solver, returncode, output, obj_val, output_filename
+
+
+# The solvers that have won races, keyed by a description of the problem, so that
+# they can be tried first on similar problems.
+solver_race_winners = {}
+
+
+def remember_solver(key, solver):
+    solver_race_winners[key] = solver
+
+
+def preferred_solver_order(key, solvers):
+    r"""
+    Returns ``solvers`` with the solver that last won a race for ``key`` (if any) first.
+    """
+    solvers = list(solvers)
+    winner = solver_race_winners.get(key)
+    if winner in solvers:
+        solvers.remove(winner)
+        solvers.insert(0, winner)
+    return solvers
+
+
+def _matching_brace(text, start):
+    # Returns the index just after the brace that closes the first "{" at or after start.
+    chars = numpy.frombuffer(text[start:], dtype=numpy.uint8)
+    depth = numpy.cumsum((chars == ord("{")).astype(numpy.int64) - (chars == ord("}")))
+    opened = numpy.flatnonzero(depth > 0)
+    if len(opened) == 0:
+        raise ValueError("malformed SDPA output file.")
+    closed = numpy.flatnonzero(depth[opened[0]:] == 0)
+    if len(closed) == 0:
+        raise ValueError("malformed SDPA output file.")
+    return start + opened[0] + closed[0] + 1
+
+
+def _parse_numbers(text):
+    return numpy.array(_number_pattern.findall(text), dtype=numpy.float64)
+
+_number_pattern = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+
+def _sdpa_blocks(numbers, block_sizes):
+    # Splits the numbers of a block matrix printed by SDPA (dense blocks row by row,
+    # diagonal blocks as a vector) into square numpy arrays.
+    blocks = []
+    pos = 0
+    for bs in block_sizes:
+        n = abs(bs)
+        if bs > 0:
+            M = numbers[pos:pos + n * n].reshape(n, n)
+            pos += n * n
+        else:
+            M = numpy.diag(numbers[pos:pos + n])
+            pos += n
+        blocks.append(M)
+    if pos != len(numbers):
+        raise ValueError("SDPA output does not match the block structure.")
+    return blocks
+
+
+def read_sdpa_output_file(filename, block_sizes, num_constraints):
+    r"""
+    Reads the solution from an output file written by SDPA (or one of its variants),
+    and returns an SDPSolution. SDPA's names are the other way round to CSDP's: its
+    xVec is y, its xMat is Z and its yMat is X.
+    """
+    with open(filename, "r") as f:
+        text = f.read()
+
+    def section(name, required=True):
+        start = text.find(name + " =")
+        if start < 0:
+            if required:
+                raise ValueError("%s not found in SDPA output file." % name)
+            return None
+        return _parse_numbers(text[start + len(name) + 2:_matching_brace(text, start)])
+
+    X = _sdpa_blocks(section("yMat"), block_sizes)
+    Z_numbers = section("xMat", required=False)
+    Z = [numpy.zeros(M.shape) for M in X] if Z_numbers is None else _sdpa_blocks(Z_numbers, block_sizes)
+    y = section("xVec", required=False)
+    if y is None or len(y) != num_constraints:
+        y = numpy.zeros(num_constraints)
+
+    return SDPSolution(X, y, Z)
+
+
+def read_sdp_solution_file(filename, block_sizes, num_constraints):
+    r"""
+    Reads a solution file in the format written by CSDP (and DSDP), or an SDPA output
+    file, and returns an SDPSolution. Entries of blocks beyond ``block_sizes`` are
+    ignored. The entries are parsed in bulk with numpy.
+    """
+    # The first line of a CSDP solution file is y; SDPA output starts with text.
+    with open(filename, "r") as f:
+        first_line = f.readline()
+    if _number_pattern.sub("", first_line).strip() != "" or first_line.strip() == "":
+        return read_sdpa_output_file(filename, block_sizes, num_constraints)
+
+    dims = [abs(bs) for bs in block_sizes]
+    X = [numpy.zeros((d, d)) for d in dims]
+    Z = [numpy.zeros((d, d)) for d in dims]
+    y = numpy.zeros(num_constraints)
+
+    with open(filename, "r") as f:
+        first_line = f.readline()
+        rest = f.read()
+
+    tokens = first_line.split()
+    is_entry = len(tokens) == 5 and tokens[0] in ["1", "2"] and all(t.isdigit() for t in tokens[1:4])
+    if is_entry:
+        rest = first_line + rest
+    elif len(tokens) == num_constraints:
+        y = numpy.array(tokens, dtype=numpy.float64)
+
+    # Every line is an entry "matrix block row column value"; blank lines are skipped.
+    entries = [line.split() for line in rest.splitlines()]
+    entries = [entry for entry in entries if len(entry) > 0]
+    for entry in entries:
+        if len(entry) != 5:
+            raise ValueError("malformed solution file %s: the line %r is not an entry." % (
+                filename, " ".join(entry)))
+    try:
+        data = numpy.array(entries, dtype=numpy.float64).reshape(-1, 5)
+    except ValueError:
+        raise ValueError("malformed solution file %s: an entry is not numeric." % filename)
+    mats = data[:, 0].astype(numpy.int64)
+    blocks = data[:, 1].astype(numpy.int64) - 1
+    rows = data[:, 2].astype(numpy.int64) - 1
+    cols = data[:, 3].astype(numpy.int64) - 1
+
+    for mi, matrices in ((1, Z), (2, X)):
+        for bi in range(len(dims)):
+            sel = (mats == mi) & (blocks == bi)
+            if not sel.any():
+                continue
+            matrices[bi][rows[sel], cols[sel]] = data[sel, 4]
+            matrices[bi][cols[sel], rows[sel]] = data[sel, 4]
+
+    return SDPSolution(X, y, Z)
+
+
+class ExternalSolverBackend(SDPBackend):
+    r"""
+    Solves SDPs by writing an SDPA input file and running CSDP, SDPA (or one of its
+    variants) or DSDP on it. The solver must be in a directory listed in PATH.
+
+    If ``limits`` (a SolverLimits) is given, the solver is run with those limits (see
+    ``run_external_solver``).
+    """
+
+    def __init__(self, solver="csdp", directory=None, limits=None):
+
+        if not solver in external_solvers:
+            raise ValueError("unknown solver.")
+
+        self.name = solver
+        self._directory = directory
+        self.limits = limits
+
+    def solve(self, sdp, show_output=False, monitor=None, initial_point=None):
+
+        directory = self._directory
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="flagmatic-")
+
+        input_filename = os.path.join(directory, "sdp.dat-s")
+        sdp.write(input_filename)
+
+        initial_point_filename = None
+        if not initial_point is None:
+            initial_point_filename = os.path.join(directory, "sdp.ini-s")
+            initial_point.write_initial_point(initial_point_filename)
+
+        returncode, output, obj_val, output_filename = run_external_solver(self.name,
+            input_filename, directory, initial_point_filename=initial_point_filename,
+            show_output=show_output, monitor=monitor, limits=self.limits)
+
+        if returncode is None:
+            if self._directory is None:
+                shutil.rmtree(directory, ignore_errors=True)
+            raise ValueError("SDP solver stopped: %s." % monitor.stop_reason)
+
+        solution = read_sdp_solution_file(output_filename, sdp.block_sizes, sdp.num_constraints)
+        solution.status = returncode
+        solution.output = output
+        if not obj_val is None:
+            solution.primal_objective = float(obj_val)
+        solution.dual_objective = float(numpy.dot(sdp.b, solution.y))
+
+        if self._directory is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        return solution
+
+
+class InteriorPointBackend(SDPBackend):
+    r"""
+    A primal-dual interior-point SDP solver written using numpy, that runs in-process.
+    It uses the HKM search direction with a Mehrotra-type predictor-corrector choice of
+    the centering parameter, and a dense Schur complement matrix. It is intended for
+    small and medium sized problems; for large problems use CSDP or SDPA.
+
+    INPUT:
+
+     - ``tolerance`` - Number (default: 1e-8). The solver stops when the relative duality
+       gap and the relative primal and dual infeasibilities are all less than this.
+
+     - ``max_iterations`` - Integer (default: 100).
+
+    The status of the solution is 0 if the tolerance was reached, 1 if the solver ran
+    out of iterations, and 2 if it stopped at the monitor's ``max_gap``.
+    """
+
+    name = "ipm"
+
+    def __init__(self, tolerance=1e-8, max_iterations=100):
+
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+
+    def _split(self, sdp):
+        # Group the entries by block, separating C from the A_i.
+        parts = []
+        for bi in range(sdp.num_blocks):
+            sel = sdp.blocks == bi
+            mats, rows, cols, vals = sdp.matrices[sel], sdp.rows[sel], sdp.cols[sel], sdp.values[sel]
+            is_c = mats == 0
+            c_part = (rows[is_c], cols[is_c], vals[is_c])
+            a_part = (mats[~is_c] - 1, rows[~is_c], cols[~is_c], vals[~is_c])
+            parts.append((c_part, a_part))
+        return parts
+
+    def _sym(self, n, rows, cols, vals):
+        M = numpy.zeros((n, n))
+        numpy.add.at(M, (rows, cols), vals)
+        off = rows != cols
+        numpy.add.at(M, (cols[off], rows[off]), vals[off])
+        return M
+
+    def _A(self, parts, sizes, m, W):
+        # The vector (tr(A_i W))_i; W need not be symmetric.
+        result = numpy.zeros(m)
+        for bi in range(len(sizes)):
+            mats, rows, cols, vals = parts[bi][1]
+            if len(vals) == 0:
+                continue
+            if sizes[bi] < 0:
+                w = vals * W[bi][rows]
+            else:
+                w = vals * numpy.where(rows == cols, 0.5, 1.0) * (W[bi][rows, cols] + W[bi][cols, rows])
+            result += numpy.bincount(mats, weights=w, minlength=m)
+        return result
+
+    def _AT(self, parts, sizes, y):
+        # The block diagonal matrix sum_i y_i A_i
+        result = []
+        for bi in range(len(sizes)):
+            mats, rows, cols, vals = parts[bi][1]
+            n = abs(sizes[bi])
+            if sizes[bi] < 0:
+                result.append(numpy.bincount(rows, weights=vals * y[mats], minlength=n))
+            else:
+                result.append(self._sym(n, rows, cols, vals * y[mats]))
+        return result
+
+    def _max_step(self, sizes, V, dV):
+        step = 1.0
+        for bi in range(len(sizes)):
+            if sizes[bi] < 0:
+                neg = dV[bi] < 0
+                if neg.any():
+                    step = min(step, numpy.min(-V[bi][neg] / dV[bi][neg]))
+            elif sizes[bi] > 0:
+                L = numpy.linalg.cholesky(V[bi])
+                Li = numpy.linalg.inv(L)
+                ev = numpy.linalg.eigvalsh(Li.dot(dV[bi]).dot(Li.T))
+                if ev[0] < 0:
+                    step = min(step, -1.0 / ev[0])
+        return step
+
+    def solve(self, sdp, show_output=False, monitor=None, initial_point=None):
+
+        if monitor is None:
+            monitor = SolverMonitor()
+        monitor.start(self.name)
+
+        sizes = sdp.block_sizes
+        nb = len(sizes)
+        m = sdp.num_constraints
+        b = sdp.b
+        parts = self._split(sdp)
+        dims = [abs(bs) for bs in sizes]
+        n = sum(dims)
+
+        C = []
+        for bi in range(nb):
+            rows, cols, vals = parts[bi][0]
+            if sizes[bi] < 0:
+                C.append(numpy.bincount(rows, weights=vals, minlength=dims[bi]))
+            else:
+                C.append(self._sym(dims[bi], rows, cols, vals))
+
+        def inner(U, V):
+            return sum(numpy.sum(U[bi] * V[bi]) for bi in range(nb))
+
+        def norm(U):
+            return numpy.sqrt(inner(U, U))
+
+        # Starting point, as suggested by Toh, Todd and Tutuncu.
+        a_norms = numpy.zeros(m)
+        for bi in range(nb):
+            mats, rows, cols, vals = parts[bi][1]
+            w = vals ** 2 * (numpy.where(rows == cols, 1.0, 2.0) if sizes[bi] > 0 else 1.0)
+            a_norms += numpy.bincount(mats, weights=w, minlength=m)
+        a_norms = numpy.sqrt(a_norms)
+        alpha = n * max(1.0, numpy.max((1.0 + numpy.abs(b)) / (1.0 + a_norms)))
+        beta = (1.0 + max(numpy.max(a_norms), norm(C))) / numpy.sqrt(n)
+        alpha, beta = max(10.0, alpha), max(10.0, beta)
+
+        X = [alpha * (numpy.ones(dims[bi]) if sizes[bi] < 0 else numpy.eye(dims[bi])) for bi in range(nb)]
+        Z = [beta * (numpy.ones(dims[bi]) if sizes[bi] < 0 else numpy.eye(dims[bi])) for bi in range(nb)]
+        y = numpy.zeros(m)
+
+        if not initial_point is None:
+            X = [numpy.diag(initial_point.X[bi]).copy() if sizes[bi] < 0 else initial_point.X[bi].copy()
+                 for bi in range(nb)]
+            Z = [numpy.diag(initial_point.Z[bi]).copy() if sizes[bi] < 0 else initial_point.Z[bi].copy()
+                 for bi in range(nb)]
+            y = numpy.array(initial_point.y, dtype=numpy.float64)
+
+        output = ""
+        status = 1
+        iteration = 0
+
+        for iteration in range(1, self.max_iterations + 1):
+
+            ATy = self._AT(parts, sizes, y)
+            rp = b - self._A(parts, sizes, m, X)
+            Rd = [C[bi] - ATy[bi] + Z[bi] for bi in range(nb)]
+            mu = inner(X, Z) / n
+
+            pobj = inner(C, X)
+            dobj = numpy.dot(b, y)
+            gap = abs(pobj - dobj) / (1.0 + abs(pobj) + abs(dobj))
+            pinf = numpy.linalg.norm(rp) / (1.0 + numpy.linalg.norm(b))
+            dinf = norm(Rd) / (1.0 + norm(C))
+
+            line = "Iter: %2d Ap: %.2e Pobj: %.10e Ad: %.2e Dobj: %.10e gap: %.2e pinf: %.2e dinf: %.2e\n" % (
+                iteration, 0.0, pobj, 0.0, dobj, gap, pinf, dinf)
+            output += line
+            if show_output:
+                sys.stdout.write(line)
+
+            if gap < self.tolerance and pinf < self.tolerance and dinf < self.tolerance:
+                status = 0
+                break
+
+            if monitor.iteration(SolverIteration(iteration, pobj, dobj, monitor.elapsed())):
+                monitor.finish()
+                raise ValueError("SDP solver stopped: %s." % monitor.stop_reason)
+
+            if monitor.gap_reached:
+                status = 2
+                break
+
+            Zinv = [1.0 / Z[bi] if sizes[bi] < 0 else numpy.linalg.inv(Z[bi]) for bi in range(nb)]
+
+            # Schur complement matrix M_ij = tr(A_i X A_j Z^-1)
+            M = numpy.zeros((m, m))
+            for bi in range(nb):
+                mats, rows, cols, vals = parts[bi][1]
+                if len(vals) == 0:
+                    continue
+                if sizes[bi] < 0:
+                    A = numpy.zeros((m, dims[bi]))
+                    numpy.add.at(A, (mats, rows), vals)
+                    M += (A * (X[bi] * Zinv[bi])).dot(A.T)
+                    continue
+                weights = vals * numpy.where(rows == cols, 1.0, 2.0)
+                order = numpy.argsort(mats, kind="mergesort")
+                starts = numpy.searchsorted(mats[order], numpy.arange(m + 1))
+                for j in range(m):
+                    sel = order[starts[j]:starts[j + 1]]
+                    if len(sel) == 0:
+                        continue
+                    p, q, v = rows[sel], cols[sel], vals[sel] * numpy.where(rows[sel] == cols[sel], 0.5, 1.0)
+                    W = (X[bi][:, p] * v).dot(Zinv[bi][q, :]) + (X[bi][:, q] * v).dot(Zinv[bi][p, :])
+                    W = 0.5 * (W + W.T)
+                    M[:, j] += numpy.bincount(mats, weights=weights * W[rows, cols], minlength=m)
+
+            M = 0.5 * (M + M.T)
+            try:
+                LM = numpy.linalg.cholesky(M)
+                solve_M = lambda r: numpy.linalg.solve(LM.T, numpy.linalg.solve(LM, r))
+            except numpy.linalg.LinAlgError:
+                solve_M = lambda r: numpy.linalg.lstsq(M, r, rcond=-1)[0]
+
+            def direction(sigma):
+                # HKM direction for the centering parameter sigma
+                G = []
+                for bi in range(nb):
+                    if sizes[bi] < 0:
+                        G.append(sigma * mu * Zinv[bi] + X[bi] * Rd[bi] * Zinv[bi])
+                    else:
+                        G.append(sigma * mu * Zinv[bi] + X[bi].dot(Rd[bi]).dot(Zinv[bi]))
+                dy = solve_M(self._A(parts, sizes, m, G) - b)
+                ATdy = self._AT(parts, sizes, dy)
+                dZ = [ATdy[bi] - Rd[bi] for bi in range(nb)]
+                dX = []
+                for bi in range(nb):
+                    if sizes[bi] < 0:
+                        dX.append(sigma * mu * Zinv[bi] - X[bi] - X[bi] * dZ[bi] * Zinv[bi])
+                    else:
+                        D = sigma * mu * Zinv[bi] - X[bi] - X[bi].dot(dZ[bi]).dot(Zinv[bi])
+                        dX.append(0.5 * (D + D.T))
+                return dX, dy, dZ
+
+            dX, dy, dZ = direction(0.0)
+            ap = self._max_step(sizes, X, dX)
+            ad = self._max_step(sizes, Z, dZ)
+            mu_aff = inner([X[bi] + ap * dX[bi] for bi in range(nb)],
+                           [Z[bi] + ad * dZ[bi] for bi in range(nb)]) / n
+            sigma = min(1.0, (mu_aff / mu) ** 3)
+
+            dX, dy, dZ = direction(sigma)
+            ap = min(1.0, 0.95 * self._max_step(sizes, X, dX))
+            ad = min(1.0, 0.95 * self._max_step(sizes, Z, dZ))
+
+            X = [X[bi] + ap * dX[bi] for bi in range(nb)]
+            y = y + ad * dy
+            Z = [Z[bi] + ad * dZ[bi] for bi in range(nb)]
+
+        X = [numpy.diag(X[bi]) if sizes[bi] < 0 else X[bi] for bi in range(nb)]
+        Z = [numpy.diag(Z[bi]) if sizes[bi] < 0 else Z[bi] for bi in range(nb)]
+
+        pobj = sum(numpy.sum(C[bi] * (numpy.diag(X[bi]) if sizes[bi] < 0 else X[bi])) for bi in range(nb))
+        dobj = numpy.dot(b, y)
+
+        monitor.finish()
+
+        line = "Primal objective value: %.10e\nDual objective value: %.10e\n" % (pobj, dobj)
+        output += line
+        if show_output:
+            sys.stdout.write(line)
+
+        return SDPSolution(X, y, Z, primal_objective=pobj, dual_objective=dobj, status=status,
+                           iterations=iteration, output=output)
+
+
+def sdp_backend(solver):
+    r"""
+    Returns an SDPBackend for ``solver``, which should be an SDPBackend, the name of an
+    external solver (see ``external_solvers``), or "ipm" for the built-in
+    InteriorPointBackend.
+    """
+    if isinstance(solver, SDPBackend):
+        return solver
+    if solver == InteriorPointBackend.name:
+        return InteriorPointBackend()
+    if solver in external_solvers:
+        return ExternalSolverBackend(solver)
+    raise ValueError("unknown solver.")